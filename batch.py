@@ -0,0 +1,406 @@
+"""
+Batch mode: every PDF of a directory through the whole pipeline in one job.
+
+Each document gets its own namespace, <BATCH_OUTPUT_DIR>/<pdf stem>/, laid out
+like a main.py run (files/, files_style/, output/, files-out/,
+extractionOut[Style]/). Work is scheduled per (document, page), not per
+document:
+
+- a pool of BATCH_WORKERS processes prepares pages (rasterize, detect,
+  crop/draw, style CSV); each worker keeps its YOLO models from one item to
+  the next. A task is a run of BATCH_RUN_PAGES consecutive pages of one
+  document, so the worker opens that PDF once per run, and runs are
+  submitted one document after the other, so every manual makes progress
+  from the start;
+- GEMINI_CONCURRENCY threads send the prepared pages, taking documents in
+  turn (FairQueue). The in-process limiter and the SQLite ledger are shared,
+  so the RPM/RPD budget is split evenly between the documents that still
+  have pages waiting, and a 400-page manual does not starve the short ones.
+
+Finished pages (extracted, or without detections) are recorded in each
+document's manifest (<doc>/.manifest-batch) and skipped on the next run: a job
+stopped by the daily quota resumes where it stopped. A page or a PDF that
+fails, including a page without a complete Gemini response, is logged and its
+document marked failed; the other documents go on.
+Only the daily quota stops the whole job. --force starts the documents again
+from empty directories.
+
+    python batch.py <pdf_dir> [--out DIR] [--workers N] [--force true]
+"""
+import importlib
+import itertools
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from pathlib import Path
+
+import telemetry
+from cliOptions import pop_option
+from config import (BATCH_OUTPUT_DIR, BATCH_QUEUE_SIZE, BATCH_RUN_PAGES, BATCH_WORKERS, PIPELINE_MATERIALIZE,
+                    STYLE_MODE)
+from manifest import Manifest, inputs_digest
+from pdfToImages import count_pdf_pages
+
+DPI = 450
+OPEN_DOCS_PER_WORKER = 2   # PdfPages + StyleTable kept open per pool process (a run reads one document)
+
+
+# =========================
+# PAGE PREPARATION (pool processes)
+# =========================
+_models = None
+_open_docs = OrderedDict()   # pdf path -> (PdfPages, StyleTable)
+
+
+def _open_doc(pdf_path):
+    import pdfToTxtStyle
+    from memoryBudget import PdfPages
+
+    if pdf_path in _open_docs:
+        _open_docs.move_to_end(pdf_path)
+        return _open_docs[pdf_path]
+    _open_docs[pdf_path] = (PdfPages(pdf_path, label=Path(pdf_path).stem), pdfToTxtStyle.StyleTable())
+    while len(_open_docs) > OPEN_DOCS_PER_WORKER:
+        _path, (pages, _styles) = _open_docs.popitem(last=False)
+        pages.close()
+    return _open_docs[pdf_path]
+
+
+def _close_doc(pdf_path):
+    entry = _open_docs.pop(pdf_path, None)
+    if entry is not None:
+        entry[0].close()
+
+
+def prepare_page(doc_id, pdf_path, doc_dir, page_num, materialize=True, dpi=DPI):
+    """
+    Everything before Gemini for one page, written under doc_dir like run_streaming does.
+    Returns (doc_id, page_num, annotated bytes, style CSV); annotated is None without detections.
+    """
+    global _models
+    import cropImages
+    import detectImages
+    import drawBoxes
+    import pdfToTxtStyle
+    from detectService import ModelCache
+    from imageProfiles import get_profile, write_image
+    from pdfToImages import page_array
+
+    def sub(name):
+        path = Path(doc_dir) / name
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    if _models is None:
+        _models = ModelCache()
+    pages, styles = _open_doc(pdf_path)
+
+    with telemetry.span("batch.page", doc=doc_id, page=page_num) as span:
+        img = page_array(pages.doc, page_num, dpi)
+        if materialize:
+            write_image(img, sub("files") / f"page_{page_num}.png", get_profile("pages"))
+
+        csv_content = pdfToTxtStyle.page_style_csv(pages.doc, page_num, styles,
+                                                    sub("files_style") if materialize else None)
+        pages.page_done(page_num)
+
+        predict_root = sub(detectImages.output_dir) if materialize else None
+        shapes = detectImages.detect_arrays(_models, [(page_num, img)], predict_root).get(page_num)
+        span["detections"] = len(shapes or ())
+        if not shapes:
+            return doc_id, page_num, None, csv_content
+
+        cropImages.crop_page(img, shapes, page_num, sub(cropImages.crop_folder), get_profile("crops"))
+        data, _small = drawBoxes.render_annotated(img, shapes, page_num, get_profile("annotated"),
+                                                  sub("files-out") if materialize else None)
+    return doc_id, page_num, data, csv_content
+
+
+def prepare_run(doc_id, pdf_path, doc_dir, page_nums, materialize=True, dpi=DPI):
+    """
+    prepare_page over a run of pages of one document. A failing page does not
+    lose the others: returns (doc_id, [(page_num, annotated, csv, error)]),
+    error being None or the exception text.
+    """
+    results = []
+    for page_num in page_nums:
+        try:
+            _doc_id, _page_num, data, csv_content = prepare_page(doc_id, pdf_path, doc_dir, page_num,
+                                                                 materialize, dpi)
+            results.append((page_num, data, csv_content, None))
+        except Exception as e:
+            # the open document may be in a bad state: the next page reopens it
+            _close_doc(pdf_path)
+            results.append((page_num, None, None, f"{type(e).__name__}: {e}"))
+    return doc_id, results
+
+
+# =========================
+# FAIR GEMINI SCHEDULING
+# =========================
+class FairQueue:
+    """Prepared pages per document, handed out one document after the other (round robin)."""
+
+    def __init__(self):
+        self._queues = OrderedDict()   # doc_id -> deque, in serving order
+        self._size = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, doc_id, item) -> None:
+        with self._cond:
+            self._queues.setdefault(doc_id, deque()).append(item)
+            self._size += 1
+            self._cond.notify()
+
+    def get(self):
+        """(doc_id, item) of the next document in turn; None once closed and drained."""
+        with self._cond:
+            while not self._queues:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            doc_id, items = self._queues.popitem(last=False)
+            item = items.popleft()
+            self._size -= 1
+            if items:
+                # served: back of the rotation
+                self._queues[doc_id] = items
+            self._cond.notify_all()
+            return doc_id, item
+
+    def wait_below(self, size, abort: threading.Event) -> None:
+        """Blocks the producer while `size` pages or more are waiting for Gemini."""
+        with self._cond:
+            while self._size >= size and not abort.is_set():
+                self._cond.wait(timeout=0.2)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def clear(self) -> None:
+        with self._cond:
+            self._queues.clear()
+            self._size = 0
+            self._closed = True
+            self._cond.notify_all()
+
+
+# =========================
+# JOB
+# =========================
+def discover(pdf_dir):
+    """
+    {doc_id: pdf path} for the PDFs of pdf_dir, whatever the extension's case
+    (doc_id = file stem, or the file name when two PDFs share a stem).
+    """
+    pdfs = sorted((p for p in Path(pdf_dir).iterdir() if p.is_file() and p.suffix.lower() == ".pdf"),
+                  key=lambda p: p.name.lower())
+    docs = {}
+    for p in pdfs:
+        docs[p.name if p.stem in docs else p.stem] = p
+    return docs
+
+
+def interleave(pages_per_doc, run_pages=BATCH_RUN_PAGES):
+    """[(doc_id, [page_num, ...]), ...]: runs of up to run_pages pages, one run of each document in turn."""
+    run_pages = max(1, run_pages)
+    runs = ([(doc_id, pages[i:i + run_pages]) for i in range(0, len(pages), run_pages)]
+            for doc_id, pages in pages_per_doc.items())
+    return [item for round_ in itertools.zip_longest(*runs) for item in round_ if item is not None]
+
+
+def run_batch(pdf_dir, out_root=BATCH_OUTPUT_DIR, workers=BATCH_WORKERS, force=False,
+              materialize=PIPELINE_MATERIALIZE, postprocess=STYLE_MODE, queue_size=BATCH_QUEUE_SIZE,
+              run_pages=BATCH_RUN_PAGES):
+    gemini = importlib.import_module("extraction-gemini-vision")
+    postprocessing = importlib.import_module("postprocessing") if postprocess else None
+
+    docs = discover(pdf_dir)
+    if not docs:
+        print(f"[ERR] No PDF in {pdf_dir}")
+        return {}
+    out_root = Path(out_root)
+    extraction_dir = os.path.basename(gemini.output_dir)
+    cleaned_dir = os.path.basename(postprocessing.OUTPUT_DIR) if postprocess else None
+
+    stats = {doc_id: {"pages": 0, "skipped": 0, "no_detections": 0, "extracted": 0, "cleaned": 0, "failed": []}
+             for doc_id in docs}
+    manifests, digests, todo = {}, {}, {}
+    for doc_id, pdf_path in docs.items():
+        doc_dir = out_root / doc_id
+        if force and doc_dir.exists():
+            shutil.rmtree(doc_dir)
+        try:
+            total = count_pdf_pages(pdf_path)
+            digests[doc_id] = {n: inputs_digest(pdf_path, n) for n in range(1, total + 1)}
+        except Exception as e:
+            print(f"[ERR] {doc_id}: cannot read {pdf_path}: {e}")
+            stats[doc_id]["failed"].append(f"open: {e}")
+            continue
+        stats[doc_id]["pages"] = total
+        # resume: pages recorded as done (extracted or without detections) from this same PDF
+        manifest = manifests[doc_id] = Manifest(doc_dir, "batch")
+        manifest.prune(digests[doc_id])
+        todo[doc_id] = []
+        for n, digest in digests[doc_id].items():
+            if manifest.is_fresh(n, digest):
+                continue
+            # PDF replaced since: its old response goes with the entry
+            manifest.invalidate(n)
+            todo[doc_id].append(n)
+        stats[doc_id]["skipped"] = total - len(todo[doc_id])
+    work = interleave(todo, run_pages)
+    print(f"[RUN] Batch: {len(docs)} documents, {sum(len(pages) for pages in todo.values())} pages to process "
+          f"({sum(s['skipped'] for s in stats.values())} already done), {workers} workers, "
+          f"runs of {run_pages} pages, {gemini.GEMINI_CONCURRENCY} Gemini requests in flight")
+
+    client = gemini.genai.Client(api_key=gemini.load_api_key(gemini.api_key_path))
+    prepared = FairQueue()
+    abort = threading.Event()
+    limit_reached = []
+    stats_lock = threading.Lock()
+
+    def page_done(doc_id, page_num, outputs):
+        manifests[doc_id].record(page_num, digests[doc_id][page_num], outputs)
+        manifests[doc_id].save()
+
+    def page_failed(doc_id, page_num, error):
+        print(f"[ERR] {doc_id} page_{page_num}: {error}")
+        with stats_lock:
+            stats[doc_id]["failed"].append(f"page_{page_num}: {error}")
+
+    def send():
+        while not abort.is_set():
+            entry = prepared.get()
+            if entry is None:
+                return
+            doc_id, (page_num, data, csv_content) = entry
+            doc_dir = out_root / doc_id
+            out_json = str(doc_dir / extraction_dir / f"page_{page_num}.json")
+            os.makedirs(os.path.dirname(out_json), exist_ok=True)
+            try:
+                # a page still to do: a JSON left by an unrecorded attempt must not count as done
+                Path(out_json).unlink(missing_ok=True)
+                prepare = gemini.page_preparer(page_num, csv_content, data, None, out_json)
+                page = prepare() if prepare is not None else None
+                if page is None:
+                    # cache hit (JSON written) or nothing could be sent (missing CSV, bad image)
+                    ok = os.path.exists(out_json)
+                else:
+                    ok = gemini.process_prepared(client, page)
+                if not ok:
+                    # not recorded: the next run sends it again
+                    page_failed(doc_id, page_num, "no complete Gemini response")
+                    continue
+                page_done(doc_id, page_num, [out_json])
+                with stats_lock:
+                    stats[doc_id]["extracted"] += 1
+                if postprocess:
+                    os.makedirs(doc_dir / cleaned_dir, exist_ok=True)
+                    if postprocessing.fix_and_save(os.path.basename(out_json), os.path.dirname(out_json),
+                                                   str(doc_dir / cleaned_dir)):
+                        with stats_lock:
+                            stats[doc_id]["cleaned"] += 1
+            except gemini.DailyLimitReached as e:
+                # the only job-wide stop: the next run resumes
+                limit_reached.append(e)
+                abort.set()
+                prepared.clear()
+            except Exception as e:
+                page_failed(doc_id, page_num, f"{type(e).__name__}: {e}")
+
+    senders = [threading.Thread(target=send, name=f"gemini-{i}") for i in range(gemini.GEMINI_CONCURRENCY)]
+    for t in senders:
+        t.start()
+
+    t0 = time.perf_counter()
+    items = iter(work)
+    in_flight = {}   # future -> (doc_id, page run)
+    # spawn: ultralytics/torch do not survive a fork reliably
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=get_context("spawn")) as pool:
+        try:
+            while not abort.is_set():
+                while len(in_flight) < 2 * max(1, workers):
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    doc_id, page_nums = item
+                    fut = pool.submit(prepare_run, doc_id, str(docs[doc_id]), str(out_root / doc_id),
+                                      page_nums, materialize, DPI)
+                    in_flight[fut] = item
+                if not in_flight:
+                    break
+                finished, _pending = wait(in_flight, timeout=0.5, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    doc_id, page_nums = in_flight.pop(fut)
+                    try:
+                        _doc_id, results = fut.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        results = [(n, None, None, f"{type(e).__name__}: {e}") for n in page_nums]
+                    for page_num, data, csv_content, error in results:
+                        if error is not None:
+                            page_failed(doc_id, page_num, error)
+                            continue
+                        if data is None:
+                            print(f"  No detections: {doc_id} page_{page_num}")
+                            page_done(doc_id, page_num, [])
+                            with stats_lock:
+                                stats[doc_id]["no_detections"] += 1
+                            continue
+                        prepared.put(doc_id, (page_num, data, csv_content))
+                # Gemini is the slow step: do not prepare more than queue_size pages ahead
+                prepared.wait_below(queue_size, abort)
+        except BaseException:
+            abort.set()
+            prepared.clear()
+            for fut in in_flight:
+                fut.cancel()
+            raise
+        finally:
+            prepared.close()
+            for t in senders:
+                t.join()
+
+    print(f"\n[TIME] total : {time.perf_counter() - t0:.3f}s")
+    for doc_id, s in stats.items():
+        print(f"  {doc_id}: {s['skipped'] + s['extracted'] + s['no_detections']}/{s['pages']} pages done "
+              f"({s['extracted']} extracted this run, {s['no_detections']} without detections"
+              + (f", {s['cleaned']} cleaned)" if postprocess else ")")
+              + (f" -- FAILED, {len(s['failed'])} errors (first: {s['failed'][0]})" if s["failed"] else ""))
+    gemini.print_run_summary()
+    for e in limit_reached:
+        print(f" {e} Stopping; run the batch again to resume.")
+    return stats
+
+
+def main():
+    argv = list(sys.argv)
+    out_root = pop_option(argv, "--out", BATCH_OUTPUT_DIR)
+    workers = int(pop_option(argv, "--workers", BATCH_WORKERS))
+    force = pop_option(argv, "--force", "false").lower() == "true"
+    if len(argv) < 2:
+        print("Usage: python batch.py <pdf_dir> [--out DIR] [--workers N] [--force true]")
+        sys.exit(1)
+
+    telemetry.run_id()   # pool processes share the run's trace directory
+    try:
+        stats = run_batch(argv[1], out_root, workers, force)
+    finally:
+        telemetry.finish_run()
+    if any(s["failed"] for s in stats.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
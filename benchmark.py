@@ -0,0 +1,400 @@
+"""
+Benchmark of every pipeline stage on synthetic PDFs (no manual, model or API key needed).
+
+The fixture PDF is generated with PyMuPDF: text lines in several fonts, sizes
+and colors (density = lines per page) plus embedded raster images. Each stage
+then runs in a fresh process on the previous stage's outputs, so its timing
+and peak RSS are its own. A stage whose inputs come from a stage left out of
+--stages still gets them: the missing prerequisites run first, untimed.
+
+    raster   pdfToImages.pdf_to_images_best_quality (RASTER_BACKEND, fitz if gs is missing)
+    style    pdfToTxtStyle.export_phrase_compact_from_doc, page by page
+    detect   detectImages.detect_batched with a stub model (boxes around the embedded images)
+    cropdraw cropAndDraw.main
+    gemini   extraction-gemini-vision against a local fake Gemini server
+
+    python benchmark.py [--pages 20] [--density low|medium|high] [--images 2] [--dpi 450]
+                        [--stages raster,style,...] [--api-latency 0.5]
+                        [--save-baseline true] [--baseline benchmark_baseline.json] [--tolerance 0.15]
+
+Without --save-baseline the run is compared with the stored baseline of the same
+fixture; a stage more than `tolerance` slower (pages/s) or heavier (peak RSS)
+is a regression and the exit code is 1.
+"""
+import importlib
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context
+from pathlib import Path
+
+import telemetry
+from cliOptions import pop_option
+from telemetry import peak_rss_mb
+
+BASE_DIR = Path(__file__).resolve().parent
+BENCH_DIR = BASE_DIR / ".benchmark"
+BASELINE_PATH = BASE_DIR / "benchmark_baseline.json"
+
+STAGES = ["raster", "style", "detect", "cropdraw", "gemini"]
+# stages whose outputs a stage reads
+REQUIRES = {
+    "raster": [],
+    "style": [],
+    "detect": ["raster"],
+    "cropdraw": ["raster", "detect"],
+    "gemini": ["style", "cropdraw"],
+}
+
+# text lines per page
+DENSITIES = {"low": 10, "medium": 30, "high": 60}
+FONTS = ["helv", "helv", "helv", "hebo", "heit", "tiro", "tibo", "cour"]
+SIZES = [10, 11, 12, 12, 14, 18]
+COLORS = [(0, 0, 0), (0, 0, 0), (0, 0, 0), (0.8, 0, 0), (0, 0.3, 0.8), (0.1, 0.5, 0.1)]
+WORDS = ("le la les un une des et ou avec pour dans sur sous entre lire écrire compter "
+         "exercice consigne réponse phrase mot image observe complète relie entoure colorie "
+         "souligne recopie classe range trouve chat maison école jardin soleil livre").split()
+
+
+# =========================
+# SYNTHETIC FIXTURES
+# =========================
+def make_synthetic_pdf(path, pages=20, density="medium", images_per_page=2, seed=0):
+    """A4 pages of styled text lines with `images_per_page` raster images each; deterministic for a seed."""
+    import fitz
+
+    rnd = random.Random(seed)
+    fonts = {name: fitz.Font(name) for name in set(FONTS)}
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page(width=595, height=842)
+        # one TextWriter per color: a few text objects per page instead of one per word
+        writers = {color: fitz.TextWriter(page.rect) for color in set(COLORS)}
+        y = 60
+        for _line in range(DENSITIES[density]):
+            x = 50
+            while x < 520:
+                word = rnd.choice(WORDS)
+                font, size, color = fonts[rnd.choice(FONTS)], rnd.choice(SIZES), rnd.choice(COLORS)
+                writers[color].append((x, y), word, font=font, fontsize=size)
+                x += font.text_length(word + " ", fontsize=size)
+            y += 760 / DENSITIES[density]
+        for color, writer in writers.items():
+            writer.write_text(page, color=color)
+
+        for i in range(images_per_page):
+            w, h = rnd.randint(120, 260), rnd.randint(90, 200)
+            pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, w, h), False)
+            pix.set_rect(pix.irect, tuple(rnd.randint(60, 230) for _ in range(3)))
+            for _ in range(6):
+                x0, y0 = rnd.randrange(w), rnd.randrange(h)
+                pix.set_rect(fitz.IRect(x0, y0, min(w, x0 + 40), min(h, y0 + 30)),
+                             tuple(rnd.randint(0, 255) for _ in range(3)))
+            x0 = 50 + i * 270
+            y0 = rnd.randint(80, 842 - h - 40)
+            page.insert_image(fitz.Rect(x0, y0, x0 + w, y0 + h), pixmap=pix)
+    doc.save(str(path), deflate=True)
+    doc.close()
+
+
+def fixture_key(pages, density, images, dpi) -> str:
+    return f"p{pages}-{density}-i{images}-d{dpi}"
+
+
+# =========================
+# STUB DETECTION MODEL
+# =========================
+class _StubTensor(list):
+    def tolist(self):
+        return list(self)
+
+
+class _StubBoxes:
+    def __init__(self, xyxy, cls):
+        self.xyxy = _StubTensor(xyxy)
+        self.cls = _StubTensor(cls)
+
+
+class _StubResult:
+    def __init__(self, xyxy):
+        self.boxes = _StubBoxes(xyxy, [0] * len(xyxy))
+
+
+class StubModel:
+    """Stands in for YOLO: one box per non-white blob found by thresholding (cheap, deterministic)."""
+
+    def predict(self, source, save=False, verbose=False, **_kwargs):
+        import cv2
+
+        results = []
+        for img in source:
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            mask = cv2.inRange(gray, 40, 235)
+            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15)))
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            boxes = []
+            for c in contours:
+                x, y, w, h = cv2.boundingRect(c)
+                if w * h >= 0.005 * img.shape[0] * img.shape[1]:
+                    boxes.append([float(x), float(y), float(x + w), float(y + h)])
+            results.append(_StubResult(boxes))
+        return results
+
+
+# =========================
+# FAKE GEMINI SERVER
+# =========================
+FAKE_RESPONSE = json.dumps([{
+    "id": "bench-1", "type": "exercise", "images": False, "image_type": "none",
+    "properties": {"number": "1", "instruction": "Complète.", "labels": [], "statement": "Le chat ...",
+                   "hint": None, "example": None, "references": None},
+}], ensure_ascii=False)
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    latency = 0.5
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if ":generateContent" not in self.path:
+            self.send_error(404)
+            return
+        time.sleep(self.latency)
+        payload = json.dumps({
+            "candidates": [{"content": {"role": "model", "parts": [{"text": FAKE_RESPONSE}]},
+                            "finishReason": "STOP"}],
+            "usageMetadata": {"promptTokenCount": len(body) // 4, "candidatesTokenCount": len(FAKE_RESPONSE) // 4},
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *_args):
+        pass
+
+
+def start_fake_gemini(latency: float):
+    FakeGeminiHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGeminiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# =========================
+# STAGES (each in a fresh process)
+# =========================
+def _stage_raster(work, params):
+    from config import RASTER_BACKEND, RASTER_WORKERS
+    from pdfToImages import GS, pdf_to_images_best_quality
+
+    backend = RASTER_BACKEND if (RASTER_BACKEND != "gs" or shutil.which(GS)) else "fitz"
+    pdf_to_images_best_quality(work / "fixture.pdf", work / "files", dpi=params["dpi"],
+                               workers=RASTER_WORKERS, backend=backend)
+    return len(list((work / "files").glob("page_*.png")))
+
+
+def _stage_style(work, params):
+    import fitz
+    from pdfToTxtStyle import StyleTable, export_phrase_compact_from_doc
+
+    out_dir = work / "files_style"
+    styles = StyleTable()
+    with fitz.open(str(work / "fixture.pdf")) as doc:
+        for i in range(len(doc)):
+            export_phrase_compact_from_doc(doc, str(out_dir / f"page_{i + 1}.csv"), pages=[i], styles=styles)
+        return len(doc)
+
+
+def _stage_detect(work, params):
+    import detectImages
+
+    detectImages.output_dir = work / "output"
+    images = sorted((work / "files").glob("*.png"))
+    detectImages.detect_batched(StubModel(), "detImages", images)
+    return len(images)
+
+
+def _stage_cropdraw(work, params):
+    import cropImages
+    import drawBoxes
+    import cropAndDraw
+
+    predict = work / "output" / "detImages" / "predict"
+    cropImages.files_dir = work / "files"
+    cropImages.detnum_folder = predict
+    cropImages.crop_folder = predict / "crops"
+    drawBoxes.images_path = str(work / "files")
+    drawBoxes.json_path = predict
+    drawBoxes.output_path = str(work / "files-out")
+    cropAndDraw.main()
+    return len(list(predict.glob("*.json")))
+
+
+def _stage_gemini(work, params):
+    import functools
+    from google import genai
+    from google.genai import types
+
+    gemini = importlib.import_module("extraction-gemini-vision")
+    gemini.image_dir = str(work / "files-out")
+    gemini.text_dir = str(work / "files_style")
+    gemini.output_dir = str(work / "extractionOut")
+    gemini.prompt_file = str(work / "prompt.txt")
+    gemini.MAX_RPM = gemini.MAX_RPD = 10 ** 9
+    gemini.GEMINI_LEDGER_ENABLED = False
+    gemini.GEMINI_CACHE_ENABLED = False
+    gemini.GEMINI_REQUEST_LOG = None
+    gemini.POST_SUCCESS_PAUSE = 0
+    os.makedirs(gemini.output_dir, exist_ok=True)
+    (work / "prompt.txt").write_text("Extract the exercises of this page as a JSON array.", encoding="utf-8")
+
+    client = genai.Client(api_key="benchmark", http_options=types.HttpOptions(base_url=params["gemini_url"]))
+    gemini.run_preparers(client, [functools.partial(gemini.prepare_request, p) for p in gemini.list_images()])
+    return len(list((work / "extractionOut").glob("*.json")))
+
+
+STAGE_FUNCS = {
+    "raster": _stage_raster,
+    "style": _stage_style,
+    "detect": _stage_detect,
+    "cropdraw": _stage_cropdraw,
+    "gemini": _stage_gemini,
+}
+
+
+def _run_stage(name, work, params):
+    """Child process: (seconds, pages, peak RSS MB)."""
+    sys.path.insert(0, str(BASE_DIR))
+    # stage modules create their hard-coded folders relative to the cwd on import
+    os.chdir(work)
+    work = Path(work)
+    t0 = time.perf_counter()
+    pages = STAGE_FUNCS[name](work, params)
+    return time.perf_counter() - t0, pages, peak_rss_mb()
+
+
+def with_prerequisites(stages):
+    """Every stage to run, in pipeline order: the requested ones and what they read from."""
+    needed = set()
+
+    def add(name):
+        if name not in needed:
+            needed.add(name)
+            for dep in REQUIRES[name]:
+                add(dep)
+
+    for name in stages:
+        add(name)
+    return [name for name in STAGES if name in needed]
+
+
+def run_benchmark(pages=20, density="medium", images=2, dpi=450, stages=STAGES, api_latency=0.5):
+    key = fixture_key(pages, density, images, dpi)
+    work = BENCH_DIR / key
+    shutil.rmtree(work, ignore_errors=True)
+    work.mkdir(parents=True)
+
+    t0 = time.perf_counter()
+    make_synthetic_pdf(work / "fixture.pdf", pages, density, images)
+    print(f"[OK] Fixture {key}: {(work / 'fixture.pdf').stat().st_size / 1024:.0f} KB "
+          f"in {time.perf_counter() - t0:.2f}s")
+
+    server, url = start_fake_gemini(api_latency)
+    params = {"dpi": dpi, "gemini_url": url}
+    results = {}
+    try:
+        for name in with_prerequisites(stages):
+            timed = name in stages
+            print(f"\n[RUN] {name}{'' if timed else ' (prerequisite, untimed)'}...")
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                seconds, n, rss = pool.submit(_run_stage, name, str(work), params).result()
+            if not timed:
+                continue
+            results[name] = {"seconds": round(seconds, 3), "pages": n,
+                             "pages_per_s": round(n / seconds, 3) if seconds else None,
+                             "peak_rss_mb": round(rss, 1) if rss is not None else None}
+    finally:
+        server.shutdown()
+    return key, results
+
+
+# =========================
+# BASELINE
+# =========================
+def compare(results, baseline, tolerance):
+    """[(stage, message)] for every stage slower or heavier than the baseline by more than `tolerance`."""
+    regressions = []
+    for name, cur in results.items():
+        ref = baseline.get(name)
+        if not ref:
+            continue
+        if ref.get("pages_per_s") and cur.get("pages_per_s") is not None \
+                and cur["pages_per_s"] < ref["pages_per_s"] * (1 - tolerance):
+            regressions.append((name, f"{cur['pages_per_s']} pages/s vs {ref['pages_per_s']}"))
+        if ref.get("peak_rss_mb") and cur.get("peak_rss_mb") is not None \
+                and cur["peak_rss_mb"] > ref["peak_rss_mb"] * (1 + tolerance):
+            regressions.append((name, f"peak RSS {cur['peak_rss_mb']} MB vs {ref['peak_rss_mb']}"))
+    return regressions
+
+
+def print_report(key, results, baseline=None):
+    print(f"\n[BENCH] {key}")
+    print(f"  {'stage':9s} {'seconds':>9s} {'pages':>6s} {'pages/s':>9s} {'RSS MB':>8s}   baseline pages/s")
+    for name, r in results.items():
+        ref = (baseline or {}).get(name, {})
+        print(f"  {name:9s} {r['seconds']:9.3f} {r['pages']:6d} {r['pages_per_s'] or 0:9.2f} "
+              f"{r['peak_rss_mb'] or 0:8.1f}   {ref.get('pages_per_s', '-')}")
+
+
+def main():
+    argv = list(sys.argv)
+    pages = int(pop_option(argv, "--pages", 20))
+    density = pop_option(argv, "--density", "medium")
+    images = int(pop_option(argv, "--images", 2))
+    dpi = int(pop_option(argv, "--dpi", 450))
+    stages = pop_option(argv, "--stages", ",".join(STAGES)).split(",")
+    api_latency = float(pop_option(argv, "--api-latency", 0.5))
+    save_baseline = pop_option(argv, "--save-baseline", "false").lower() == "true"
+    baseline_path = Path(pop_option(argv, "--baseline", BASELINE_PATH))
+    tolerance = float(pop_option(argv, "--tolerance", 0.15))
+
+    unknown = [s for s in stages if s not in STAGE_FUNCS]
+    if density not in DENSITIES or unknown:
+        print(f"Usage: python benchmark.py [--density {'|'.join(DENSITIES)}] [--stages {','.join(STAGES)}] ...")
+        sys.exit(1)
+
+    telemetry.run_id()   # stage children share the run's trace directory
+    key, results = run_benchmark(pages, density, images, dpi, stages, api_latency)
+    telemetry.finish_run()
+
+    all_baselines = json.loads(baseline_path.read_text(encoding="utf-8")) if baseline_path.exists() else {}
+    baseline = all_baselines.get(key)
+    print_report(key, results, baseline)
+
+    if save_baseline:
+        all_baselines[key] = {**(baseline or {}), **results}
+        baseline_path.write_text(json.dumps(all_baselines, indent=2, sort_keys=True), encoding="utf-8")
+        print(f"[OK] Baseline saved: {baseline_path} ({key})")
+        return
+
+    if baseline is None:
+        print(f"[WARN] No baseline for {key} (run with --save-baseline true)")
+        return
+    regressions = compare(results, baseline, tolerance)
+    for name, message in regressions:
+        print(f"[ERR] Regression in {name}: {message}")
+    if regressions:
+        sys.exit(1)
+    print(f"[OK] No regression beyond {tolerance:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+"""
+Options `--nom VALEUR` des scripts d'étape, partagées sans dépendre d'un autre
+script (pdfToImages, pdfToTxtStyle, batch, benchmark).
+"""
+import sys
+
+
+def pop_option(argv, name, default=None):
+    """Retire `name VALUE` de argv (arguments positionnels inchangés)."""
+    if name not in argv:
+        return default
+    i = argv.index(name)
+    if i + 1 >= len(argv):
+        print(f"Error: {name} needs a value")
+        sys.exit(1)
+    value = argv[i + 1]
+    del argv[i:i + 2]
+    return value
@@ -1,2 +1,76 @@
 # config.py
+import os
+
 STYLE_MODE = False  # or True
+STYLE_WORKERS = 1   # processus pour pdfToTxtStyle.py (--workers)
+STYLE_OUTPUT = "csv"  # "csv" (files_style/page_N.csv), "parquet" (styleStore.py, files_style/style_store/) ou "both"
+RASTER_WORKERS = 1  # processus Ghostscript pour pdfToImages.py (--workers)
+RASTER_BACKEND = "gs"  # "gs" (Ghostscript) ou "fitz" (PyMuPDF, sans sous-processus)
+CROP_DRAW_WORKERS = 4  # threads de cropAndDraw.py (découpe + annotation, une lecture par page)
+POSTPROCESS_WORKERS = 4  # processus de postprocessing.py (réparation JSON)
+
+# Mode basse mémoire (memoryBudget.py) pour les très gros PDF : pdfToTxtStyle / pdfToImages
+# vident les caches MuPDF et rouvrent le document tous les DOC_REOPEN_EVERY pages ou dès
+# que le RSS d'un processus dépasse MEMORY_BUDGET_MB ; Ghostscript rend par bandes.
+LOW_MEMORY = False
+MEMORY_BUDGET_MB = 1024
+DOC_REOPEN_EVERY = 50
+
+# Orchestration de main.py : "subprocess" (un interpréteur par script),
+# "inprocess" (pipeline.py : un seul processus, modèles partagés, pages en mémoire) ou
+# "streaming" (inprocess page par page : chaque page passe à l'étape suivante dès qu'elle est prête)
+PIPELINE_MODE = "subprocess"
+PIPELINE_MATERIALIZE = True  # inprocess/streaming : écrire aussi files/, files_style/, output/, files-out/
+PIPELINE_QUEUE_SIZE = 4      # streaming : pages en attente au plus entre deux étapes
+
+# Mode lot (batch.py) : tous les PDF d'un dossier, un sous-dossier de sortie par document
+BATCH_OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "batch_out")
+BATCH_WORKERS = 4       # processus qui préparent les pages (rendu, détection, découpe, CSV)
+BATCH_QUEUE_SIZE = 16   # pages préparées en attente de Gemini au plus
+BATCH_RUN_PAGES = 8     # pages consécutives d'un même document par tâche (PDF ouvert une fois par tranche)
+
+# Télémétrie (telemetry.py) : durées par étape / page, pic de RSS, octets lus/écrits,
+# latence Gemini, relances, attente du limiteur ; un dossier par run dans TRACE_DIR
+TRACE_ENABLED = False   # à activer pour mesurer un run (aucun fichier écrit sinon)
+TRACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".traces")
+TRACE_KEEP_RUNS = 20    # seuls les N runs les plus récents sont gardés dans TRACE_DIR
+TRACE_FORMATS = ("jsonl", "chrome")   # events.jsonl et/ou trace.json (chrome://tracing, ui.perfetto.dev)
+TRACE_EXPORTERS = []                  # "module:fonction" appelée avec chaque événement (dict)
+
+# Profil image par étape (voir imageProfiles.PROFILES)
+IMAGE_PROFILES = {
+    "pages": "archive",       # files/ avec RASTER_BACKEND = "fitz" (format PNG obligatoire)
+    "detect": "archive",      # entrée YOLO : page entière ; "detect" (réduite à 1600 px en mémoire, plus
+                              # rapide) est en option : les boîtes peuvent bouger, à valider sur ses documents
+    "crops": "archive",       # output/detImages/predict/crops
+    "annotated": "archive",   # files-out/
+    "llm": "archive",         # image envoyée à Gemini : PNG sans perte ; "llm" / "llm-webp" / "llm-cropped"
+                              # (réduits, avec perte) sont plus légers mais peuvent changer l'extraction
+}
+
+# Texte envoyé à Gemini avec l'image : "csv" (CSV de pdfToTxtStyle tel quel) ou
+# "compact" (légende des styles numérotés + lignes qui y renvoient, moins de tokens)
+CSV_PAYLOAD = "csv"
+
+# Journal des requêtes Gemini (octets image, tokens, latence) en JSON lines ; None = désactivé
+GEMINI_REQUEST_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gemini_requests.jsonl")
+
+# Service de détection persistant (python detectService.py) : modèles YOLO gardés en mémoire
+DETECT_SERVICE = False
+DETECT_SERVICE_ADDRESS = ("127.0.0.1", 6001)
+DETECT_SERVICE_MAX_MODELS = 2   # modèles résidents (LRU)
+# Secret partagé client/service (fichier 0600 créé au premier démarrage) ; la variable
+# d'environnement DETECT_SERVICE_KEY, si définie, le remplace
+DETECT_SERVICE_KEY_PATH = os.path.join(os.path.expanduser("~"), ".extractionPipeline", "detect_service.key")
+
+# Cache des réponses Gemini (hors des dossiers vidés par main.reset_directories)
+GEMINI_CACHE_ENABLED = True
+GEMINI_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".gemini_cache")
+GEMINI_CACHE_MAX_MB = 200
+GEMINI_BATCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".gemini_batch")  # état des jobs batch (reprise)
+
+# Quotas Gemini (Google AI Studio) partagés par tous les processus via le ledger SQLite
+GEMINI_MAX_RPM = 10          # requests per minute
+GEMINI_MAX_RPD = 250         # requests per day
+GEMINI_LEDGER_ENABLED = True
+GEMINI_LEDGER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".gemini_ledger.sqlite")
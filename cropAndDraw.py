@@ -0,0 +1,98 @@
+"""
+Fused cropImages + drawBoxes: each page PNG is decoded once, its crops are
+written from the clean page, then the boxes and labels are drawn in place.
+Pages run in a thread pool (cv2 releases the GIL while decoding/encoding).
+
+Outputs, and both stages' manifests, are the same files as running
+cropImages.py then drawBoxes.py.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+
+import cropImages
+import drawBoxes
+from config import CROP_DRAW_WORKERS
+from imageProfiles import get_profile, write_image
+from manifest import Manifest, inputs_digest
+import telemetry
+
+
+def process_page(json_file, crop_profile, annotated_profile, crop_manifest, draw_manifest):
+    """Returns (crops rebuilt, annotated page rebuilt)."""
+    image_path = cropImages.files_dir / f"{json_file.stem}.png"
+    if not image_path.exists():
+        print(f"[ERR] Image not found for {json_file.name}")
+        return False, False
+
+    page = json_file.stem
+    crop_digest = inputs_digest(json_file, image_path, sorted(crop_profile.items()))
+    draw_digest = inputs_digest(json_file, image_path, sorted(annotated_profile.items()))
+    redo_crops = not crop_manifest.is_fresh(page, crop_digest)
+    redo_draw = not draw_manifest.is_fresh(page, draw_digest)
+    if not (redo_crops or redo_draw):
+        return False, False
+
+    with telemetry.span("cropdraw.page", page=page) as span:
+        with open(json_file, "r", encoding="utf-8") as jf:
+            shapes = json.load(jf).get("shapes", [])
+
+        img = cv2.imread(str(image_path))
+        if img is None:
+            print(f"[WARN] Could not load {image_path}")
+            return False, False
+        span["bytes_read"] = image_path.stat().st_size + json_file.stat().st_size
+        written = []
+
+        if redo_crops:
+            crop_manifest.invalidate(page)
+            # same page number rule as cropImages.py
+            crops = cropImages.crop_page(img, shapes, page.split("_")[-1], cropImages.crop_folder, crop_profile)
+            crop_manifest.record(page, crop_digest, crops)
+            written += crops
+
+        if redo_draw:
+            draw_manifest.invalidate(page)
+            # same page number rule as drawBoxes.py; crops are written, drawing in place is safe
+            page_num = ''.join(c for c in image_path.name if c.isdigit()) or "0"
+            img = drawBoxes.annotate_page(img, shapes, page_num)
+            out_file = write_image(img, os.path.join(drawBoxes.output_path, image_path.name), annotated_profile)
+            print(f"[OK] Saved {out_file}")
+            draw_manifest.record(page, draw_digest, [out_file])
+            written.append(out_file)
+
+        span["bytes_written"] = sum(Path(p).stat().st_size for p in written)
+
+    return redo_crops, redo_draw
+
+
+def main(workers=CROP_DRAW_WORKERS):
+    cropImages.crop_folder.mkdir(exist_ok=True, parents=True)
+    os.makedirs(drawBoxes.output_path, exist_ok=True)
+
+    crop_profile = get_profile("crops")
+    annotated_profile = get_profile("annotated")
+
+    json_files = sorted(Path(drawBoxes.json_path).glob("*.json"))
+
+    crop_manifest = Manifest(cropImages.crop_folder, "crops")
+    draw_manifest = Manifest(drawBoxes.output_path, "annotated")
+    for m in (crop_manifest, draw_manifest):
+        m.prune(json_file.stem for json_file in json_files)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(pool.map(
+            lambda jf: process_page(jf, crop_profile, annotated_profile, crop_manifest, draw_manifest),
+            json_files))
+
+    crop_manifest.save()
+    draw_manifest.save()
+    crop_manifest.report(len(json_files), sum(c for c, _d in results))
+    draw_manifest.report(len(json_files), sum(d for _c, d in results))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,102 @@
 from pathlib import Path
 import cv2
 import json
+from imageProfiles import get_profile, write_image
+from manifest import Manifest, inputs_digest
 
 # Paths
 files_dir = Path(r"C:\Users\lasheb\PycharmProjects\extractionPipeline-TS\files")  # Original images
 detnum_folder = Path("output/detImages/predict")  # JSON folder
 crop_folder = detnum_folder / "crops"
-crop_folder.mkdir(exist_ok=True, parents=True)
 
-# Get all JSON files
-json_files = list(detnum_folder.glob("*.json"))
 
-for json_file in json_files:
-    # Always map JSON -> .png from original files
-    image_name_png = json_file.stem + ".png"
-    image_path = files_dir / image_name_png
+def crop_page(img, shapes, page_num, crop_folder, crop_profile):
+    """Writes p{page_num}c{id} crops of one decoded page; returns the written paths."""
+    written = []
+    h, w = img.shape[:2]
+    for shape in shapes:
+        (x_min, y_min), (x_max, y_max) = shape["points"]
 
-    if not image_path.exists():
-        print(f"[ERR] Image not found for {json_file.name}")
-        continue
+        # Clamp to image bounds
+        x_min = max(int(x_min), 0)
+        y_min = max(int(y_min), 0)
+        x_max = min(int(x_max), w - 1)
+        y_max = min(int(y_max), h - 1)
 
-    # Load original image
-    img = cv2.imread(str(image_path))
-    h, w = img.shape[:2]
+        roi = img[y_min:y_max, x_min:x_max]
+
+        # Use JSON shape id
+        shape_id = shape["id"]
+
+        # Naming: p{page_num}c{id}.png
+        crop_name = f"p{page_num}c{shape_id}.png"
+        crop_path = write_image(roi, Path(crop_folder) / crop_name, crop_profile)
+        print(f"[OK] Saved crop: {crop_path.name}")
+        written.append(crop_path)
+    return written
+
+
+# =========================
+# IN-PROCESS PIPELINE STAGE (pipeline.py)
+# =========================
+STAGE_INPUTS = ("page_image", "shapes")
+STAGE_OUTPUTS = ("crops",)
+
+
+def stage(ctx):
+    """Crops from the in-memory pages; crops are a deliverable and are always written."""
+    folder = ctx.dir(crop_folder)
+    crop_profile = get_profile("crops")
+    for page_num in ctx.pages_with("page_image", "shapes"):
+        paths = crop_page(ctx.get(page_num, "page_image").load(), ctx.get(page_num, "shapes"),
+                          page_num, folder, crop_profile)
+        ctx.put(page_num, "crops", paths)
+
+
+def main():
+    crop_folder.mkdir(exist_ok=True, parents=True)
+    crop_profile = get_profile("crops")
+
+    # Get all JSON files
+    json_files = list(detnum_folder.glob("*.json"))
+
+    # Incremental rebuild: a page is re-cropped when its boxes or its image changed
+    manifest = Manifest(crop_folder, "crops")
+    manifest.prune(json_file.stem for json_file in json_files)
+    stale = 0
+
+    for json_file in json_files:
+        # Always map JSON -> .png from original files
+        image_name_png = json_file.stem + ".png"
+        image_path = files_dir / image_name_png
+
+        if not image_path.exists():
+            print(f"[ERR] Image not found for {json_file.name}")
+            continue
+
+        digest = inputs_digest(json_file, image_path, sorted(crop_profile.items()))
+        if manifest.is_fresh(json_file.stem, digest):
+            continue
+        stale += 1
+        # crops of a previous run (the page may have fewer boxes now)
+        manifest.invalidate(json_file.stem)
 
-    # Extract page number
-    stem = json_file.stem
-    page_num = stem.split("_")[-1]
+        # Load original image
+        img = cv2.imread(str(image_path))
 
-    # Read JSON
-    with open(json_file, "r", encoding="utf-8") as jf:
-        data = json.load(jf)
-        for shape in data["shapes"]:
-            (x_min, y_min), (x_max, y_max) = shape["points"]
+        # Extract page number
+        stem = json_file.stem
+        page_num = stem.split("_")[-1]
 
-            # Clamp to image bounds
-            x_min = max(int(x_min), 0)
-            y_min = max(int(y_min), 0)
-            x_max = min(int(x_max), w - 1)
-            y_max = min(int(y_max), h - 1)
+        # Read JSON
+        with open(json_file, "r", encoding="utf-8") as jf:
+            data = json.load(jf)
+        written = crop_page(img, data["shapes"], page_num, crop_folder, crop_profile)
+        manifest.record(json_file.stem, digest, written)
 
-            roi = img[y_min:y_max, x_min:x_max]
+    manifest.save()
+    manifest.report(len(json_files), stale)
 
-            # Use JSON shape id
-            shape_id = shape["id"]
 
-            # Naming: p{page_num}c{id}.png
-            crop_name = f"p{page_num}c{shape_id}.png"
-            cv2.imwrite(str(crop_folder / crop_name), roi)
-            print(f"[OK] Saved crop: {crop_name}")
+if __name__ == "__main__":
+    main()
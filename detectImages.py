@@ -1,9 +1,13 @@
-from ultralytics import YOLO
 from pathlib import Path
 import cv2
 import json
 import shutil
 
+from imageProfiles import get_profile, resize_for_profile
+from config import DETECT_SERVICE
+from manifest import Manifest, inputs_digest
+import telemetry
+
 # Delete "files" directory if it exists (optional)
 files_dir = Path(r"C:\Users\lasheb\PycharmProjects\extractionPipeline-TS\files")
 
@@ -14,24 +18,156 @@ classes_dict = {
 
 # Directories
 output_dir = Path("output")
-output_dir.mkdir(exist_ok=True)
-
-# Get all PNG files from "files"
-images = list(files_dir.glob("*.png"))
 
 # Model paths
 model_paths = {
     "detImages": r"C:\Users\lasheb\PycharmProjects\MALIN-extraction-with-images\models\detImages.pt",
 }
 
-run_folders = []
+# Batched in-memory inference (0 = legacy: one predict per file with save=True)
+BATCH_SIZE = 8
+# Opt-in side outputs of the batched mode (annotated .jpg / YOLO .txt labels)
+SAVE_ANNOTATED = False
+SAVE_TXT = False
+# Model whose boxes feed cropImages/drawBoxes (output/detImages/predict)
+PIPELINE_MODEL = "detImages"
+
+
+def shape_label(model_name, cls):
+    return classes_dict.get(model_name, [str(cls)])[cls]
+
+
+def save_labelme_json(json_path, shapes, h, w):
+    json_dict = {
+        "shapes": shapes,
+        "imageHeight": h,
+        "imageWidth": w
+    }
+    with open(json_path, "w", encoding="utf-8") as jf:
+        json.dump(json_dict, jf, ensure_ascii=False, indent=2)
+    print(f"  [OK] Saved JSON: {json_path}")
+
+
+def shapes_from_result(result, model_name, scale=1.0):
+    """
+    LabelMe shapes straight from Results.boxes (xyxy in the predicted image).
+    `scale` is predicted size / original size; points are mapped back to the original page.
+    """
+    shapes = []
+    xyxy = result.boxes.xyxy.tolist()
+    classes = result.boxes.cls.tolist()
+    for idx, ((x_min, y_min, x_max, y_max), cls) in enumerate(zip(xyxy, classes)):  # idx = id for each shape
+        cls = int(cls)
+
+        # For detNum, keep only class 2
+        if model_name == "detNum" and cls != 2:
+            continue
+
+        shapes.append({
+            "id": idx,  # starts at 0 and increments for each box
+            "label": shape_label(model_name, cls),
+            "points": [
+                [x_min / scale, y_min / scale],
+                [x_max / scale, y_max / scale]
+            ]
+        })
+    return shapes
+
+
+def load_for_detection(image_path):
+    """One decode per page, downscaled with the "detect" profile when configured."""
+    with telemetry.span("detect.load", page=Path(image_path).stem) as s:
+        img = cv2.imread(str(image_path))
+        if img is None:
+            return None
+        s["bytes_read"] = Path(image_path).stat().st_size
+        h, w = img.shape[:2]
+        img, scale = resize_for_profile(img, get_profile("detect"))
+    return img, scale, h, w
+
+
+def predict_batches(model, model_name, loaded, batch_size=BATCH_SIZE):
+    """
+    `loaded` yields (key, img, scale, h, w) with img already resized for detection.
+    Feeds the model `batch_size` pages at a time and yields (key, result, shapes, h, w),
+    shapes in original page coordinates.
+    """
+    batch = []
+    for item in loaded:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield from _predict_batch(model, model_name, batch)
+            batch = []
+    if batch:
+        yield from _predict_batch(model, model_name, batch)
+
+
+def _predict_batch(model, model_name, batch):
+    print(f"Processing {', '.join(str(getattr(key, 'name', key)) for key, *_ in batch)} with {model_name}...")
+    with telemetry.span("detect.batch", model=model_name, pages=len(batch)):
+        results = model.predict(source=[img for _key, img, *_ in batch], save=False, verbose=False)
+    for (key, _img, scale, h, w), result in zip(batch, results):
+        yield key, result, shapes_from_result(result, model_name, scale), h, w
+
+
+def iter_detections(model, model_name, images, batch_size=BATCH_SIZE):
+    """
+    Feeds page files to the model `batch_size` at a time (decoded batch by batch).
+    Yields (image_path, result, shapes, h, w) with shapes already in original page coordinates.
+    """
+    def loaded():
+        for image_path in images:
+            image_path = Path(image_path)
+            page = load_for_detection(image_path)
+            if page is None:
+                print(f"[WARN] Could not read image: {image_path}")
+                continue
+            yield (image_path, *page)
+
+    yield from predict_batches(model, model_name, loaded(), batch_size)
+
+
+def detect_batched(model, model_name, images, batch_size=BATCH_SIZE,
+                   save_annotated=SAVE_ANNOTATED, save_txt=SAVE_TXT):
+    """Writes output/<model>/predict/page_N.json from the in-memory results."""
+    predict_dir = output_dir / model_name / "predict"
+    predict_dir.mkdir(exist_ok=True, parents=True)
+    if save_txt:
+        (predict_dir / "labels").mkdir(exist_ok=True)
+
+    for image_path, result, shapes, h, w in iter_detections(model, model_name, images, batch_size):
+        # Same as the legacy mode: YOLO writes no label file (hence no JSON)
+        # for a page without detections.
+        if not shapes:
+            print(f"  No detections: {image_path.name}")
+            continue
+        save_labelme_json(predict_dir / f"{image_path.stem}.json", shapes, h, w)
+        if save_annotated:
+            result.save(filename=str(predict_dir / f"{image_path.stem}.jpg"))
+        if save_txt:
+            result.save_txt(str(predict_dir / "labels" / f"{image_path.stem}.txt"))
+
+
+def detect_via_service(model_name, images):
+    """Asks the running detectService for the shapes and writes the same JSON files."""
+    from detectService import request_detection
 
-# Step 1: Detection
-for model_name, model_path in model_paths.items():
-    print(f"\n=== Loading model {model_name} ===")
-    model = YOLO(str(model_path))
+    predict_dir = output_dir / model_name / "predict"
+    predict_dir.mkdir(exist_ok=True, parents=True)
 
-    # Output directory for this model
+    results = request_detection(model_name, [str(p) for p in images])
+    for image_path in images:
+        page = results.get(str(image_path))
+        # an empty page comes back with shapes == []: no JSON, like the other modes
+        if not page or not page["shapes"]:
+            print(f"  No detections: {image_path.name}")
+            continue
+        save_labelme_json(predict_dir / f"{image_path.stem}.json",
+                          page["shapes"], page["imageHeight"], page["imageWidth"])
+
+
+def detect_per_file(model, model_name, images):
+    """Legacy mode: one predict per file, annotated .jpg + .txt labels saved by YOLO."""
     model_output_dir = output_dir / model_name
     model_output_dir.mkdir(exist_ok=True, parents=True)
 
@@ -46,17 +182,15 @@ for model_name, model_path in model_paths.items():
             exist_ok=True
         )
 
-    run_folders.append((model_name, model_output_dir))
-    print(f"==> {model_name} finished\n")
 
-# Step 2: Transform TXT -> JSON (LabelMe format)
-for model_name, run_folder in run_folders:
+def labels_to_json(model_name, run_folder):
+    """Legacy mode: transform TXT -> JSON (LabelMe format)."""
     labels_dir = run_folder / "predict" / "labels"
     images_dir = run_folder / "predict"
 
     if not labels_dir.exists():
         print(f"No labels found for {model_name}")
-        continue
+        return
 
     print(f"Transforming labels to JSON for {model_name}")
 
@@ -99,7 +233,7 @@ for model_name, run_folder in run_folders:
 
                 shape = {
                     "id": idx,  # starts at 0 and increments for each line
-                    "label": classes_dict.get(model_name, [str(cls)])[cls],
+                    "label": shape_label(model_name, cls),
                     "points": [
                         [x_min, y_min],
                         [x_max, y_max]
@@ -107,14 +241,140 @@ for model_name, run_folder in run_folders:
                 }
                 shapes.append(shape)
 
-        json_dict = {
-            "shapes": shapes,
-            "imageHeight": h,
-            "imageWidth": w
-        }
+        save_labelme_json(images_dir / f"{txt_file.stem}.json", shapes, h, w)
+
+
+# =========================
+# IN-PROCESS PIPELINE STAGE (pipeline.py)
+# =========================
+STAGE_INPUTS = ("page_image",)
+STAGE_OUTPUTS = ("shapes",)
+
+
+def detect_arrays(models, pages, predict_root=None):
+    """
+    Runs every model of model_paths on one batch of in-memory pages [(page_num, img)].
+    Returns {page_num: shapes} for PIPELINE_MODEL (pages without detections are left out);
+    writes <predict_root>/<model>/predict/page_N.json when predict_root is given.
+    """
+    profile = get_profile("detect")
+    loaded = []
+    for page_num, img in pages:
+        h, w = img.shape[:2]
+        small, scale = resize_for_profile(img, profile)
+        loaded.append((page_num, small, scale, h, w))
+    if not loaded:
+        return {}
+
+    found = {}
+    for model_name in model_paths:
+        predict_dir = None
+        if predict_root is not None:
+            predict_dir = Path(predict_root) / model_name / "predict"
+            predict_dir.mkdir(exist_ok=True, parents=True)
+        for page_num, _result, shapes, h, w in predict_batches(models.get(model_name), model_name,
+                                                                loaded, len(loaded)):
+            if not shapes:
+                print(f"  No detections: page_{page_num}")
+                continue
+            if predict_dir is not None:
+                save_labelme_json(predict_dir / f"page_{page_num}.json", shapes, h, w)
+            if model_name == PIPELINE_MODEL:
+                found[page_num] = shapes
+    return found
+
+
+def stage(ctx):
+    """
+    Detects on the in-memory pages with models kept in ctx.resources (loaded once per run).
+    Pages without detections get no "shapes", like the missing JSON of the file mode.
+    """
+    from detectService import ModelCache
+
+    models = ctx.resources.setdefault("detect_models", ModelCache())
+    predict_root = ctx.dir(output_dir) if ctx.materialize else None
+    pages = ctx.pages_with("page_image")
+    batch_size = BATCH_SIZE or 1
+    for start in range(0, len(pages), batch_size):
+        batch = [(n, ctx.get(n, "page_image").load()) for n in pages[start:start + batch_size]]
+        for page_num, shapes in detect_arrays(models, batch, predict_root).items():
+            ctx.put(page_num, "shapes", shapes)
+
+
+def page_outputs(model_name, image_path):
+    """Files written for one page: LabelMe JSON (+ legacy YOLO label and annotated image)."""
+    predict_dir = output_dir / model_name / "predict"
+    candidates = [predict_dir / f"{image_path.stem}.json",
+                  predict_dir / "labels" / f"{image_path.stem}.txt",
+                  predict_dir / image_path.name,
+                  predict_dir / f"{image_path.stem}.jpg"]
+    return [p for p in candidates if p.exists()]
+
+
+def stale_pages(manifest, images):
+    """{model_name: ([stale image paths], {image_path: digest})}; stale outputs are deleted."""
+    manifest.prune(f"{model_name}/{p.stem}" for model_name in model_paths for p in images)
+    detect_profile = sorted(get_profile("detect").items())
+    todo = {}
+    for model_name, model_path in model_paths.items():
+        digests = {p: inputs_digest(p, Path(model_path), detect_profile, BATCH_SIZE > 0) for p in images}
+        stale = [p for p in images if not manifest.is_fresh(f"{model_name}/{p.stem}", digests[p])]
+        for p in stale:
+            # YOLO appends to existing label files: start the page from scratch
+            manifest.invalidate(f"{model_name}/{p.stem}")
+            for old in page_outputs(model_name, p):
+                old.unlink()
+        manifest.report(len(images), len(stale))
+        todo[model_name] = (stale, digests)
+    return todo
+
+
+def main():
+    output_dir.mkdir(exist_ok=True)
+
+    # Get all PNG files from "files"
+    images = sorted(files_dir.glob("*.png"))
+
+    # Incremental rebuild: only pages whose PNG, model weights or settings changed
+    manifest = Manifest(output_dir, "detect")
+    todo = stale_pages(manifest, images)
+
+    def record(model_name):
+        stale, digests = todo[model_name]
+        for p in stale:
+            manifest.record(f"{model_name}/{p.stem}", digests[p], page_outputs(model_name, p))
+        manifest.save()
+
+    if DETECT_SERVICE:
+        from detectService import service_available
+        if service_available():
+            for model_name in model_paths:
+                print(f"\n=== {model_name} via detection service ===")
+                if todo[model_name][0]:
+                    detect_via_service(model_name, todo[model_name][0])
+                record(model_name)
+            return
+        print("[WARN] Detection service not reachable, loading models locally")
+
+    for model_name, model_path in model_paths.items():
+        stale = todo[model_name][0]
+        if not stale:
+            print(f"==> {model_name} up to date\n")
+            continue
+
+        print(f"\n=== Loading model {model_name} ===")
+        from ultralytics import YOLO   # only when a model is loaded here (not via the service, benchmark stub)
+        model = YOLO(str(model_path))
+
+        if BATCH_SIZE > 0:
+            detect_batched(model, model_name, stale)
+        else:
+            detect_per_file(model, model_name, stale)
+            labels_to_json(model_name, output_dir / model_name)
+
+        record(model_name)
+        print(f"==> {model_name} finished\n")
 
-        json_path = images_dir / f"{txt_file.stem}.json"
-        with open(json_path, "w", encoding="utf-8") as jf:
-            json.dump(json_dict, jf, ensure_ascii=False, indent=2)
 
-        print(f"  [OK] Saved JSON: {json_path}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Persistent detection worker: loads the YOLO models of detectImages.model_paths
+once and answers detection requests over a local socket.
+
+    python detectService.py            # start the service (Ctrl+C or "shutdown" to stop)
+    python detectService.py stats      # loaded models / request counters
+    python detectService.py shutdown
+
+detectImages.py uses it when config.DETECT_SERVICE is True and falls back to
+loading the models itself when the service is not running.
+
+multiprocessing.connection unpickles what it receives, so both sides
+authenticate with a per-user secret: $DETECT_SERVICE_KEY, or the 0600 file
+DETECT_SERVICE_KEY_PATH that the service creates on its first start.
+
+Each connection is handled in its own thread (handshake included), and a
+client gets CONNECTION_TIMEOUT seconds to send its request: a stalled client
+never blocks the other stages. Inference itself runs one request at a time.
+A model whose weights file changed on disk is reloaded on its next request.
+"""
+import os
+import secrets
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge
+from pathlib import Path
+
+import numpy as np
+
+from config import DETECT_SERVICE_ADDRESS, DETECT_SERVICE_KEY_PATH, DETECT_SERVICE_MAX_MODELS
+
+KEY_ENV = "DETECT_SERVICE_KEY"
+CONNECTION_TIMEOUT = 30.0   # seconds for a connected client to send its request
+
+
+def authkey(create=False) -> bytes:
+    """The shared secret; create=True (service) writes a random one if there is none yet."""
+    if os.environ.get(KEY_ENV):
+        return os.environ[KEY_ENV].encode()
+    path = Path(DETECT_SERVICE_KEY_PATH)
+    if create and not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass   # created meanwhile by another service
+        else:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+    return path.read_text().strip().encode()
+
+
+# =========================
+# SERVER
+# =========================
+class ModelCache:
+    """
+    LRU of loaded YOLO models; the least recently used one is dropped first.
+    Entries are keyed on the weights file's mtime: a replaced file is reloaded.
+    """
+
+    def __init__(self, max_models=DETECT_SERVICE_MAX_MODELS):
+        self.max_models = max_models
+        self.models = OrderedDict()   # model name -> (model, weights mtime)
+        self.lock = threading.Lock()  # the service runs one inference at a time
+
+    def get(self, model_name):
+        from ultralytics import YOLO
+        from detectImages import model_paths
+
+        if model_name not in model_paths:
+            raise KeyError(f"Unknown model: {model_name}")
+        path = Path(model_paths[model_name])
+        mtime = path.stat().st_mtime_ns if path.exists() else None
+
+        if model_name in self.models:
+            model, loaded_mtime = self.models[model_name]
+            if loaded_mtime == mtime:
+                self.models.move_to_end(model_name)
+                return model
+            print(f"[OK] {model_name}: weights changed on disk, reloading", flush=True)
+            del self.models[model_name]
+
+        print(f"=== Loading model {model_name} ===", flush=True)
+        t0 = time.perf_counter()
+        model = YOLO(str(model_paths[model_name]))
+        # first inference builds/fuses the network: pay it now, not on the first request
+        model.predict(source=np.zeros((640, 640, 3), dtype=np.uint8), verbose=False)
+        print(f"[OK] {model_name} ready in {time.perf_counter() - t0:.1f}s", flush=True)
+
+        self.models[model_name] = (model, mtime)
+        while len(self.models) > self.max_models:
+            evicted, _ = self.models.popitem(last=False)
+            print(f"[OK] Evicted model {evicted}", flush=True)
+        return model
+
+
+def handle_request(cache, stats, request):
+    op = request.get("op")
+    if op == "ping":
+        return {"ok": True}
+    if op == "stats":
+        return {"ok": True, "models": list(cache.models), **stats}
+    if op == "detect":
+        from detectImages import BATCH_SIZE, iter_detections
+
+        model_name = request["model"]
+        # answer with the caller's own path strings
+        requested = {Path(p): p for p in request["images"]}
+        results = {}
+        with cache.lock:
+            model = cache.get(model_name)
+            for image_path, _result, shapes, h, w in iter_detections(
+                    model, model_name, list(requested), request.get("batch_size") or BATCH_SIZE):
+                results[requested[image_path]] = {
+                    "shapes": shapes, "imageHeight": h, "imageWidth": w,
+                }
+            stats["requests"] += 1
+            stats["pages"] += len(request["images"])
+        return {"ok": True, "results": results}
+    return {"ok": False, "error": f"Unknown op: {op}"}
+
+
+def handle_connection(conn, key, cache, stats, stop):
+    """One client, in its own thread: handshake, request (CONNECTION_TIMEOUT), response."""
+    with conn:
+        try:
+            # what Listener(authkey=...).accept() does, but out of the accept loop
+            deliver_challenge(conn, key)
+            answer_challenge(conn, key)
+            if not conn.poll(CONNECTION_TIMEOUT):
+                print(f"[WARN] No request within {CONNECTION_TIMEOUT:.0f}s, connection closed", flush=True)
+                return
+            request = conn.recv()
+        except (AuthenticationError, OSError, EOFError) as e:
+            # wrong key or aborted handshake: refuse this client, keep serving
+            print(f"[WARN] Rejected connection: {e!r}", flush=True)
+            return
+        if request.get("op") == "shutdown":
+            conn.send({"ok": True})
+            stop()
+            return
+        try:
+            response = handle_request(cache, stats, request)
+        except Exception as e:
+            response = {"ok": False, "error": repr(e)}
+        try:
+            conn.send(response)
+        except OSError:
+            pass   # client gone
+
+
+def serve(address=DETECT_SERVICE_ADDRESS, preload=True):
+    from detectImages import model_paths
+
+    cache = ModelCache()
+    stats = {"requests": 0, "pages": 0}
+    if preload:
+        for model_name in list(model_paths)[:cache.max_models]:
+            cache.get(model_name)
+
+    key = authkey(create=True)
+    stopping = threading.Event()
+    # no authkey here: the handshake runs in the connection's thread
+    with Listener(address) as listener:
+
+        def stop():
+            stopping.set()
+            # wakes the accept() below (closing the listener from this thread would not)
+            socket.create_connection(address, timeout=5).close()
+
+        print(f"[OK] Detection service listening on {address[0]}:{address[1]}", flush=True)
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError as e:
+                print(f"[WARN] accept failed: {e!r}", flush=True)
+                continue
+            if stopping.is_set():
+                conn.close()
+                break
+            threading.Thread(target=handle_connection, args=(conn, key, cache, stats, stop),
+                             daemon=True).start()
+    print("[OK] Detection service stopped", flush=True)
+
+
+# =========================
+# CLIENT
+# =========================
+def _call(request, address=DETECT_SERVICE_ADDRESS):
+    with Client(address, authkey=authkey()) as conn:
+        conn.send(request)
+        response = conn.recv()
+    if not response.get("ok"):
+        raise RuntimeError(f"Detection service error: {response.get('error')}")
+    return response
+
+
+def service_available(address=DETECT_SERVICE_ADDRESS) -> bool:
+    try:
+        _call({"op": "ping"}, address)
+        return True
+    except (ConnectionError, OSError, EOFError, AuthenticationError):
+        # OSError also covers a missing key file: no service was ever started
+        return False
+
+
+def request_detection(model_name, image_paths, batch_size=None, address=DETECT_SERVICE_ADDRESS):
+    """{image_path: {"shapes", "imageHeight", "imageWidth"}} for every page with a result."""
+    return _call({"op": "detect", "model": model_name, "images": list(image_paths),
+                  "batch_size": batch_size}, address)["results"]
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "serve"
+    if command == "serve":
+        serve()
+    elif command == "stats":
+        print(_call({"op": "stats"}))
+    elif command == "shutdown":
+        _call({"op": "shutdown"})
+    else:
+        print("Usage: python detectService.py [serve|stats|shutdown]")
+        sys.exit(1)
@@ -1,7 +1,10 @@
 import os
 import json
 import cv2
+import numpy as np
 from pathlib import Path
+from imageProfiles import apply_profile, encode_array, get_profile, write_image
+from manifest import Manifest, inputs_digest
 
 # Base directory = where this script is located
 base_dir = Path(__file__).parent.resolve()
@@ -11,36 +14,10 @@ images_path = r"C:\Users\lasheb\PycharmProjects\extractionPipeline-TS\files"
 json_path = base_dir / "output" / "detImages" / "predict"
 output_path = r"C:\Users\lasheb\PycharmProjects\extractionPipeline-TS\files-out"
 
-# Create output folder if not exists
-os.makedirs(output_path, exist_ok=True)
 
-# Iterate over all json files
-for json_file in os.listdir(json_path):
-    if not json_file.endswith(".json"):
-        continue
-
-    json_file_path = os.path.join(json_path, json_file)
-
-    with open(json_file_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    # Assume JSON filename corresponds to the image name
-    image_name = os.path.splitext(json_file)[0] + ".png"  # or jpg/jpeg
-    image_file = os.path.join(images_path, image_name)
-
-    if not os.path.exists(image_file):
-        print(f"[WARN] Image not found for {json_file}")
-        continue
-
-    img = cv2.imread(image_file)
-    if img is None:
-        print(f"[WARN] Could not load {image_file}")
-        continue
-
-    # Extract page number
-    page_num = ''.join([c for c in image_name if c.isdigit()]) or "0"
-
-    for shape in data.get("shapes", []):
+def annotate_page(img, shapes, page_num):
+    """Draws the red boxes and p{page}c{id} labels in place; returns the annotated image."""
+    for shape in shapes:
         pts = shape["points"]
         x1, y1 = map(int, pts[0])
         x2, y2 = map(int, pts[1])
@@ -73,14 +50,108 @@ for json_file in os.listdir(json_path):
         tx2 = text_x + text_w + padding
         ty2 = text_y + padding
 
-        overlay = img.copy()
-        cv2.rectangle(overlay, (tx1, ty1), (tx2, ty2), (0, 0, 0), -1)
-        alpha = 0.85  # nicer contrast
-        img = cv2.addWeighted(overlay, alpha, img, 1 - alpha, 0)
+        # Darken only the label rectangle (clipped to the page): blending a full-page
+        # copy, as before, leaves every pixel outside it unchanged anyway.
+        h, w = img.shape[:2]
+        rx1, ry1 = max(tx1, 0), max(ty1, 0)
+        rx2, ry2 = min(tx2, w - 1) + 1, min(ty2, h - 1) + 1
+        if rx1 < rx2 and ry1 < ry2:
+            roi = img[ry1:ry2, rx1:rx2]
+            alpha = 0.85  # nicer contrast
+            roi[:] = cv2.addWeighted(np.zeros_like(roi), alpha, roi, 1 - alpha, 0)
 
         cv2.putText(img, label_text, (text_x, text_y), font,
                     scale, (255, 255, 255), thickness, cv2.LINE_AA)
 
-    out_file = os.path.join(output_path, image_name)
-    cv2.imwrite(out_file, img)
-    print(f"[OK] Saved {out_file}")
+    return img
+
+
+# =========================
+# IN-PROCESS PIPELINE STAGE (pipeline.py)
+# =========================
+STAGE_INPUTS = ("page_image", "shapes")
+STAGE_OUTPUTS = ("annotated",)
+
+
+def render_annotated(img, shapes, page_num, profile, out_dir=None):
+    """
+    Annotates a copy of `img` and encodes it with `profile`. Returns (bytes, array):
+    the bytes files-out/page_N would contain (they key the Gemini cache) and the
+    matching array when the profile is lossless (None otherwise).
+    """
+    # annotate_page draws in place: the crop stage still needs the clean page
+    annotated = apply_profile(annotate_page(img.copy(), shapes, page_num), profile)
+    data = encode_array(annotated, profile)
+    if out_dir is not None:
+        out_file = Path(out_dir) / f"page_{page_num}.{profile['format']}"
+        out_file.write_bytes(data)
+        print(f"[OK] Saved {out_file}")
+    return data, (annotated if profile["format"] == "png" else None)
+
+
+def stage(ctx):
+    """Only the encoded bytes are kept: a full-resolution array per page would last until Gemini."""
+    out_dir = ctx.dir("files-out") if ctx.materialize else None
+    annotated_profile = get_profile("annotated")
+    for page_num in ctx.pages_with("page_image", "shapes"):
+        data, _img = render_annotated(ctx.get(page_num, "page_image").load(), ctx.get(page_num, "shapes"),
+                                      page_num, annotated_profile, out_dir)
+        ctx.put(page_num, "annotated", data)
+
+
+def main():
+    # Create output folder if not exists
+    os.makedirs(output_path, exist_ok=True)
+
+    annotated_profile = get_profile("annotated")
+
+    json_files = [f for f in os.listdir(json_path) if f.endswith(".json")]
+
+    # Incremental rebuild: a page is redrawn when its boxes or its image changed
+    manifest = Manifest(output_path, "annotated")
+    manifest.prune(os.path.splitext(f)[0] for f in json_files)
+    stale = 0
+
+    # Iterate over all json files
+    for json_file in json_files:
+        json_file_path = os.path.join(json_path, json_file)
+
+        # Assume JSON filename corresponds to the image name
+        image_name = os.path.splitext(json_file)[0] + ".png"  # or jpg/jpeg
+        image_file = os.path.join(images_path, image_name)
+
+        if not os.path.exists(image_file):
+            print(f"[WARN] Image not found for {json_file}")
+            continue
+
+        page = os.path.splitext(json_file)[0]
+        digest = inputs_digest(Path(json_file_path), Path(image_file), sorted(annotated_profile.items()))
+        if manifest.is_fresh(page, digest):
+            continue
+        stale += 1
+        # previous output first: with another annotated format, page_N.png and page_N.jpg would both stay
+        manifest.invalidate(page)
+
+        with open(json_file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        img = cv2.imread(image_file)
+        if img is None:
+            print(f"[WARN] Could not load {image_file}")
+            continue
+
+        # Extract page number
+        page_num = ''.join([c for c in image_name if c.isdigit()]) or "0"
+
+        img = annotate_page(img, data.get("shapes", []), page_num)
+
+        out_file = write_image(img, os.path.join(output_path, image_name), annotated_profile)
+        print(f"[OK] Saved {out_file}")
+        manifest.record(page, digest, [out_file])
+
+    manifest.save()
+    manifest.report(len(json_files), stale)
+
+
+if __name__ == "__main__":
+    main()
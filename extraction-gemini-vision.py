@@ -1,12 +1,32 @@
+import asyncio
+import csv
+import io
+import math
 import os
+import sys
+import threading
 import time
 import json
 from collections import deque
+import functools
+from functools import lru_cache
 from typing import Optional
 
-import PIL.Image
+import cv2
+import numpy as np
 from google import genai
-from config import STYLE_MODE  # <--- add this
+from google.genai import types
+import geminiCache
+import rateLedger
+import styleStore
+from config import STYLE_MODE, GEMINI_CACHE_ENABLED, GEMINI_LEDGER_ENABLED, GEMINI_MAX_RPM, GEMINI_MAX_RPD  # <--- add this
+from config import IMAGE_PROFILES, GEMINI_REQUEST_LOG, CSV_PAYLOAD
+from imageProfiles import PNG_SIGNATURE, apply_profile, encode_array, get_profile, is_lossless, mime_type, png_size
+from incrementalJson import IncrementalArrayParser, MalformedStream
+import geminiBatch
+from config import GEMINI_BATCH_DIR
+from manifest import Manifest
+import telemetry
 
 
 # =========================
@@ -14,11 +34,17 @@ from config import STYLE_MODE  # <--- add this
 # =========================
 MODEL_NAME = "gemini-2.5-flash"
 
-# Set these to what your Google AI Studio dashboard shows
-MAX_RPM = 10          # requests per minute
-MAX_RPD = 250         # requests per day
+# Set these to what your Google AI Studio dashboard shows (config.py, shared with rateLedger.py)
+MAX_RPM = GEMINI_MAX_RPM          # requests per minute
+MAX_RPD = GEMINI_MAX_RPD          # requests per day
 # Optional: tiny spacing to smooth bursts after retries (seconds)
 POST_SUCCESS_PAUSE = 0.25
+# Stream responses and parse them incrementally; a clearly malformed stream is aborted and retried
+STREAMING = False
+# Requests in flight at once (1 = one page at a time); MAX_RPM/MAX_RPD still apply
+GEMINI_CONCURRENCY = 4
+# Build manifest of extractionOut[Style] (set by main(); None = skip pages whose JSON exists)
+MANIFEST = None
 
 # ---- Booléen de mode style / normal ----
 # True  => utilise promptStyle.txt + extractionOutStyle
@@ -43,10 +69,13 @@ os.makedirs(output_dir, exist_ok=True)
 # =========================
 # RATE LIMITER (leaky bucket)
 # =========================
+# With GEMINI_LEDGER_ENABLED the windows live in rateLedger (SQLite shared by
+# every local process); the deques below are the single-process fallback.
 _one_min = 60.0
 _one_day = 86400.0
 _minute_window = deque()
 _day_window = deque()
+_window_lock = threading.Lock()   # run_concurrent is single-threaded, the streaming pipeline is not
 
 def _purge_windows(now: float) -> None:
     while _minute_window and (now - _minute_window[0]) >= _one_min:
@@ -54,35 +83,128 @@ def _purge_windows(now: float) -> None:
     while _day_window and (now - _day_window[0]) >= _one_day:
         _day_window.popleft()
 
-def allow_request() -> None:
+class DailyLimitReached(RuntimeError):
+    """MAX_RPD requests already sent in the last 24h: stop, do not retry."""
+
+
+def _try_acquire() -> float:
     """
-    Blocks until it's safe to fire one more request under RPM/RPD caps.
-    Raises RuntimeError if daily cap is reached.
+    Takes one RPM/RPD slot if available and returns 0.
+    Otherwise returns how long to wait before trying again.
+    Raises DailyLimitReached if daily cap is reached.
     """
-    while True:
+    if GEMINI_LEDGER_ENABLED:
+        wait, used_today = rateLedger.try_acquire(MAX_RPM, MAX_RPD)
+        if wait is None:
+            raise DailyLimitReached(f"Daily request limit reached ({MAX_RPD}, shared ledger).")
+        return wait
+
+    with _window_lock:
         now = time.time()
         _purge_windows(now)
 
         if len(_day_window) >= MAX_RPD:
-            raise RuntimeError(f"Daily request limit reached ({MAX_RPD}).")
+            raise DailyLimitReached(f"Daily request limit reached ({MAX_RPD}).")
 
         if len(_minute_window) < MAX_RPM:
             _minute_window.append(now)
             _day_window.append(now)
-            return
+            return 0.0
 
         # Need to wait for the earliest minute slot to expire
-        sleep_for = _one_min - (now - _minute_window[0]) + 0.05
-        time.sleep(max(0.05, sleep_for))
+        return max(0.05, _one_min - (now - _minute_window[0]) + 0.05)
+
+def allow_request() -> None:
+    """
+    Blocks until it's safe to fire one more request under RPM/RPD caps.
+    Raises RuntimeError (DailyLimitReached) if daily cap is reached.
+    """
+    with telemetry.span("gemini.allow_request"):
+        while True:
+            sleep_for = _try_acquire()
+            if not sleep_for:
+                return
+            time.sleep(sleep_for)
+
+async def allow_request_async() -> None:
+    """allow_request for the asyncio scheduler: waits without blocking the other requests."""
+    with telemetry.span("gemini.allow_request"):
+        while True:
+            sleep_for = _try_acquire()
+            if not sleep_for:
+                return
+            await asyncio.sleep(sleep_for)
 
 
 # =========================
 # UTILITIES
 # =========================
+_log_lock = threading.Lock()
+
 def read_file(path: str) -> str:
     with open(path, "r", encoding="utf-8") as f:
         return f.read()
 
+@lru_cache(maxsize=None)
+def load_prompt(path: str) -> str:
+    """Prompt file, read once per run."""
+    return read_file(path)
+
+COMPACT_HEADER = (
+    "Style legend first (style_id;font_family;size;color_hex;style_tag), "
+    "then one row per line: phrase;style_id;overrides "
+    "(overrides = word|style_id joined by ||)."
+)
+
+def compact_style_payload(csv_text: str) -> str:
+    """
+    Same content as the style CSV, with each distinct (font_family, size, color_hex,
+    style_tag) written once in a legend and referenced by id (S0, S1...) on every line
+    and in the overrides.
+    """
+    rows = list(csv.reader(io.StringIO(csv_text), delimiter=";"))
+    if not rows:
+        return csv_text
+
+    ids = {}
+    def style_id(style):
+        if style not in ids:
+            ids[style] = f"S{len(ids)}"
+        return ids[style]
+
+    lines = []
+    for row in rows[1:]:
+        if len(row) < 6:
+            continue
+        phrase, fam, size, col, tag, overrides = row[:6]
+        line_style = style_id((fam, size, col, tag))
+        compact_overrides = []
+        for item in overrides.split("||") if overrides else []:
+            parts = item.rsplit("|", 4)
+            if len(parts) != 5:
+                compact_overrides.append(item)
+                continue
+            word, w_fam, w_size, w_col, w_tag = parts
+            compact_overrides.append(f"{word}|{style_id((w_fam, w_size, w_col, w_tag))}")
+        lines.append([phrase, line_style, "||".join(compact_overrides)])
+
+    out = io.StringIO()
+    w = csv.writer(out, delimiter=";", lineterminator="\n")
+    out.write(COMPACT_HEADER + "\n")
+    w.writerow(["style_id", "font_family", "size", "color_hex", "style_tag"])
+    for style, sid in ids.items():
+        w.writerow([sid, *style])
+    out.write("\n")
+    w.writerow(["phrase", "style_id", "overrides"])
+    w.writerows(lines)
+    return out.getvalue()
+
+def build_side_text(csv_text: str) -> str:
+    """Text payload sent next to the prompt, per config.CSV_PAYLOAD ("csv" | "compact")."""
+    if CSV_PAYLOAD == "compact":
+        return compact_style_payload(csv_text)
+    return csv_text
+
 def clean_fenced_json(text: str) -> str:
     t = text.strip()
     if t.startswith("```json"):
@@ -93,6 +215,16 @@ def clean_fenced_json(text: str) -> str:
         t = t[:-3].strip()
     return t
 
+def is_complete_response(text: str, finish_reason: Optional[str]) -> bool:
+    """Finished normally (STOP) and parses as JSON once the fences are removed: safe to cache."""
+    if finish_reason != "STOP":
+        return False
+    try:
+        json.loads(clean_fenced_json(text))
+    except ValueError:
+        return False
+    return True
+
 def save_json_safely(raw_text: str, out_path: str) -> None:
     """
     Try to parse the model output as JSON and pretty-print it.
@@ -108,6 +240,40 @@ def save_json_safely(raw_text: str, out_path: str) -> None:
         with open(out_path, "w", encoding="utf-8") as f:
             f.write(cleaned)
 
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Gemini 2.x: 258 tokens if both sides <= 384 px, else 258 per 768x768 tile."""
+    if width <= 384 and height <= 384:
+        return 258
+    return 258 * math.ceil(width / 768) * math.ceil(height / 768)
+
+def log_request(meta: Optional[dict], resp, latency: float, attempts: int) -> None:
+    """Prints bytes/tokens/latency of one request and appends them to GEMINI_REQUEST_LOG (JSON lines)."""
+    usage = getattr(resp, "usage_metadata", None)
+    record = dict(meta or {})
+    record.update({
+        "model": MODEL_NAME,
+        "latency_s": round(latency, 3),
+        "attempts": attempts,
+        "prompt_tokens": getattr(usage, "prompt_token_count", None),
+        "output_tokens": getattr(usage, "candidates_token_count", None),
+        "total_tokens": getattr(usage, "total_token_count", None),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    })
+    print(f" [{record.get('page', '?')}] {record.get('image_bytes', '?')} image bytes, "
+          f"~{record.get('image_tokens_est', '?')} image tokens, prompt={record['prompt_tokens']} "
+          f"output={record['output_tokens']} tokens, {latency:.1f}s")
+    if GEMINI_REQUEST_LOG:
+        with _log_lock, open(GEMINI_REQUEST_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    telemetry.emit_span("gemini.request", time.time() - latency, latency,
+                        **{k: v for k, v in record.items() if k not in ("latency_s", "time")})
+
+def finish_reason(resp) -> Optional[str]:
+    """Finish reason of the first candidate ("STOP", "MAX_TOKENS"...), or None."""
+    candidates = getattr(resp, "candidates", None) or []
+    reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    return getattr(reason, "name", reason)
+
 def load_api_key(path: str) -> str:
     with open(path, "r", encoding="utf-8") as f:
         return f.read().strip()
@@ -116,98 +282,203 @@ def load_api_key(path: str) -> str:
 # =========================
 # GEMINI CALLER (with backoff)
 # =========================
-def generate_with_backoff(client: genai.Client, contents) -> Optional[str]:
+MAX_ATTEMPTS = 6  # 6 attempts: ~2,4,8,16,32,64s (capped below)
+
+def _is_retryable(e: Exception) -> bool:
+    msg = str(e).lower()
+    # treat common transient errors as retryable
+    return any(k in msg for k in (
+        "rate", "limit", "quota", "exceeded", "resource exhausted",
+        "temporarily", "please try again"
+    ))
+
+def _backoff_seconds(attempt: int) -> int:
+    # Exponential backoff with cap (max 5 minutes)
+    return min(300, max(2, 2 ** attempt))
+
+def _stream_parser(meta: Optional[dict]) -> IncrementalArrayParser:
+    page = (meta or {}).get("page", "?")
+
+    def on_exercise(obj):
+        ex_id = obj.get("id") if isinstance(obj, dict) else None
+        print(f" [{page}] exercise {ex_id} received")
+
+    return IncrementalArrayParser(on_exercise)
+
+def _stream_generate(client: genai.Client, contents, meta: Optional[dict]):
+    """
+    generate_content_stream fed into the incremental parser.
+    Returns (text, last chunk); raises MalformedStream as soon as the output
+    stops looking like a JSON array (leaving the loop closes the stream).
+    """
+    parser = _stream_parser(meta)
+    parts, last = [], None
+    for chunk in client.models.generate_content_stream(model=MODEL_NAME, contents=contents):
+        last = chunk
+        text = getattr(chunk, "text", None) or ""
+        parser.feed(text)
+        parts.append(text)
+    return "".join(parts), last
+
+async def _stream_generate_async(client: genai.Client, contents, meta: Optional[dict]):
+    parser = _stream_parser(meta)
+    parts, last = [], None
+    async for chunk in await client.aio.models.generate_content_stream(model=MODEL_NAME, contents=contents):
+        last = chunk
+        text = getattr(chunk, "text", None) or ""
+        parser.feed(text)
+        parts.append(text)
+    return "".join(parts), last
+
+def generate_with_backoff(client: genai.Client, contents, meta: Optional[dict] = None):
     """
     Calls generate_content with an exponential backoff on rate/quota errors.
-    Returns response text or None on repeated failures.
+    Returns (response text, finish reason), or (None, None) on repeated failures.
     """
-    max_attempts = 6  # 6 attempts: ~2,4,8,16,32,64s (capped below)
-    for attempt in range(max_attempts):
+    for attempt in range(MAX_ATTEMPTS):
         try:
             allow_request()
-            resp = client.models.generate_content(model=MODEL_NAME, contents=contents)
+            t0 = time.perf_counter()
+            if STREAMING:
+                text, resp = _stream_generate(client, contents, meta)
+            else:
+                resp = client.models.generate_content(model=MODEL_NAME, contents=contents)
+                text = getattr(resp, "text", None)
+            log_request(meta, resp, time.perf_counter() - t0, attempt + 1)
             # smooth bursts after success
             if POST_SUCCESS_PAUSE:
                 time.sleep(POST_SUCCESS_PAUSE)
-            return getattr(resp, "text", None)
+            return text, finish_reason(resp)
+        except DailyLimitReached:
+            raise
+        except MalformedStream as e:
+            print(f" Malformed output, stream aborted: {e} (attempt {attempt+1}/{MAX_ATTEMPTS})")
+            telemetry.count("gemini.retries", reason="malformed")
+            time.sleep(POST_SUCCESS_PAUSE)
         except Exception as e:
-            msg = str(e).lower()
-            # treat common transient errors as retryable
-            retryable = any(k in msg for k in (
-                "rate", "limit", "quota", "exceeded", "resource exhausted",
-                "temporarily", "please try again"
-            ))
-            if not retryable:
+            if not _is_retryable(e):
                 # Non-rate error: bubble up for visibility
                 print(f" Non-retryable error: {e}")
-                return None
+                return None, None
 
-            # Exponential backoff with cap (max 5 minutes)
-            backoff = min(300, max(2, 2 ** attempt))
-            print(f"Rate/quota error: {e}. Backing off {backoff}s (attempt {attempt+1}/{max_attempts})…")
+            backoff = _backoff_seconds(attempt)
+            print(f"Rate/quota error: {e}. Backing off {backoff}s (attempt {attempt+1}/{MAX_ATTEMPTS})…")
+            telemetry.count("gemini.retries", reason="rate")
+            telemetry.count("gemini.backoff_s", backoff)
             time.sleep(backoff)
 
     print(" Failed after retries; giving up on this item.")
-    return None
+    return None, None
+
+async def generate_with_backoff_async(client: genai.Client, contents, meta: Optional[dict] = None):
+    """generate_with_backoff on client.aio: same limiter, retry rules and backoff."""
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            await allow_request_async()
+            t0 = time.perf_counter()
+            if STREAMING:
+                text, resp = await _stream_generate_async(client, contents, meta)
+            else:
+                resp = await client.aio.models.generate_content(model=MODEL_NAME, contents=contents)
+                text = getattr(resp, "text", None)
+            log_request(meta, resp, time.perf_counter() - t0, attempt + 1)
+            if POST_SUCCESS_PAUSE:
+                await asyncio.sleep(POST_SUCCESS_PAUSE)
+            return text, finish_reason(resp)
+        except DailyLimitReached:
+            raise
+        except MalformedStream as e:
+            print(f" Malformed output, stream aborted: {e} (attempt {attempt+1}/{MAX_ATTEMPTS})")
+            telemetry.count("gemini.retries", reason="malformed")
+            await asyncio.sleep(POST_SUCCESS_PAUSE)
+        except Exception as e:
+            if not _is_retryable(e):
+                print(f" Non-retryable error: {e}")
+                return None, None
+
+            backoff = _backoff_seconds(attempt)
+            print(f"Rate/quota error: {e}. Backing off {backoff}s (attempt {attempt+1}/{MAX_ATTEMPTS})…")
+            telemetry.count("gemini.retries", reason="rate")
+            telemetry.count("gemini.backoff_s", backoff)
+            await asyncio.sleep(backoff)
+
+    print(" Failed after retries; giving up on this item.")
+    return None, None
 
 
 # =========================
 # MAIN PIPELINE
 # =========================
-def process_image_file(client: genai.Client, image_path: str) -> None:
+def csv_from_store(stem: str) -> Optional[str]:
+    """page_N.csv rebuilt from the Parquet style store (STYLE_OUTPUT = "parquet"), or None."""
+    store = os.path.join(text_dir, styleStore.STORE_DIRNAME)
+    if not styleStore.has_store(store):
+        return None
+    try:
+        return styleStore.page_csv(store, int(stem.rsplit("_", 1)[-1]))
+    except Exception as e:
+        print(f" ERROR reading style store {store}: {e}")
+        return None
+
+def prepare_request(image_path: str, out_dir: Optional[str] = None):
+    """
+    Steps 1-3 of a page read from disk: CSV, prompt, image, cache lookup.
+    Returns (name, contents, cache key, out_json, meta), or None when there is
+    nothing to send (already done, cache hit, missing input).
+    out_dir replaces output_dir (the fake batch endpoint writes elsewhere).
+    """
     name = os.path.basename(image_path)
     stem, _ = os.path.splitext(name)
 
     # Paths
     csv_path = os.path.join(text_dir, f"{stem}.csv")
-    txt_path = os.path.join(text_dir, f"{stem}.txt")
-    out_json = os.path.join(output_dir, f"{stem}.json")
+    out_json = os.path.join(out_dir or output_dir, f"{stem}.json")
 
-    # Skip if already processed
-    if os.path.exists(out_json):
+    # Skip if already processed (with a manifest, prepare_page decides from the inputs)
+    if MANIFEST is None and os.path.exists(out_json):
         print(f" Skipping (already exists): {out_json}")
-        return
+        return None
 
     # =========================
-    # 1) READ CSV, CONVERT → TXT
+    # 1) READ CSV (kept in memory)
     # =========================
-    if not os.path.exists(csv_path):
-        print(f" CSV NOT FOUND for {stem}")
-        return
+    if os.path.exists(csv_path):
+        try:
+            with open(csv_path, "r", encoding="utf-8") as f:
+                csv_content = f.read()
+        except Exception as e:
+            print(f" ERROR reading CSV {csv_path}: {e}")
+            return None
+    else:
+        csv_content = csv_from_store(stem)
+        if csv_content is None:
+            print(f" CSV NOT FOUND for {stem}")
+            return None
 
     try:
-        with open(csv_path, "r", encoding="utf-8") as f:
-            csv_content = f.read()
-
-        # Create TXT from CSV
-        with open(txt_path, "w", encoding="utf-8") as f:
-            f.write(csv_content)
+        with open(image_path, "rb") as f:
+            raw_image = f.read()
+    except Exception as e:
+        print(f" Could not open image {image_path}: {e}")
+        return None
 
-        print(f" Converted CSV > TXT : {csv_path} -> {txt_path}")
+    return prepare_page(name, csv_content, raw_image, out_json)
 
-    except Exception as e:
-        print(f" ERROR converting CSV {csv_path}: {e}")
-        return
 
-    # =========================
-    # 2) LOAD IMAGE
-    # =========================
-    try:
-        image = PIL.Image.open(image_path)
-    except Exception as e:
-        print(f" Could not open image {image_path}: {e}")
-        return
+def prepare_page(name: str, csv_content: str, raw_image: bytes, out_json: str, img=None):
+    """
+    Steps 2-3 for a page already in memory. `raw_image` is the annotated page as
+    written to files-out (it keys the cache); pass `img` when it is already decoded.
+    """
+    stem, _ = os.path.splitext(name)
 
     # =========================
-    # 3) LOAD PROMPT + TXT (just converted)
+    # 2) PROMPT (loaded once) + CSV PAYLOAD
     # =========================
-    base_prompt = read_file(prompt_file)
-
-    try:
-        side_text = read_file(txt_path)
-    except Exception as e:
-        print(f" Cannot read TXT after conversion: {txt_path}")
-        return
+    base_prompt = load_prompt(prompt_file)
+    side_text = build_side_text(csv_content)
+    if side_text is not csv_content:
+        print(f" CSV payload {stem}: {len(csv_content)} -> {len(side_text)} chars ({CSV_PAYLOAD})")
 
     full_prompt = (
             base_prompt
@@ -217,31 +488,268 @@ def process_image_file(client: genai.Client, image_path: str) -> None:
     )
 
     # =========================
-    # 4) SEND TO GEMINI
+    # 3) IMAGE + CACHE LOOKUP
     # =========================
-    contents = [full_prompt, image]
+    llm_profile = get_profile("llm")
+    key = geminiCache.cache_key(raw_image, side_text, base_prompt, MODEL_NAME, repr(sorted(llm_profile.items())))
+    if MANIFEST is not None and MANIFEST.is_fresh(stem, key):
+        print(f" Up to date: {out_json}")
+        return None
+    if GEMINI_CACHE_ENABLED:
+        cached = geminiCache.get(key)
+        if cached is not None:
+            save_json_safely(cached, out_json)
+            print(f" Cache hit {key[:12]} -> {out_json}")
+            telemetry.count("gemini.cache_hits")
+            if MANIFEST is not None:
+                MANIFEST.record(stem, key, [out_json])
+            return None
 
-    resp_text = generate_with_backoff(client, contents)
+    try:
+        if is_lossless(llm_profile) and raw_image[:8] == PNG_SIGNATURE:
+            # profil sans perte et image déjà en PNG : envoyée telle quelle
+            image_bytes = raw_image
+            width, height = png_size(raw_image)
+        else:
+            # ré-encodée selon le profil "llm" (bord long plafonné, marges retirées si demandé)
+            if img is None:
+                img = cv2.imdecode(np.frombuffer(raw_image, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                raise ValueError("cv2.imdecode returned None")
+            upload = apply_profile(img, llm_profile)
+            image_bytes = encode_array(upload, llm_profile)
+            height, width = upload.shape[:2]
+        image = types.Part.from_bytes(data=image_bytes, mime_type=mime_type(llm_profile))
+        print(f" Image {name}: {len(raw_image)} -> {len(image_bytes)} bytes "
+              f"({width}x{height} {llm_profile['format']})")
+    except Exception as e:
+        print(f" Could not open image {name}: {e}")
+        return None
+
+    meta = {
+        "page": stem,
+        "profile": IMAGE_PROFILES.get("llm", "archive"),
+        "source_bytes": len(raw_image),
+        "image_bytes": len(image_bytes),
+        "image_size": [width, height],
+        "image_tokens_est": estimate_image_tokens(width, height),
+        "prompt_chars": len(full_prompt),
+    }
+    return name, [full_prompt, image], key, out_json, meta
+
+
+def save_response(name: str, resp_text: Optional[str], key: str, out_json: str,
+                  finish: Optional[str], cache: bool = True) -> bool:
+    """Writes the page JSON; True when the response was complete (see is_complete_response)."""
     if not resp_text:
         print(f" No response for {name}")
-        return
+        return False
 
     # =========================
     # 5) SAVE RESULT
     # =========================
+    # written either way (useful to debug), but only a complete answer is cached
+    # or recorded: the next run asks again for a truncated or unparsable one
+    complete = is_complete_response(resp_text, finish)
+    if not complete:
+        print(f" Incomplete response for {name} (finish reason {finish}): not cached")
+    elif cache and GEMINI_CACHE_ENABLED:
+        geminiCache.put(key, resp_text)
+        print(f" Cached as {key}")
     save_json_safely(resp_text, out_json)
     print(f" Saved {out_json}")
+    if complete and cache and MANIFEST is not None:
+        MANIFEST.record(os.path.splitext(name)[0], key, [out_json])
+    return complete
+
+
+def process_prepared(client: genai.Client, prepared) -> bool:
+    """True when a complete response was saved for the page."""
+    if prepared is None:
+        return False
+    name, contents, key, out_json, meta = prepared
+
+    # =========================
+    # 4) SEND TO GEMINI
+    # =========================
+    resp_text, finish = generate_with_backoff(client, contents, meta)
+    return save_response(name, resp_text, key, out_json, finish)
+
+
+def process_image_file(client: genai.Client, image_path: str) -> None:
+    process_prepared(client, prepare_request(image_path))
+
+
+async def process_prepared_async(client: genai.Client, prepare) -> None:
+    # image decode/re-encode is CPU work: keep it off the event loop
+    prepared = await asyncio.to_thread(prepare)
+    if prepared is None:
+        return
+    name, contents, key, out_json, meta = prepared
+
+    resp_text, finish = await generate_with_backoff_async(client, contents, meta)
+    await asyncio.to_thread(save_response, name, resp_text, key, out_json, finish)
+
+
+def list_images():
+    return [os.path.join(image_dir, fname) for fname in sorted(os.listdir(image_dir))
+            if fname.lower().endswith((".png", ".jpg", ".jpeg", ".webp"))]
+
+
+async def run_concurrent(client: genai.Client, preparers, concurrency: int) -> None:
+    """
+    `preparers`: zero-argument callables returning prepare_request/prepare_page results.
+    Up to `concurrency` requests in flight; the shared RPM/RPD limiter decides
+    when each one may actually fire. Hitting MAX_RPD cancels the remaining pages.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(prepare):
+        async with semaphore:
+            await process_prepared_async(client, prepare)
+
+    tasks = [asyncio.create_task(worker(p)) for p in preparers]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            await fut
+    except DailyLimitReached as e:
+        print(f" {e} Stopping.")
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def run_preparers(client: genai.Client, preparers) -> None:
+    """Sends every prepared page, concurrently when GEMINI_CONCURRENCY > 1."""
+    if GEMINI_CONCURRENCY > 1:
+        asyncio.run(run_concurrent(client, preparers, GEMINI_CONCURRENCY))
+        return
+    try:
+        for prepare in preparers:
+            process_prepared(client, prepare())
+    except DailyLimitReached as e:
+        print(f" {e} Stopping.")
+
+
+def print_run_summary() -> None:
+    if GEMINI_CACHE_ENABLED:
+        geminiCache.evict_pending()
+        print(f" {geminiCache.summary()}")
+    if GEMINI_LEDGER_ENABLED:
+        print(f" Daily budget remaining: {rateLedger.remaining_today(MAX_RPD)}/{MAX_RPD}")
+
+
+def fake_output_dir() -> str:
+    """Where --fake-batch writes its canned responses: never the real output_dir."""
+    return os.path.join(GEMINI_BATCH_DIR, "fake-out", os.path.basename(output_dir))
+
+
+def run_batch_mode(image_paths, endpoint, fake: bool) -> None:
+    """
+    All pending pages in one batch job (see geminiBatch). Cache hits and pages
+    already extracted are resolved by prepare_request and never submitted.
+    Fake endpoint responses are not cached and go to fake_output_dir(), so a
+    later real run neither skips those pages nor takes them for fresh.
+    """
+    out_dir = fake_output_dir() if fake else output_dir
+    os.makedirs(out_dir, exist_ok=True)
+
+    def prepare_pending():
+        pending = {}
+        for path in image_paths:
+            prepared = prepare_request(path, out_dir)
+            if prepared is None:
+                continue
+            name, (prompt, image), key, out_json, meta = prepared
+            line = geminiBatch.request_line(meta["page"], prompt, image.inline_data.data,
+                                            image.inline_data.mime_type)
+            pending[meta["page"]] = (line, {"name": name, "cache_key": key, "out_json": out_json})
+        return pending
+
+    def save_result(_page, text, info, finish):
+        save_response(info["name"], text, info["cache_key"], info["out_json"], finish, cache=not fake)
+
+    mode = "fake" if fake else "gemini"
+    geminiBatch.run_batch(endpoint, os.path.join(GEMINI_BATCH_DIR, f"{mode}-{os.path.basename(output_dir)}"),
+                          f"extraction-{os.path.basename(output_dir)}", prepare_pending, save_result,
+                          poll_interval=1.0 if fake else 30.0)
+
+
+# =========================
+# IN-PROCESS PIPELINE STAGE (pipeline.py)
+# =========================
+def page_preparer(page_num, csv_content: Optional[str], annotated: bytes, annotated_image, out_json: str):
+    """Zero-argument preparer for an in-memory page, or None when there is nothing to send."""
+    if os.path.exists(out_json):
+        print(f" Skipping (already exists): {out_json}")
+        return None
+    if csv_content is None:
+        print(f" CSV NOT FOUND for page_{page_num}")
+        return None
+    name = f"page_{page_num}.{get_profile('annotated')['format']}"
+    return functools.partial(prepare_page, name, csv_content, annotated, out_json, annotated_image)
+
+
+STAGE_INPUTS = ("annotated", "style_csv")
+STAGE_OUTPUTS = ("extraction",)
+
+
+def stage(ctx):
+    """
+    Extracts the pages annotated in memory. Responses are always written
+    (extractionOut[Style]/page_N.json); "extraction" holds those paths.
+    """
+    out_dir = ctx.dir(os.path.basename(output_dir))
+    if "gemini_client" not in ctx.resources:
+        ctx.resources["gemini_client"] = genai.Client(api_key=load_api_key(api_key_path))
+
+    preparers, pages = [], {}
+    for page_num in ctx.pages_with("annotated"):
+        out_json = str(out_dir / f"page_{page_num}.json")
+        pages[page_num] = out_json
+        prepare = page_preparer(page_num, ctx.get(page_num, "style_csv"), ctx.get(page_num, "annotated"),
+                                None, out_json)
+        if prepare is not None:
+            preparers.append(prepare)
+
+    run_preparers(ctx.resources["gemini_client"], preparers)
+    for page_num, out_json in pages.items():
+        if os.path.exists(out_json):
+            ctx.put(page_num, "extraction", out_json)
+    print_run_summary()
 
 
 def main():
+    # Usage: python extraction-gemini-vision.py [--batch | --fake-batch] [--refresh-cache]
+    # --refresh-cache : ignore the cached responses and ask Gemini again (the cache is updated)
+    if "--refresh-cache" in sys.argv:
+        os.environ[geminiCache.REFRESH_ENV] = "1"
+    if "--fake-batch" in sys.argv:
+        endpoint = geminiBatch.FakeBatchEndpoint(os.path.join(GEMINI_BATCH_DIR, "fake-endpoint"))
+        run_batch_mode(list_images(), endpoint, fake=True)
+        print(f" Done (fake responses in {fake_output_dir()}).")
+        return
+
     api_key = load_api_key(api_key_path)
     client = genai.Client(api_key=api_key)
 
-    # Walk the image directory
-    for fname in sorted(os.listdir(image_dir)):
-        if fname.lower().endswith((".png", ".jpg", ".jpeg", ".webp")):
-            fpath = os.path.join(image_dir, fname)
-            process_image_file(client, fpath)
+    image_paths = list_images()
+
+    # Incremental rebuild: a page is re-extracted only when its image, CSV,
+    # prompt, model or upload encoding changed (the cache key covers all of them)
+    global MANIFEST
+    MANIFEST = Manifest(output_dir, "extraction")
+    MANIFEST.prune(os.path.splitext(os.path.basename(p))[0] for p in image_paths)
+    try:
+        if "--batch" in sys.argv:
+            run_batch_mode(image_paths, geminiBatch.GeminiBatchEndpoint(client, MODEL_NAME), fake=False)
+        else:
+            # Walk the image directory
+            run_preparers(client, [functools.partial(prepare_request, p) for p in image_paths])
+    finally:
+        # also after an interruption: pages already extracted stay up to date
+        MANIFEST.save()
+    print_run_summary()
     print(" Done.")
 
 if __name__ == "__main__":
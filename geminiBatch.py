@@ -0,0 +1,296 @@
+"""
+Batch submission for whole-manual extraction.
+
+All pending pages (prompt + CSV + image) go into one JSONL job file that is
+submitted once, polled, and fanned back out to page_N.json. The job name and
+the page -> output mapping are written to a state file right after submission,
+so an interrupted run resumes polling the same job instead of paying for it twice.
+
+Two endpoints share the same interface (submit / poll / results):
+  - GeminiBatchEndpoint : Gemini Batch API (client.batches + client.files; needs a
+                          google-genai release whose Developer API takes a JSONL
+                          file as batch source, see requirements.txt)
+  - FakeBatchEndpoint   : local, offline; completes after a few polls with canned
+                          responses, to exercise submit -> poll -> demux without API calls
+
+    python geminiBatch.py selftest    # submit -> interrupted poll -> resume -> demux, offline
+"""
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PENDING, RUNNING, SUCCEEDED, FAILED = "pending", "running", "succeeded", "failed"
+
+
+# =========================
+# JOB FILE
+# =========================
+def request_line(key: str, prompt: str, image_bytes: bytes, mime_type: str) -> dict:
+    """One JSONL line in the Gemini batch request format."""
+    return {
+        "key": key,
+        "request": {
+            "contents": [{
+                "role": "user",
+                "parts": [
+                    {"text": prompt},
+                    {"inline_data": {"mime_type": mime_type,
+                                     "data": base64.b64encode(image_bytes).decode("ascii")}},
+                ],
+            }],
+        },
+    }
+
+
+def write_job_file(path: Path, lines) -> None:
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    os.replace(tmp, path)
+
+
+def response_text(response: dict):
+    """Concatenated text of the first candidate of a GenerateContentResponse dict."""
+    candidates = (response or {}).get("candidates") or []
+    if not candidates:
+        return None
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    text = "".join(p.get("text", "") for p in parts)
+    return text or None
+
+
+def response_finish_reason(response: dict):
+    """finishReason of the first candidate ("STOP", "MAX_TOKENS"...), or None."""
+    candidates = (response or {}).get("candidates") or []
+    if not candidates:
+        return None
+    return candidates[0].get("finishReason") or candidates[0].get("finish_reason")
+
+
+# =========================
+# ENDPOINTS
+# =========================
+def file_batches_supported() -> bool:
+    """True when the installed google-genai accepts an uploaded JSONL file as batch source
+    and returns the results as a file (Developer API, not only Vertex AI)."""
+    from google.genai import types
+
+    source = getattr(types, "BatchJobSource", None)
+    destination = getattr(types, "BatchJobDestination", None)
+    return (source is not None and destination is not None
+            and "file_name" in source.model_fields and "file_name" in destination.model_fields)
+
+
+class GeminiBatchEndpoint:
+
+    def __init__(self, client, model_name: str):
+        # checked before anything is prepared or uploaded
+        if not file_batches_supported():
+            raise RuntimeError("This google-genai release cannot submit file-based batch jobs "
+                               "with an API key; install the version pinned in requirements.txt "
+                               "or run without --batch")
+        self.client = client
+        self.model_name = model_name
+
+    def submit(self, job_file: Path, display_name: str) -> str:
+        from google.genai import types
+
+        uploaded = self.client.files.upload(
+            file=str(job_file),
+            config=types.UploadFileConfig(display_name=display_name, mime_type="jsonl"),
+        )
+        job = self.client.batches.create(model=self.model_name,
+                                         src=types.BatchJobSource(file_name=uploaded.name),
+                                         config=types.CreateBatchJobConfig(display_name=display_name))
+        return job.name
+
+    def poll(self, job_name: str) -> str:
+        state = self.client.batches.get(name=job_name).state
+        state = getattr(state, "name", str(state))
+        if state == "JOB_STATE_SUCCEEDED":
+            return SUCCEEDED
+        if state in ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+            return FAILED
+        return PENDING if state == "JOB_STATE_PENDING" else RUNNING
+
+    def results(self, job_name: str):
+        """Yields (key, text or None, error or None, finish reason or None)."""
+        job = self.client.batches.get(name=job_name)
+        if job.dest is None or not job.dest.file_name:
+            raise RuntimeError(f"Batch job {job_name} has no result file")
+        content = self.client.files.download(file=job.dest.file_name)
+        for raw in content.decode("utf-8").splitlines():
+            if not raw.strip():
+                continue
+            line = json.loads(raw)
+            yield (line.get("key"), response_text(line.get("response")), line.get("error"),
+                   response_finish_reason(line.get("response")))
+
+
+class FakeBatchEndpoint:
+    """
+    Offline stand-in: jobs live in `root`, switch to succeeded after `polls_needed`
+    polls, and answer every request with `responder(key, request)` (default: a
+    one-exercise JSON array naming the page).
+    """
+
+    def __init__(self, root, polls_needed: int = 2, responder=None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.polls_needed = polls_needed
+        self.responder = responder or (lambda key, request: json.dumps(
+            [{"id": f"{key}-fake", "type": "exercise", "images": False, "image_type": "none",
+              "properties": {"number": None, "instruction": None, "labels": [], "statement": None,
+                             "hint": None, "example": None, "references": None}}]))
+
+    def _job_dir(self, job_name: str) -> Path:
+        return self.root / job_name
+
+    def submit(self, job_file: Path, display_name: str) -> str:
+        job_name = f"fake-{display_name}-{int(time.time() * 1000)}"
+        job_dir = self._job_dir(job_name)
+        job_dir.mkdir(parents=True)
+        (job_dir / "input.jsonl").write_bytes(Path(job_file).read_bytes())
+        (job_dir / "polls").write_text("0")
+        return job_name
+
+    def poll(self, job_name: str) -> str:
+        job_dir = self._job_dir(job_name)
+        polls = int((job_dir / "polls").read_text()) + 1
+        (job_dir / "polls").write_text(str(polls))
+        if polls < self.polls_needed:
+            return RUNNING
+        if not (job_dir / "output.jsonl").exists():
+            lines = []
+            with open(job_dir / "input.jsonl", encoding="utf-8") as f:
+                for raw in f:
+                    req = json.loads(raw)
+                    text = self.responder(req["key"], req["request"])
+                    lines.append({"key": req["key"],
+                                  "response": {"candidates": [{"content": {"parts": [{"text": text}]},
+                                                                "finishReason": "STOP"}]}})
+            write_job_file(job_dir / "output.jsonl", lines)
+        return SUCCEEDED
+
+    def results(self, job_name: str):
+        with open(self._job_dir(job_name) / "output.jsonl", encoding="utf-8") as f:
+            for raw in f:
+                line = json.loads(raw)
+                yield (line.get("key"), response_text(line.get("response")), line.get("error"),
+                       response_finish_reason(line.get("response")))
+
+
+# =========================
+# SUBMIT -> POLL -> DEMUX
+# =========================
+def run_batch(endpoint, work_dir, display_name: str, prepare_pending, save_result,
+              poll_interval: float = 30.0) -> int:
+    """
+    prepare_pending() -> {key: (request_line dict, info dict)} for pages still to do.
+    save_result(key, text, info, finish_reason) writes one page. Returns the number of pages saved.
+    A state file in work_dir makes the whole thing resumable.
+    """
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    state_path = work_dir / "batch_state.json"
+
+    if state_path.exists():
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+        print(f" Resuming batch job {state['job_name']} ({len(state['pages'])} pages)")
+    else:
+        pending = prepare_pending()
+        if not pending:
+            print(" Batch: nothing to submit.")
+            return 0
+        job_file = work_dir / "batch_requests.jsonl"
+        write_job_file(job_file, [line for line, _info in pending.values()])
+        print(f" Batch: submitting {len(pending)} pages ({job_file.stat().st_size} bytes)")
+        job_name = endpoint.submit(job_file, display_name)
+        state = {"job_name": job_name, "pages": {key: info for key, (_line, info) in pending.items()},
+                 "submitted_at": time.time()}
+        tmp = state_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, state_path)
+        job_file.unlink(missing_ok=True)
+        print(f" Batch job submitted: {job_name}")
+
+    while True:
+        status = endpoint.poll(state["job_name"])
+        print(f" Batch job {state['job_name']}: {status}")
+        if status == SUCCEEDED:
+            break
+        if status == FAILED:
+            # keep the state file: the failure is visible and nothing is resubmitted silently
+            raise RuntimeError(f"Batch job {state['job_name']} failed")
+        time.sleep(poll_interval)
+
+    saved = 0
+    for key, text, error, finish in endpoint.results(state["job_name"]):
+        info = state["pages"].get(key)
+        if info is None:
+            continue
+        if error or not text:
+            print(f" No response for {key}: {error}")
+            continue
+        save_result(key, text, info, finish)
+        saved += 1
+
+    state_path.unlink()
+    print(f" Batch: {saved}/{len(state['pages'])} pages saved")
+    return saved
+
+
+# =========================
+# SELF-TEST (offline, FakeBatchEndpoint)
+# =========================
+def self_test() -> None:
+    """submit, interrupted polling, resume from the state file, then demux by key."""
+    with tempfile.TemporaryDirectory() as tmp:
+        endpoint = FakeBatchEndpoint(Path(tmp) / "endpoint", polls_needed=3,
+                                     responder=lambda key, request: f"answer-{key}")
+        pages = {f"page_{n}": (request_line(f"page_{n}", "prompt", b"img", "image/png"), {"n": n})
+                 for n in (1, 2, 3)}
+        saved = {}
+
+        def save_result(key, text, info, finish):
+            assert finish == "STOP", finish
+            saved[key] = (text, info["n"])
+
+        class Interrupted(Exception):
+            pass
+
+        class InterruptedWhilePolling(FakeBatchEndpoint):
+            # same job store, but the run stops at the first poll, like a Ctrl-C while waiting
+            def poll(self, job_name):
+                raise Interrupted
+
+        try:
+            run_batch(InterruptedWhilePolling(endpoint.root, polls_needed=3), Path(tmp) / "work",
+                      "selftest", lambda: pages, save_result, poll_interval=0)
+        except Interrupted:
+            pass
+        assert (Path(tmp) / "work" / "batch_state.json").exists(), "state file missing after submission"
+
+        def no_resubmission():
+            raise AssertionError("a resumed job must not be prepared again")
+
+        assert run_batch(endpoint, Path(tmp) / "work", "selftest", no_resubmission, save_result,
+                         poll_interval=0) == 3
+        assert saved == {f"page_{n}": (f"answer-page_{n}", n) for n in (1, 2, 3)}, saved
+        assert not (Path(tmp) / "work" / "batch_state.json").exists(), "state file left after completion"
+        assert len(list((Path(tmp) / "endpoint").iterdir())) == 1, "job submitted twice"
+    print("[OK] geminiBatch self-test passed")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["selftest"]:
+        print("Usage: python geminiBatch.py selftest")
+        sys.exit(1)
+    self_test()
@@ -0,0 +1,166 @@
+"""
+Content-addressed cache of Gemini responses, kept outside the directories
+wiped by main.reset_directories.
+
+The key is a SHA-256 over the annotated page image, the style CSV, the prompt
+file, the model name and the upload encoding, so an unchanged page never costs
+a second request. Only complete responses are stored (finish reason STOP and
+valid JSON), so a truncated or unparsable answer is retried on the next run.
+Entries are evicted least-recently-used once the cache exceeds GEMINI_CACHE_MAX_MB,
+checked every EVICT_EVERY stores and when the process exits.
+
+With GEMINI_CACHE_REFRESH=1 in the environment (main.py --force,
+extraction-gemini-vision.py --refresh-cache) lookups miss and every page is
+requested again; the new responses replace the stored ones.
+
+    python geminiCache.py stats
+    python geminiCache.py invalidate <key> [<key> ...]
+    python geminiCache.py clear
+"""
+import atexit
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from config import GEMINI_CACHE_DIR, GEMINI_CACHE_MAX_MB
+
+CACHE_DIR = Path(GEMINI_CACHE_DIR)
+REFRESH_ENV = "GEMINI_CACHE_REFRESH"
+# listing the whole cache costs O(entries): size checked once per EVICT_EVERY stores
+EVICT_EVERY = 50
+
+# counters of the current process, printed at the end of a run (not persisted)
+stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+_stores_since_evict = 0
+_evict_lock = threading.Lock()   # put runs in worker threads (asyncio.to_thread)
+
+
+def cache_key(*parts) -> str:
+    """SHA-256 over length-prefixed parts (str or bytes), so ("ab", "c") != ("a", "bc")."""
+    h = hashlib.sha256()
+    for part in parts:
+        data = part.encode("utf-8") if isinstance(part, str) else bytes(part)
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def refreshing() -> bool:
+    """True when this run ignores stored responses (they are still replaced by new ones)."""
+    return os.environ.get(REFRESH_ENV) == "1"
+
+
+def _entry_path(key: str) -> Path:
+    return CACHE_DIR / key[:2] / f"{key}.txt"
+
+
+def get(key: str):
+    """Stored response text, or None. A hit refreshes the entry's LRU position."""
+    if refreshing():
+        stats["misses"] += 1
+        return None
+    path = _entry_path(key)
+    try:
+        text = path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        stats["misses"] += 1
+        return None
+    now = time.time()
+    os.utime(path, (now, now))
+    stats["hits"] += 1
+    return text
+
+
+def put(key: str, text: str) -> None:
+    global _stores_since_evict
+    path = _entry_path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # unique temp file: two writers of the same key never share it, the last replace wins
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=path.parent, suffix=".tmp",
+                                     delete=False) as f:
+        f.write(text)
+    os.replace(f.name, path)
+    with _evict_lock:
+        stats["stores"] += 1
+        if _stores_since_evict == 0:
+            atexit.register(evict_pending)
+        _stores_since_evict += 1
+        due = _stores_since_evict >= EVICT_EVERY
+    if due:
+        evict_pending()
+
+
+def evict_pending() -> None:
+    """Applies GEMINI_CACHE_MAX_MB if anything was stored since the last check."""
+    global _stores_since_evict
+    with _evict_lock:
+        if not _stores_since_evict:
+            return
+        _stores_since_evict = 0
+        atexit.unregister(evict_pending)
+    evict(GEMINI_CACHE_MAX_MB * 1024 * 1024)
+
+
+def _entries():
+    if not CACHE_DIR.exists():
+        return []
+    return [(p, p.stat()) for p in CACHE_DIR.glob("*/*.txt")]
+
+
+def evict(max_bytes: int) -> int:
+    """Drops least recently used entries until the cache fits in max_bytes."""
+    entries = _entries()
+    total = sum(st.st_size for _p, st in entries)
+    removed = 0
+    for path, st in sorted(entries, key=lambda e: e[1].st_mtime):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= st.st_size
+        removed += 1
+    stats["evictions"] += removed
+    return removed
+
+
+def invalidate(key: str) -> bool:
+    path = _entry_path(key)
+    if path.exists():
+        path.unlink()
+        return True
+    return False
+
+
+def clear() -> int:
+    entries = _entries()
+    for path, _st in entries:
+        path.unlink(missing_ok=True)
+    return len(entries)
+
+
+def summary(run_counters: bool = True) -> str:
+    """Entries and size on disk, plus this process's hit/miss counters when run_counters."""
+    entries = _entries()
+    size_mb = sum(st.st_size for _p, st in entries) / (1024 * 1024)
+    text = f"cache {CACHE_DIR}: {len(entries)} entries, {size_mb:.1f}/{GEMINI_CACHE_MAX_MB} MB"
+    if run_counters:
+        text += (f" | hits={stats['hits']} misses={stats['misses']} stores={stats['stores']} "
+                 f"evictions={stats['evictions']}")
+    return text
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "stats":
+        print(summary(run_counters=False))
+    elif command == "invalidate" and len(sys.argv) > 2:
+        for key in sys.argv[2:]:
+            print(f"[OK] Invalidated {key}" if invalidate(key) else f"[WARN] Not cached: {key}")
+    elif command == "clear":
+        print(f"[OK] Removed {clear()} entries from {CACHE_DIR}")
+    else:
+        print("Usage: python geminiCache.py [stats|invalidate <key>...|clear]")
+        sys.exit(1)
@@ -0,0 +1,127 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from config import IMAGE_PROFILES
+
+# =========================
+# PROFILS DE SORTIE IMAGE
+# =========================
+# format          : "png" | "jpg" | "webp"
+# png_compression : 0 (rapide, gros fichiers) .. 9 (lent, petits fichiers)
+# quality         : qualité JPEG / WebP (0-100)
+# max_long_edge   : réduit l'image si son plus grand côté dépasse cette valeur (None = taille d'origine)
+# crop_margins    : retire les marges sans contenu (pixels proches du blanc), en gardant margin_pad px
+PROFILES = {
+    # archivage : PNG sans perte, compression rapide
+    "archive": {"format": "png", "png_compression": 1, "max_long_edge": None},
+    # archivage compact : PNG sans perte, compression maximale (plus lent)
+    "archive-small": {"format": "png", "png_compression": 9, "max_long_edge": None},
+    # entrée YOLO réduite (opt-in via IMAGE_PROFILES["detect"]) : le modèle travaille en 640 px,
+    # mais la réduction préalable peut décaler les boîtes par rapport à la page entière
+    "detect": {"format": "jpg", "quality": 90, "max_long_edge": 1600},
+    # upload Gemini réduit (opt-in via IMAGE_PROFILES["llm"]) : bord long plafonné, JPEG/WebP.
+    # Moins d'octets et de tokens, mais l'extraction peut changer : à valider sur ses documents.
+    "llm": {"format": "jpg", "quality": 85, "max_long_edge": 2048},
+    "llm-webp": {"format": "webp", "quality": 80, "max_long_edge": 2048},
+    "llm-cropped": {"format": "jpg", "quality": 85, "max_long_edge": 2048, "crop_margins": True, "margin_pad": 24},
+}
+
+# niveau de gris au-dessus duquel un pixel compte comme fond de page
+MARGIN_THRESHOLD = 245
+
+MIME_TYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+
+
+def get_profile(stage: str) -> dict:
+    """Profil configuré pour une étape (config.IMAGE_PROFILES), "archive" par défaut."""
+    name = IMAGE_PROFILES.get(stage, "archive")
+    if name not in PROFILES:
+        raise ValueError(f"Unknown image profile '{name}' for stage '{stage}'")
+    return PROFILES[name]
+
+
+def resize_for_profile(img, profile: dict):
+    """Retourne (image, échelle) ; échelle = taille_sortie / taille_entrée."""
+    max_edge = profile.get("max_long_edge")
+    h, w = img.shape[:2]
+    if not max_edge or max(h, w) <= max_edge:
+        return img, 1.0
+    scale = max_edge / max(h, w)
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA), scale
+
+
+def crop_margins(img, pad: int = 24, threshold: int = MARGIN_THRESHOLD):
+    """Recadre sur la boîte englobante des pixels non blancs (+ pad) ; page vide = inchangée."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    points = cv2.findNonZero((gray < threshold).astype(np.uint8))
+    if points is None:
+        return img
+    x, y, w, h = cv2.boundingRect(points)
+    ih, iw = img.shape[:2]
+    x0, y0 = max(0, x - pad), max(0, y - pad)
+    x1, y1 = min(iw, x + w + pad), min(ih, y + h + pad)
+    return img[y0:y1, x0:x1]
+
+
+def apply_profile(img, profile: dict):
+    """Transformations géométriques du profil : marges puis réduction."""
+    if profile.get("crop_margins"):
+        img = crop_margins(img, profile.get("margin_pad", 24))
+    img, _ = resize_for_profile(img, profile)
+    return img
+
+
+def _encode_params(profile: dict):
+    fmt = profile["format"]
+    if fmt == "png":
+        return [cv2.IMWRITE_PNG_COMPRESSION, profile.get("png_compression", 1)]
+    if fmt == "jpg":
+        return [cv2.IMWRITE_JPEG_QUALITY, profile.get("quality", 90)]
+    if fmt == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, profile.get("quality", 80)]
+    raise ValueError(f"Unsupported image format: {fmt}")
+
+
+def encode_array(img, profile: dict) -> bytes:
+    """Encode en mémoire au format du profil, sans transformation."""
+    ok, buf = cv2.imencode("." + profile["format"], img, _encode_params(profile))
+    if not ok:
+        raise RuntimeError(f"cv2.imencode failed ({profile['format']})")
+    return buf.tobytes()
+
+
+def encode_image(img, profile: dict) -> bytes:
+    """Encode en mémoire selon le profil (marges et réduction comprises)."""
+    return encode_array(apply_profile(img, profile), profile)
+
+
+def write_image(img, path, profile: dict) -> Path:
+    """
+    Écrit l'image selon le profil. L'extension de `path` est remplacée par
+    celle du profil ; retourne le chemin réellement écrit.
+    """
+    path = Path(path).with_suffix("." + profile["format"])
+    img = apply_profile(img, profile)
+    if not cv2.imwrite(str(path), img, _encode_params(profile)):
+        raise RuntimeError(f"cv2.imwrite failed: {path}")
+    return path
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def is_lossless(profile: dict) -> bool:
+    """Profil qui garde tous les pixels : PNG, sans réduction ni recadrage."""
+    return profile["format"] == "png" and not profile.get("max_long_edge") and not profile.get("crop_margins")
+
+
+def png_size(data: bytes):
+    """(largeur, hauteur) lues dans l'en-tête IHDR d'un PNG."""
+    return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+
+
+def mime_type(profile: dict) -> str:
+    return MIME_TYPES[profile["format"]]
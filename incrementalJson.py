@@ -0,0 +1,99 @@
+"""
+Incremental parser for the model's JSON array output, fed chunk by chunk
+while the response is streamed.
+
+Each top-level object of the array is handed to `on_object` as soon as its
+closing brace arrives. Structural garbage (no array, text between or after the
+objects) raises MalformedStream right away, so the request can be aborted and
+retried instead of paying for the rest of a bad generation.
+
+Objects that close but do not parse (the LaTeX backslash errors repaired later
+by postprocessing.py) are only counted in `invalid_objects`; they are not a
+reason to abort.
+"""
+import json
+
+
+class MalformedStream(ValueError):
+    pass
+
+
+class IncrementalArrayParser:
+
+    def __init__(self, on_object=None):
+        self.on_object = on_object
+        self.objects = []
+        self.invalid_objects = 0
+        self._buf = []          # characters of the object being read
+        self._depth = 0         # nesting depth inside the top-level array
+        self._in_string = False
+        self._escape = False
+        self._state = "start"   # start -> array -> done
+        self._prefix = ""       # text before the array (markdown fence)
+
+    def feed(self, chunk: str) -> None:
+        for ch in chunk:
+            self._feed_char(ch)
+
+    def _feed_char(self, ch: str) -> None:
+        if self._state == "start":
+            if ch == "[":
+                self._state = "array"
+                return
+            self._prefix += ch
+            stripped = self._prefix.strip()
+            # only a ```json / ``` fence may precede the array
+            if stripped and not ("```json".startswith(stripped) or stripped.startswith("```")):
+                raise MalformedStream(f"Output does not start with a JSON array: {stripped[:40]!r}")
+            if len(stripped) > 16:
+                raise MalformedStream(f"Unexpected text before the JSON array: {stripped[:40]!r}")
+            return
+
+        if self._state == "done":
+            if not ch.isspace() and ch != "`":
+                raise MalformedStream(f"Unexpected text after the JSON array: {ch!r}")
+            return
+
+        # inside the array
+        if self._depth == 0:
+            if ch.isspace() or ch == ",":
+                return
+            if ch == "]":
+                self._state = "done"
+                return
+            if ch != "{":
+                raise MalformedStream(f"Expected an object in the JSON array, got {ch!r}")
+
+        self._buf.append(ch)
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+            return
+
+        if ch == '"':
+            self._in_string = True
+        elif ch in "{[":
+            self._depth += 1
+        elif ch in "}]":
+            self._depth -= 1
+            if self._depth == 0:
+                self._emit("".join(self._buf))
+                self._buf = []
+
+    def _emit(self, text: str) -> None:
+        try:
+            obj = json.loads(text)
+        except ValueError:
+            self.invalid_objects += 1
+            return
+        self.objects.append(obj)
+        if self.on_object:
+            self.on_object(obj)
+
+    @property
+    def complete(self) -> bool:
+        return self._state == "done"
@@ -1,9 +1,13 @@
+import atexit
 import os
 import shutil
 import subprocess
 import sys
 from pathlib import Path
-from config import STYLE_MODE  # <--- add this
+from config import STYLE_MODE, STYLE_WORKERS, RASTER_WORKERS, RASTER_BACKEND  # <--- add this
+from config import PIPELINE_MODE, PIPELINE_MATERIALIZE, PIPELINE_QUEUE_SIZE
+import geminiCache
+import telemetry
 
 BASE_DIR = Path(__file__).resolve().parent
 
@@ -18,6 +22,12 @@ def reset_directories():
         print(f"[OK] Reset: {dir_path}")
 
 
+def ensure_directories():
+    """Incremental runs: keep previous outputs, the stages' manifests decide what is stale."""
+    for directory in DIRS_TO_RESET:
+        os.makedirs(BASE_DIR / directory, exist_ok=True)
+
+
 def run_script(script_name, *args):
     script_path = BASE_DIR / script_name
 
@@ -27,23 +37,25 @@ def run_script(script_name, *args):
 
     print(f"\n[RUN] Running {script_name}...")
 
-    process = subprocess.Popen(
-        [sys.executable, str(script_path), *map(str, args)],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        encoding="utf-8",
-        errors="replace"
-    )
-
-    for line in iter(process.stdout.readline, ''):
-        if line:
-            print(line, end="")
-        else:
-            break
-
-    process.stdout.close()
-    process.wait()
+    with telemetry.span("stage", script=script_name) as span:
+        process = subprocess.Popen(
+            [sys.executable, str(script_path), *map(str, args)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding="utf-8",
+            errors="replace"
+        )
+
+        for line in iter(process.stdout.readline, ''):
+            if line:
+                print(line, end="")
+            else:
+                break
+
+        process.stdout.close()
+        process.wait()
+        span["returncode"] = process.returncode
 
     if process.returncode == 0:
         print(f"[OK] {script_name} finished successfully")
@@ -75,7 +87,52 @@ if __name__ == "__main__":
         last_page = str(LAST_PAGE)
     # =========================
 
-    reset_directories()
+    # Usage: python main.py [--force]
+    # --force : repart de dossiers vides (tout est recalculé, manifestes compris)
+    #           et redemande chaque page à Gemini (le cache est mis à jour, pas relu)
+    FORCE = "--force" in sys.argv
+    if FORCE:
+        os.environ[geminiCache.REFRESH_ENV] = "1"
+
+    # un identifiant de run hérité par chaque script (events-<pid>.jsonl fusionnés à la fin)
+    telemetry.run_id()
+    atexit.register(telemetry.finish_run)
+
+    if FORCE or PIPELINE_MODE != "subprocess":
+        # les modes en processus passent les pages en mémoire : pas de manifestes
+        reset_directories()
+    else:
+        ensure_directories()
+
+    if PIPELINE_MODE == "streaming":
+        from pipeline import run_streaming
+
+        run_streaming(
+            pdf_path,
+            None if ALL_PAGES else FIRST_PAGE,
+            None if ALL_PAGES else LAST_PAGE,
+            BASE_DIR,
+            materialize=PIPELINE_MATERIALIZE,
+            postprocess=STYLE_MODE,
+            queue_size=PIPELINE_QUEUE_SIZE
+        )
+        print("\n[DONE] All tasks completed successfully!")
+        sys.exit(0)
+
+    if PIPELINE_MODE == "inprocess":
+        from pipeline import STAGE_MODULES, run_pipeline
+
+        stages = STAGE_MODULES if STYLE_MODE else [m for m in STAGE_MODULES if m != "postprocessing"]
+        run_pipeline(
+            pdf_path,
+            None if ALL_PAGES else FIRST_PAGE,
+            None if ALL_PAGES else LAST_PAGE,
+            BASE_DIR,
+            materialize=PIPELINE_MATERIALIZE,
+            stages=stages
+        )
+        print("\n[DONE] All tasks completed successfully!")
+        sys.exit(0)
 
     # PDF -> images (Ghostscript)
     run_script(
@@ -84,7 +141,11 @@ if __name__ == "__main__":
         BASE_DIR / "files",
         all_flag,
         first_page,
-        last_page
+        last_page,
+        "--workers",
+        RASTER_WORKERS,
+        "--backend",
+        RASTER_BACKEND
     )
 
     # PDF -> CSV style/texte (PyMuPDF)
@@ -94,13 +155,15 @@ if __name__ == "__main__":
         BASE_DIR / "files_style",
         all_flag,
         first_page,
-        last_page
+        last_page,
+        "--workers",
+        STYLE_WORKERS
     )
 
 
     run_script("detectImages.py")
-    run_script("cropImages.py")
-    run_script("drawBoxes.py")
+    # découpe + annotation : une seule lecture de chaque page (= cropImages.py puis drawBoxes.py)
+    run_script("cropAndDraw.py")
     run_script("extraction-gemini-vision.py")
 
     if STYLE_MODE==True :
@@ -0,0 +1,109 @@
+"""
+Per-stage build manifests for incremental reruns of main.py.
+
+Each stage keeps, next to its outputs, a manifest mapping every page to the
+digest of what it was built from (input file contents + stage parameters) and
+the files it wrote. A page is rebuilt only when that digest changed or one of
+its outputs is missing, the way make compares a target with its prerequisites.
+`python main.py --force` wipes the directories (and the manifests with them).
+
+Only the file mode (PIPELINE_MODE = "subprocess") uses manifests: the in-process
+modes hand pages over in memory and start from clean directories.
+
+    python manifest.py <output_dir> [<output_dir> ...]   # pages recorded per stage
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+
+# (path, size, mtime_ns) -> sha256: the PDF and model weights are hashed once per process
+_digests = {}
+
+
+def file_digest(path) -> str:
+    st = os.stat(path)
+    key = (str(path), st.st_size, st.st_mtime_ns)
+    if key not in _digests:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def inputs_digest(*parts) -> str:
+    """SHA-256 over length-prefixed parts: Path = file contents, str/bytes as is, anything else repr()."""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, Path):
+            data = file_digest(part).encode("ascii")
+        elif isinstance(part, (bytes, bytearray)):
+            data = bytes(part)
+        else:
+            data = (part if isinstance(part, str) else repr(part)).encode("utf-8")
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+class Manifest:
+    """{page: {"inputs": digest, "outputs": [paths]}} of one stage, stored in its output directory."""
+
+    def __init__(self, output_dir, stage: str):
+        self.path = Path(output_dir) / f".manifest-{stage}"
+        self.stage = stage
+        self._lock = threading.Lock()   # save_response runs in worker threads
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.pages = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.pages = {}
+
+    def is_fresh(self, page, digest: str) -> bool:
+        entry = self.pages.get(str(page))
+        return (entry is not None and entry["inputs"] == digest
+                and all(os.path.exists(p) for p in entry["outputs"]))
+
+    def record(self, page, digest: str, outputs) -> None:
+        with self._lock:
+            self.pages[str(page)] = {"inputs": digest, "outputs": [str(p) for p in outputs]}
+
+    def invalidate(self, page) -> None:
+        """Deletes the recorded outputs of a page about to be rebuilt (or gone upstream)."""
+        with self._lock:
+            entry = self.pages.pop(str(page), None)
+        for p in (entry or {}).get("outputs", []):
+            Path(p).unlink(missing_ok=True)
+
+    def prune(self, current_pages) -> int:
+        """Drops pages whose input disappeared upstream, with their outputs."""
+        current = {str(p) for p in current_pages}
+        gone = [page for page in list(self.pages) if page not in current]
+        for page in gone:
+            self.invalidate(page)
+        return len(gone)
+
+    def save(self) -> None:
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.pages, f, ensure_ascii=False, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    def report(self, total: int, stale: int) -> None:
+        print(f"[OK] {self.stage}: {total - stale}/{total} pages up to date, {stale} to rebuild")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python manifest.py <output_dir> [<output_dir> ...]")
+        sys.exit(1)
+    for directory in sys.argv[1:]:
+        for path in sorted(Path(directory).glob(".manifest-*")):
+            m = Manifest(directory, path.name[len(".manifest-"):])
+            print(f"{path}: {len(m.pages)} pages")
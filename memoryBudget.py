@@ -0,0 +1,72 @@
+"""
+Mode basse mémoire pour les très gros PDF (config.LOW_MEMORY).
+
+PdfPages ouvre le PDF pour pdfToTxtStyle / pdfToImages et suit le RSS page par
+page : tous les DOC_REOPEN_EVERY pages, ou dès que le RSS dépasse
+MEMORY_BUDGET_MB (budget par processus), le store MuPDF (polices, images
+décodées, objets du xref) est vidé et le document rouvert, ce qui borne la
+croissance des caches sur un manuel de 500+ pages. Chaque page est rapportée
+([MEM] et jauge "memory.rss_mb" de la télémétrie).
+
+Hors mode basse mémoire, PdfPages se comporte comme fitz.open().
+"""
+import gc
+
+import fitz
+
+import telemetry
+from config import DOC_REOPEN_EVERY, LOW_MEMORY, MEMORY_BUDGET_MB
+
+
+class PdfPages:
+    """fitz.Document (attribut doc) rouvert au besoin ; appeler page_done() après chaque page."""
+
+    def __init__(self, pdf_path, low_memory=LOW_MEMORY, budget_mb=MEMORY_BUDGET_MB,
+                 reopen_every=DOC_REOPEN_EVERY, label=""):
+        self.pdf_path = str(pdf_path)
+        self.low_memory = low_memory
+        self.budget_mb = budget_mb
+        self.reopen_every = reopen_every
+        self.label = label
+        self.doc = fitz.open(self.pdf_path)
+        self._since_reopen = 0
+        self._warned = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.doc)
+
+    def close(self) -> None:
+        self.doc.close()
+
+    def reopen(self) -> None:
+        """Vide le store MuPDF et rouvre le document (les objets Page en cours deviennent invalides)."""
+        self.doc.close()
+        fitz.TOOLS.store_shrink(100)
+        gc.collect()
+        self.doc = fitz.open(self.pdf_path)
+        self._since_reopen = 0
+
+    def page_done(self, page_num) -> None:
+        if not self.low_memory:
+            return
+        self._since_reopen += 1
+        rss = telemetry.current_rss_mb()
+        over_budget = rss is not None and self.budget_mb and rss > self.budget_mb
+        note = ""
+        if over_budget or (self.reopen_every and self._since_reopen >= self.reopen_every):
+            self.reopen()
+            after = telemetry.current_rss_mb()
+            note = f" -> {after:.0f} MB après réouverture" if after is not None else " (rouvert)"
+            if over_budget and after is not None and after > self.budget_mb and not self._warned:
+                self._warned = True
+                print(f"[WARN] {self.label or self.pdf_path} : {after:.0f} MB après réouverture, au-delà du "
+                      f"budget de {self.budget_mb} MB (baisser le DPI ou le nombre de workers)", flush=True)
+        if rss is not None:
+            print(f"[MEM] {self.label + ' ' if self.label else ''}page {page_num} : {rss:.0f} MB{note}", flush=True)
+            telemetry.gauge("memory.rss_mb", rss, page=page_num)
@@ -1,17 +1,252 @@
+import math
 import os
+import re
+import shutil
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import telemetry
+from cliOptions import pop_option
+from telemetry import peak_rss_mb
+
+GS = "gswin64c" if os.name == "nt" else "gs"
+GS_BAND_BUFFER = 16 * 1024 * 1024   # octets par bande Ghostscript en mode basse mémoire
+
+_print_lock = threading.Lock()
+
+
+def log(*args):
+    with _print_lock:
+        print(*args, flush=True)
+
+
+def count_pdf_pages(pdf_path):
+    """Nombre de pages du PDF (PyMuPDF si disponible, sinon Ghostscript)."""
+    try:
+        import fitz
+    except ImportError:
+        fitz = None
+
+    if fitz is not None:
+        with fitz.open(str(pdf_path)) as doc:
+            return len(doc)
+
+    ps_path = str(Path(pdf_path).resolve()).replace("\\", "/")
+    out = subprocess.run(
+        [GS, "-q", "-dNODISPLAY", "-dNOSAFER", "-dBATCH", "-dNOPAUSE",
+         "-c", f"({ps_path}) (r) file runpdfbegin pdfpagecount = quit"],
+        check=True, capture_output=True, text=True,
+    )
+    return int(out.stdout.strip().splitlines()[-1])
+
+
+def gs_memory_args():
+    """
+    Mode basse mémoire (config.LOW_MEMORY) : Ghostscript rend la page par bandes
+    de GS_BAND_BUFFER octets au lieu de garder le bitmap 450 DPI entier.
+    """
+    from config import LOW_MEMORY
+
+    if not LOW_MEMORY:
+        return []
+    return [f"-dMaxBitmap={GS_BAND_BUFFER}", f"-dBufferSpace={GS_BAND_BUFFER}"]
+
+
+def split_page_range(first_page, last_page, chunks):
+    """[(first, last), ...] : `chunks` tranches contiguës couvrant first..last ([] si la plage est vide)."""
+    total = last_page - first_page + 1
+    if total <= 0:
+        return []
+    size = math.ceil(total / max(1, min(chunks, total)))
+    return [(start, min(start + size - 1, last_page))
+            for start in range(first_page, last_page + 1, size)]
+
+
+def render_chunk(pdf_path, output_folder, first_page, last_page, dpi=450, render_threads=None,
+                 on_page=None):
+    """
+    Rasterise first..last (1-based, inclus) avec un Ghostscript dédié.
+    Chaque page est renommée en page_N.png dès que Ghostscript passe à la
+    suivante (lignes "Page N" sur stdout), d'où une progression page par page ;
+    on_page(page_num, path) est alors appelé.
+    """
+    output_folder = Path(output_folder)
+    tmp_dir = output_folder / f".gs-{first_page}-{last_page}"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    cmd = [
+        GS,
+        "-dSAFER",
+        "-dBATCH",
+        "-dNOPAUSE",
+        "-dTextAlphaBits=4",
+        "-dGraphicsAlphaBits=4",
+        "-sDEVICE=png16m",
+        f"-r{dpi}",
+        f"-dFirstPage={first_page}",
+        f"-dLastPage={last_page}",
+        *gs_memory_args(),
+        "-sOutputFile=" + str(tmp_dir / "tmp-%03d.png"),
+    ]
+    if render_threads:
+        cmd.append(f"-dNumRenderingThreads={render_threads}")
+    cmd.append(str(pdf_path))
+
+    # durée d'une page = entre deux lignes "Page N" de Ghostscript
+    page_start = [time.time()]
+
+    def finish(index):
+        tmp_file = tmp_dir / f"tmp-{index:03d}.png"
+        if tmp_file.exists():
+            new_file = output_folder / f"page_{first_page + index - 1}.png"
+            os.replace(tmp_file, new_file)
+            log(f"[OK] {new_file.name}")
+            now = time.time()
+            telemetry.emit_span("raster.page", page_start[0], now - page_start[0], backend="gs",
+                                page=first_page + index - 1, bytes_written=new_file.stat().st_size)
+            page_start[0] = now
+            if on_page is not None:
+                on_page(first_page + index - 1, new_file)
+
+    with telemetry.span("raster.chunk", first=first_page, last=last_page, dpi=dpi):
+        index = 0
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   text=True, errors="replace")
+        try:
+            for line in iter(process.stdout.readline, ''):
+                if re.match(r"^Page \d+", line):
+                    if index:
+                        finish(index)
+                    index += 1
+        except BaseException:
+            # on_page a échoué (pipeline interrompu) : ne pas laisser Ghostscript tourner
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            process.wait()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+
+        if index:
+            finish(index)
+    if gs_memory_args():
+        peak = peak_rss_mb()
+        if peak is not None:
+            log(f"[MEM] pages {first_page}-{last_page} : pic {peak:.0f} MB (Ghostscript compris)")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def pdf_to_images_parallel(pdf_path, output_folder, dpi=450, all_pages=True,
+                           first_page=None, last_page=None, workers=4, render_threads=None):
+    """Découpe la plage en `workers` tranches, un Ghostscript par tranche en parallèle."""
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    if all_pages:
+        first_page, last_page = 1, count_pdf_pages(pdf_path)
+    elif first_page is None or last_page is None:
+        raise ValueError("first_page and last_page must be set when all_pages is False")
+
+    chunks = split_page_range(first_page, last_page, workers)
+    if not chunks:
+        log(f"[WARN] Plage vide : pages {first_page} > {last_page}")
+        return
+    log(f"[RUN] Ghostscript x{len(chunks)} : " + ", ".join(f"{a}-{b}" for a, b in chunks))
+
+    with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+        futures = [pool.submit(render_chunk, pdf_path, output_folder, a, b, dpi, render_threads)
+                   for a, b in chunks]
+        for fut in futures:
+            fut.result()
+
+    print("\n[OK] Done! Images saved in:", output_folder.resolve())
+
+
+def page_array(doc, page_num, dpi=450, bgr=True):
+    """Page page_num (1-based) d'un fitz.Document déjà ouvert : ndarray HxWx3 uint8."""
+    import fitz
+    import numpy as np
+
+    with telemetry.span("raster.page", backend="fitz", page=page_num, dpi=dpi):
+        pix = doc[page_num - 1].get_pixmap(dpi=dpi, alpha=False, colorspace=fitz.csRGB)
+        # vue sur le pixmap (samples_mv) : une seule copie, pas deux, d'une page 450 DPI
+        view = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+        img = view[:, :, ::-1].copy() if bgr else view.copy()
+        del view, pix
+        return img
+
+
+def iter_page_arrays(pdf_path, first_page=None, last_page=None, dpi=450, bgr=True):
+    """
+    Rasterise en mémoire avec PyMuPDF : yield (page_num, ndarray HxWx3 uint8).
+    bgr=True donne l'ordre des canaux attendu par cv2 (detect/crop/draw).
+    """
+    from memoryBudget import PdfPages
+
+    # PdfPages : en mode basse mémoire, caches MuPDF vidés et RSS rapporté page par page
+    with PdfPages(pdf_path) as pages:
+        first_page = first_page or 1
+        last_page = min(last_page or len(pages), len(pages))
+        for page_num in range(first_page, last_page + 1):
+            yield page_num, page_array(pages.doc, page_num, dpi, bgr)
+            pages.page_done(page_num)
+
+
+def pdf_to_images_fitz(pdf_path, output_folder, dpi=450,
+                       all_pages=True, first_page=None, last_page=None):
+    """
+    Backend PyMuPDF (sans Ghostscript ni sous-processus).
+    Les PNG suivent le profil "pages" de config.IMAGE_PROFILES.
+    Pour les pages en mémoire sans PNG : iter_page_arrays.
+    """
+    from imageProfiles import get_profile, write_image
+
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    if all_pages:
+        first_page, last_page = 1, None
+    elif first_page is None or last_page is None:
+        raise ValueError("first_page and last_page must be set when all_pages is False")
+
+    profile = get_profile("pages")
+    if profile["format"] != "png":
+        raise ValueError("The 'pages' image profile must be PNG (files/ is read as page_N.png)")
+
+    print(f"[RUN] PyMuPDF : pages {first_page} > {last_page or 'fin'} @ {dpi} dpi")
+    for page_num, img in iter_page_arrays(pdf_path, first_page, last_page, dpi=dpi):
+        out_file = write_image(img, output_folder / f"page_{page_num}.png", profile)
+        telemetry.count("raster.bytes_written", out_file.stat().st_size)
+        print(f"[OK] {out_file.name}")
+
+    print("\n[OK] Done! Images saved in:", output_folder.resolve())
+
 
 def pdf_to_images_best_quality(pdf_path, output_folder, dpi=450,
-                               all_pages=True, first_page=None, last_page=None):
+                               all_pages=True, first_page=None, last_page=None,
+                               workers=1, render_threads=None, backend="gs"):
+    if backend == "fitz":
+        return pdf_to_images_fitz(pdf_path, output_folder, dpi=dpi, all_pages=all_pages,
+                                  first_page=first_page, last_page=last_page)
+    if backend != "gs":
+        raise ValueError(f"Unknown backend: {backend} (expected 'gs' or 'fitz')")
+
+    if workers > 1:
+        return pdf_to_images_parallel(pdf_path, output_folder, dpi=dpi, all_pages=all_pages,
+                                      first_page=first_page, last_page=last_page,
+                                      workers=workers, render_threads=render_threads)
+
     pdf_path = Path(pdf_path)
     output_folder = Path(output_folder)
     output_folder.mkdir(parents=True, exist_ok=True)
 
     device = "png16m"   # 24-bit PNG
-    gs = "gswin64c" if os.name == "nt" else "gs"
+    gs = GS
 
     # On génère d'abord des fichiers temporaires : tmp-001.png, tmp-002.png, ...
     tmp_pattern = str(output_folder / "tmp-%03d.png")
@@ -25,8 +260,11 @@ def pdf_to_images_best_quality(pdf_path, output_folder, dpi=450,
         "-dGraphicsAlphaBits=4",
         "-sDEVICE=" + device,
         f"-r{dpi}",
+        *gs_memory_args(),
         "-sOutputFile=" + tmp_pattern,
     ]
+    if render_threads:
+        cmd.append(f"-dNumRenderingThreads={render_threads}")
 
     if not all_pages:
         if first_page is None or last_page is None:
@@ -39,7 +277,8 @@ def pdf_to_images_best_quality(pdf_path, output_folder, dpi=450,
     print("[RUN] Ghostscript command:")
     print(" ".join(map(str, cmd)))
 
-    subprocess.run(cmd, check=True)
+    with telemetry.span("raster.chunk", first=first_page, last=last_page, dpi=dpi):
+        subprocess.run(cmd, check=True)
 
     # Renommage : tmp-001.png -> page_X.png
     # Si all_pages=True : on commence à 1 -> page_1.png, page_2.png, ...
@@ -64,15 +303,156 @@ def pdf_to_images_best_quality(pdf_path, output_folder, dpi=450,
     print("\n[OK] Done! Images saved in:", output_folder.resolve())
 
 
+# =========================
+# ÉTAPE DU PIPELINE EN PROCESSUS (pipeline.py)
+# =========================
+STAGE_INPUTS = ("pdf",)
+STAGE_OUTPUTS = ("page_image",)
+
+
+def render_pages(pdf_path, output_folder, first_page, last_page, on_page, dpi=450,
+                 workers=1, backend="gs", save_png=True):
+    """
+    Appelle on_page(page_num, ndarray BGR) pour chaque page dès qu'elle est rendue
+    (ordre non garanti avec plusieurs Ghostscript).
+    Backend "fitz" : rendu en mémoire, page_N.png écrit seulement si save_png.
+    Backend "gs"   : Ghostscript écrit toujours page_N.png, relu une fois.
+    """
+    import cv2
+    from imageProfiles import get_profile, write_image
+
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    if backend == "fitz":
+        profile = get_profile("pages")
+        log(f"[RUN] PyMuPDF : pages {first_page} > {last_page} @ {dpi} dpi")
+        for page_num, img in iter_page_arrays(pdf_path, first_page, last_page, dpi=dpi):
+            if save_png:
+                out_file = write_image(img, output_folder / f"page_{page_num}.png", profile)
+                telemetry.count("raster.bytes_written", out_file.stat().st_size)
+            on_page(page_num, img)
+        return
+    if backend != "gs":
+        raise ValueError(f"Unknown backend: {backend} (expected 'gs' or 'fitz')")
+
+    def read_page(page_num, path):
+        img = cv2.imread(str(path))
+        if img is None:
+            log(f"[WARN] Page non rendue : {path.name}")
+            return
+        on_page(page_num, img)
+
+    chunks = split_page_range(first_page, last_page, workers)
+    if not chunks:
+        log(f"[WARN] Plage vide : pages {first_page} > {last_page}")
+        return
+    log(f"[RUN] Ghostscript x{len(chunks)} : " + ", ".join(f"{a}-{b}" for a, b in chunks))
+    with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+        futures = [pool.submit(render_chunk, pdf_path, output_folder, a, b, dpi, None, read_page)
+                   for a, b in chunks]
+        for fut in futures:
+            fut.result()
+
+
+class PageImage:
+    """
+    Référence légère vers une page : load() relit files/page_N.png, ou re-rend
+    la page avec PyMuPDF quand aucun PNG n'est écrit. Un tableau 450 DPI pèse
+    ~58 MB (A4) : ctx n'en garde aucun, chaque étape recharge la page traitée.
+    """
+
+    def __init__(self, pdf_path, page_num, dpi=450, path=None):
+        self.pdf_path = Path(pdf_path)
+        self.page_num = page_num
+        self.dpi = dpi
+        self.path = Path(path) if path is not None else None
+
+    def load(self):
+        """ndarray BGR HxWx3 uint8 de la page."""
+        if self.path is not None:
+            import cv2
+
+            img = cv2.imread(str(self.path))
+            if img is None:
+                raise RuntimeError(f"Could not read {self.path}")
+            return img
+        import fitz
+
+        with fitz.open(str(self.pdf_path)) as doc:
+            return page_array(doc, self.page_num, self.dpi)
+
+
+def stage(ctx):
+    """
+    Une PageImage par page pour les étapes suivantes. Ghostscript (ou PyMuPDF
+    avec materialize) écrit files/page_N.png ; PyMuPDF sans materialize ne
+    rend rien ici, les pages sont rendues à la demande.
+    """
+    from config import RASTER_BACKEND, RASTER_WORKERS
+
+    use_files = RASTER_BACKEND == "gs" or ctx.materialize
+    files = ctx.dir("files") if use_files else None
+    if use_files:
+        pdf_to_images_best_quality(ctx.pdf_path, files, dpi=ctx.dpi, all_pages=False,
+                                   first_page=ctx.page_nums[0], last_page=ctx.page_nums[-1],
+                                   workers=RASTER_WORKERS, backend=RASTER_BACKEND)
+    for page_num in ctx.page_nums:
+        path = files / f"page_{page_num}.png" if use_files else None
+        if path is not None and not path.exists():
+            log(f"[WARN] Page non rendue : {path.name}")
+            continue
+        ctx.put(page_num, "page_image", PageImage(ctx.pdf_path, page_num, ctx.dpi, path))
+
+
+def benchmark_backends(pdf_path, first_page, last_page, dpi=450, backends=("gs", "fitz")):
+    """
+    Compare les backends (temps, pic de RSS). Chaque backend tourne dans un
+    processus neuf pour que les pics de mémoire ne se mélangent pas.
+    """
+    import tempfile
+    import time
+
+    results = []
+    for backend in backends:
+        with tempfile.TemporaryDirectory() as tmp:
+            cmd = [sys.executable, str(Path(__file__).resolve()), str(pdf_path), tmp,
+                   "false", str(first_page), str(last_page), str(dpi),
+                   "--backend", backend, "--report-rss", "true"]
+            t0 = time.perf_counter()
+            out = subprocess.run(cmd, capture_output=True, text=True, errors="replace")
+            elapsed = time.perf_counter() - t0
+            if out.returncode != 0:
+                print(f"[ERR] {backend} failed:\n{out.stdout}{out.stderr}")
+                continue
+            rss = re.findall(r"^\[RSS\] peak_mb=(\S+)", out.stdout, re.MULTILINE)
+            results.append((backend, elapsed, rss[-1] if rss else "n/a"))
+
+    n_pages = last_page - first_page + 1
+    print(f"\n[BENCH] {pdf_path} pages {first_page}-{last_page} @ {dpi} dpi")
+    for backend, elapsed, rss in results:
+        print(f"  {backend:5s}  {elapsed:8.2f}s  {n_pages / elapsed:6.2f} pages/s  peak RSS {rss} MB")
+    return results
+
+
 if __name__ == "__main__":
     # Usage: python pdfToImages.py <pdf_path> <output_folder> <all(true|false)> [first_page] [last_page] [dpi]
-    if len(sys.argv) < 4:
-        print("Usage: python pdfToImages.py <pdf_path> <output_folder> <all(true|false)> [first_page] [last_page] [dpi]")
+    #                              [--workers N] [--threads N] [--backend gs|fitz] [--benchmark true]
+    argv = list(sys.argv)
+    workers = int(pop_option(argv, "--workers", 1))
+    render_threads = pop_option(argv, "--threads")
+    render_threads = int(render_threads) if render_threads else None
+    backend = pop_option(argv, "--backend", "gs")
+    benchmark = pop_option(argv, "--benchmark", "false").lower() == "true"
+    report_rss = pop_option(argv, "--report-rss", "false").lower() == "true"
+    if len(argv) < 4:
+        print("Usage: python pdfToImages.py <pdf_path> <output_folder> <all(true|false)> [first_page] [last_page] [dpi] "
+              "[--workers N] [--threads N] [--backend gs|fitz] [--benchmark true]")
         sys.exit(1)
 
-    pdf_path = sys.argv[1]
-    output_folder = sys.argv[2]
-    all_flag = sys.argv[3].lower().strip()
+    pdf_path = argv[1]
+    output_folder = argv[2]
+    all_flag = argv[3].lower().strip()
 
     if all_flag == "true" or all_flag == "":
         all_pages = True
@@ -80,19 +460,61 @@ if __name__ == "__main__":
         last_page = None
     else:
         all_pages = False
-        if len(sys.argv) < 6:
+        if len(argv) < 6:
             print("Error: need first_page and last_page when all_flag is false")
             sys.exit(1)
-        first_page = int(sys.argv[4])
-        last_page = int(sys.argv[5])
-
-    dpi = int(sys.argv[6]) if len(sys.argv) >= 7 else 450
-
-    pdf_to_images_best_quality(
-        pdf_path,
-        output_folder,
-        dpi=dpi,
-        all_pages=all_pages,
-        first_page=first_page,
-        last_page=last_page,
-    )
+        first_page = int(argv[4])
+        last_page = int(argv[5])
+
+    dpi = int(argv[6]) if len(argv) >= 7 and argv[6] else 450
+
+    if benchmark:
+        if all_pages:
+            first_page, last_page = 1, count_pdf_pages(pdf_path)
+        benchmark_backends(pdf_path, first_page, last_page, dpi=dpi)
+        sys.exit(0)
+
+    # Reconstruction incrémentale : seules les pages dont le PDF ou les
+    # paramètres de rendu ont changé (ou dont le PNG manque) sont rendues.
+    from manifest import Manifest, inputs_digest
+
+    if all_pages:
+        first_page, last_page = 1, count_pdf_pages(pdf_path)
+    render_params = (dpi, backend)
+    if backend == "fitz":
+        from imageProfiles import get_profile
+        render_params += (sorted(get_profile("pages").items()),)
+
+    manifest = Manifest(output_folder, "pages")
+    digests = {n: inputs_digest(Path(pdf_path), n, render_params) for n in range(first_page, last_page + 1)}
+    # pages hors de la plage (FIRST_PAGE / LAST_PAGE resserrés) : PNG supprimés, sinon
+    # detectImages et l'extraction les traiteraient encore
+    pruned = manifest.prune(digests)
+    if pruned:
+        print(f"[OK] pages: {pruned} pages hors plage supprimées")
+    stale = [n for n, digest in digests.items() if not manifest.is_fresh(n, digest)]
+    manifest.report(len(digests), len(stale))
+
+    if stale:
+        # Ghostscript rend des plages : on couvre la plus petite plage contenant les pages à refaire
+        first_stale, last_stale = min(stale), max(stale)
+        pdf_to_images_best_quality(
+            pdf_path,
+            output_folder,
+            dpi=dpi,
+            all_pages=False,
+            first_page=first_stale,
+            last_page=last_stale,
+            workers=workers,
+            render_threads=render_threads,
+            backend=backend,
+        )
+        for n in range(first_stale, last_stale + 1):
+            out_file = Path(output_folder) / f"page_{n}.png"
+            if out_file.exists():
+                manifest.record(n, digests[n], [out_file])
+    manifest.save()
+
+    if report_rss:
+        peak = peak_rss_mb()
+        print(f"[RSS] peak_mb={peak:.1f}" if peak is not None else "[RSS] peak_mb=n/a")
@@ -1,16 +1,42 @@
 # pip install pymupdf
 import fitz
 import csv
+import math
+import os
 import re
 import sys
 import glob
+import io
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
-from typing import Iterable, Tuple
+from typing import Iterable, List, Optional, Tuple
+
+import telemetry
+from config import STYLE_OUTPUT
+from manifest import Manifest, inputs_digest
+from memoryBudget import PdfPages
+from cliOptions import pop_option
+
+
+# Taille des caches de normalisation (polices / couleurs distinctes).
+STYLE_CACHE_SIZE = 4096
+
+# Extraction texte seule : sans TEXT_PRESERVE_IMAGES, MuPDF ne décode pas les images
+# (les blocs image étaient de toute façon ignorés). Mêmes drapeaux que "words" :
+# une seule TextPage sert aux deux extractions.
+TEXT_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+
+@lru_cache(maxsize=STYLE_CACHE_SIZE)
+def _hex_from_int(c: int) -> str:
+    return f"#{c:06x}"
 
 
 def to_hex_color(c):
     if isinstance(c, int):
-        return f"#{c:06x}"
+        return _hex_from_int(c)
     if isinstance(c, (tuple, list)) and len(c) >= 3:
         vals = []
         for x in c[:3]:
@@ -30,6 +56,7 @@ STYLE_PATTERNS = [
 ITALIC_PATTERNS = ["italic", "oblique"]
 
 
+@lru_cache(maxsize=STYLE_CACHE_SIZE)
 def normalize_style(fontname: str) -> Tuple[str, str]:
     base = re.sub(r"^[A-Z]{6}\+", "", fontname or "")
     parts = base.split("-")
@@ -53,114 +80,388 @@ def rect_intersection_area(a, b):
     return max(0, x1 - x0) * max(0, y1 - y0)
 
 
-def style_for_word_from_spans(word_bbox, spans):
-    best = None
-    best_area = 0.0
-    for s in spans:
-        area = rect_intersection_area(word_bbox, s["bbox"])
-        if area > best_area:
-            best_area = area
-            fam, style = normalize_style(s.get("font", ""))
-            size = float(s.get("size", 0.0))
-            color_hex = to_hex_color(s.get("color", 0))
-            best = (fam, style, size, color_hex)
-    return best or ("", "regular", 0.0, "#000000")
-
-
-def weighted_dominant_style(spans):
-    weights = {}
-    for s in spans:
-        fam, tag = normalize_style(s.get("font", ""))
-        size = float(s.get("size", 0.0))
-        col = to_hex_color(s.get("color", 0))
-        key = (fam, tag, size, col)
-        weights[key] = weights.get(key, 0) + max(1, len(s.get("text", "")))
-    return max(weights.items(), key=lambda kv: kv[1])[0]
-
-
-def export_phrase_compact_from_doc(doc: fitz.Document, out_csv: str, pages: Iterable[int]):
-    page_indexes = pages
+DEFAULT_STYLE = ("", "regular", 0.0, "#000000")
+
+
+def styles_differ(a, b) -> bool:
+    fam_a, tag_a, size_a, col_a = a
+    fam_b, tag_b, size_b, col_b = b
+    return (fam_a != fam_b) or (tag_a != tag_b) or abs(size_a - size_b) > 1e-6 or (col_a.lower() != col_b.lower())
+
+
+class StyleTable:
+    """
+    Interning des styles d'un document : chaque (famille, style, taille, couleur)
+    reçoit un petit id entier, partagé par tous les spans qui le portent.
+    Les clés brutes (police, taille, couleur) sont mises en cache, avec une borne.
+    """
+
+    def __init__(self, max_raw_keys: int = STYLE_CACHE_SIZE):
+        self.styles = []
+        self._ids = {}
+        self._raw = {}
+        self._max_raw_keys = max_raw_keys
+
+    def intern_style(self, style) -> int:
+        sid = self._ids.get(style)
+        if sid is None:
+            sid = len(self.styles)
+            self._ids[style] = sid
+            self.styles.append(style)
+        return sid
+
+    def intern(self, font, size, color) -> int:
+        raw_key = (font, size, tuple(color) if isinstance(color, list) else color)
+        sid = self._raw.get(raw_key)
+        if sid is None:
+            fam, tag = normalize_style(font)
+            sid = self.intern_style((fam, tag, float(size), to_hex_color(color)))
+            if len(self._raw) >= self._max_raw_keys:
+                self._raw.clear()
+            self._raw[raw_key] = sid
+        return sid
+
+
+# Hauteur (en points PDF) des tranches horizontales de l'index des mots.
+WORD_BUCKET_HEIGHT = 12.0
+# Nombre de tranches de pages par worker en mode --workers.
+CHUNKS_PER_WORKER = 4
+# Au-delà de ce nombre de tranches, une bbox est traitée comme "partout".
+MAX_BUCKET_SPAN = 1024
+
+
+def _bucket_range(y0, y1, bucket_height):
+    if not (math.isfinite(y0) and math.isfinite(y1)):
+        return None
+    first, last = math.floor(y0 / bucket_height), math.floor(y1 / bucket_height)
+    if last - first > MAX_BUCKET_SPAN:
+        return None
+    return range(first, last + 1)
+
+
+def build_word_index(words, bucket_height: float = WORD_BUCKET_HEIGHT):
+    """
+    Index spatial des mots d'une page : chaque mot est rangé dans toutes les
+    tranches horizontales que couvre sa bbox. Les bbox non finies ou géantes
+    sont gardées à part et toujours proposées comme candidates.
+    """
+    buckets = {}
+    always = []
+    for i, (_wx0, wy0, _wx1, wy1, *_rest) in enumerate(words):
+        span = _bucket_range(wy0, wy1, bucket_height)
+        if span is None:
+            always.append(i)
+            continue
+        for b in span:
+            buckets.setdefault(b, []).append(i)
+    return buckets, always, bucket_height
+
+
+def words_in_rect(index, rect):
+    """
+    Indices (ordre de la page) des mots candidats pour `rect`.
+    Sur-ensemble de ceux dont l'intersection avec `rect` est non vide.
+    """
+    buckets, always, bucket_height = index
+    _x0, y0, _x1, y1 = rect
+    span = _bucket_range(y0, y1, bucket_height)
+    if span is None:
+        return sorted({i for ids in buckets.values() for i in ids}.union(always))
+    found = set(always)
+    for b in span:
+        found.update(buckets.get(b, ()))
+    return sorted(found)
+
+
+def page_lines(page: fitz.Page, styles: Optional[StyleTable] = None):
+    """
+    Lignes d'une page : [(phrase, style dominant, bbox, overrides)], avec
+    overrides = [(mot, bbox, style)] et style = (famille, tag, taille, couleur).
+    Les mots et les spans ne sont extraits qu'une fois par page ; les styles
+    sont comparés par id via `styles` (une table par document).
+    Source commune du CSV (page_rows) et du store colonnaire (styleStore.py).
+    """
+    if styles is None:
+        styles = StyleTable()
+    table = styles.styles
+    default_sid = styles.intern_style(DEFAULT_STYLE)
+
+    lines = []
+    textpage = page.get_textpage(flags=TEXT_FLAGS)
+    d = page.get_text("dict", textpage=textpage)
+    words = page.get_text("words", textpage=textpage)
+    del textpage
+    index = build_word_index(words)
+
+    for b in d.get("blocks", []):
+        if b.get("type", 0) != 0:
+            continue
+
+        for l in b.get("lines", []):
+            spans, texts = [], []
+
+            for s in l.get("spans", []):
+                t = s.get("text", "")
+                if t == "":
+                    continue
+                spans.append((
+                    tuple(s["bbox"]),
+                    styles.intern(s.get("font", ""), float(s.get("size", 0.0)), s.get("color", 0)),
+                    max(1, len(t)),
+                ))
+                texts.append(t)
+
+            if not spans:
+                continue
+
+            phrase = "".join(texts)
+
+            weights = {}
+            for _bbox, sid, weight in spans:
+                weights[sid] = weights.get(sid, 0) + weight
+            sid_d = max(weights.items(), key=lambda kv: kv[1])[0]
+
+            overrides = []
+
+            x0 = min(sp[0][0] for sp in spans)
+            y0 = min(sp[0][1] for sp in spans)
+            x1 = max(sp[0][2] for sp in spans)
+            y1 = max(sp[0][3] for sp in spans)
+            lbbox = (x0, y0, x1, y1)
+
+            for i in words_in_rect(index, lbbox):
+                wx0, wy0, wx1, wy1, word, *_rest = words[i]
+                wbbox = (wx0, wy0, wx1, wy1)
+                if rect_intersection_area(lbbox, wbbox) <= 0:
+                    continue
+
+                # Style du mot : span de plus grande intersection.
+                sid_w = default_sid
+                best_area = 0.0
+                for sbbox, sid, _weight in spans:
+                    area = rect_intersection_area(wbbox, sbbox)
+                    if area > best_area:
+                        best_area = area
+                        sid_w = sid
+
+                if sid_w != sid_d and styles_differ(table[sid_w], table[sid_d]):
+                    if word.strip():
+                        overrides.append((word, wbbox, table[sid_w]))
+
+            lines.append((phrase, table[sid_d], lbbox, overrides))
+
+    return lines
+
+
+def format_overrides(overrides) -> str:
+    """Colonne overrides du CSV : mot|famille|taille|couleur|style, séparés par ||."""
+    return "||".join(f"{word}|{fam}|{size:g}|{col}|{tag}" for word, _bbox, (fam, tag, size, col) in overrides)
+
+
+def line_row(phrase: str, style, overrides) -> list:
+    fam, tag, size, col = style
+    return [phrase, fam, f"{size:g}", col, tag, format_overrides(overrides)]
+
+
+def page_rows(page: fitz.Page, styles: Optional[StyleTable] = None):
+    """Lignes CSV (phrase, famille, taille, couleur, style, overrides) d'une page."""
+    return [line_row(phrase, style, overrides) for phrase, style, _bbox, overrides in page_lines(page, styles)]
+
+
+CSV_HEADER = ["phrase", "font_family", "size", "color_hex", "style_tag", "overrides"]
+
+
+def export_phrase_compact_from_doc(doc: fitz.Document, out_csv: str, pages: Iterable[int],
+                                   styles: Optional[StyleTable] = None):
     Path(out_csv).parent.mkdir(parents=True, exist_ok=True)
 
-    with open(out_csv, "w", newline="", encoding="utf-8") as f:
+    # Écriture dans un fichier temporaire puis renommage : un lecteur ne voit
+    # jamais de CSV à moitié écrit (utile avec --workers).
+    tmp_csv = f"{out_csv}.tmp"
+    with open(tmp_csv, "w", newline="", encoding="utf-8") as f:
         w = csv.writer(f, delimiter=";")
-        w.writerow(["phrase", "font_family", "size", "color_hex", "style_tag", "overrides"])
+        w.writerow(CSV_HEADER)
 
-        for p in page_indexes:
-            page = doc[p]
-            d = page.get_text("dict")
+        for p in pages:
+            w.writerows(page_rows(doc[p], styles))
+    os.replace(tmp_csv, out_csv)
 
-            for b in d.get("blocks", []):
-                if b.get("type", 0) != 0:
-                    continue
+    print(f"[OK] Export: {out_csv}")
 
-                for l in b.get("lines", []):
-                    spans, texts = [], []
-
-                    for s in l.get("spans", []):
-                        t = s.get("text", "")
-                        if t == "":
-                            continue  
-                        spans.append({
-                            "bbox": tuple(s["bbox"]),
-                            "font": s.get("font", ""),
-                            "size": float(s.get("size", 0.0)),
-                            "color": s.get("color", 0),
-                            "text": t
-                        })
-                        texts.append(t)
-
-                    if not spans:
-                        continue
-
-                    raw_phrase = "".join(texts)
-                    phrase = raw_phrase
-                    fam_d, tag_d, size_d, col_d = weighted_dominant_style(spans)
-
-                    overrides = []
-                    words = page.get_text("words")
-
-                    x0 = min(s["bbox"][0] for s in spans)
-                    y0 = min(s["bbox"][1] for s in spans)
-                    x1 = max(s["bbox"][2] for s in spans)
-                    y1 = max(s["bbox"][3] for s in spans)
-                    lbbox = (x0, y0, x1, y1)
-
-                    for (wx0, wy0, wx1, wy1, word, *_rest) in words:
-                        wbbox = (wx0, wy0, wx1, wy1)
-                        if rect_intersection_area(lbbox, wbbox) <= 0:
-                            continue
-
-                        fam_w, tag_w, size_w, col_w = style_for_word_from_spans(wbbox, spans)
-
-                        if (fam_w != fam_d) or (tag_w != tag_d) or abs(size_w - size_d) > 1e-6 or (col_w.lower() != col_d.lower()):
-                            if word.strip():
-                                overrides.append(f"{word}|{fam_w}|{size_w:g}|{col_w}|{tag_w}")
-
-                    w.writerow([
-                        phrase,
-                        fam_d,
-                        f"{size_d:g}",
-                        col_d,
-                        tag_d,
-                        "||".join(overrides) if overrides else ""
-                    ])
 
+def csv_text_from_doc(doc: fitz.Document, pages: Iterable[int], styles: Optional[StyleTable] = None) -> str:
+    """Même contenu que le fichier écrit par export_phrase_compact_from_doc, en mémoire."""
+    return csv_text([row for p in pages for row in page_rows(doc[p], styles)])
+
+
+def csv_text(rows) -> str:
+    """En-tête + lignes au format des page_N.csv."""
+    buf = io.StringIO(newline="")
+    w = csv.writer(buf, delimiter=";")
+    w.writerow(CSV_HEADER)
+    w.writerows(rows)
+    return buf.getvalue()
+
+
+def universal_newlines(text: str) -> str:
+    """Texte tel que relu par open(..., "r") : ce que Gemini reçoit d'un page_N.csv."""
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+# =========================
+# ÉTAPE DU PIPELINE EN PROCESSUS (pipeline.py)
+# =========================
+STAGE_INPUTS = ("pdf",)
+STAGE_OUTPUTS = ("style_csv",)
+
+
+def page_style_csv(doc: fitz.Document, page_num: int, styles: StyleTable, out_dir=None) -> str:
+    """
+    CSV de style d'une page (1-based), tel que relu par open(..., "r") (fins de
+    ligne universelles) ; écrit aussi out_dir/page_N.csv si out_dir est donné.
+    """
+    with telemetry.span("style.page", page=page_num) as span:
+        text = csv_text_from_doc(doc, [page_num - 1], styles)
+        if out_dir is not None:
+            out_csv = Path(out_dir) / f"page_{page_num}.csv"
+            with open(out_csv, "w", newline="", encoding="utf-8") as f:
+                f.write(text)
+            span["bytes_written"] = out_csv.stat().st_size
+            print(f"[OK] Export: {out_csv}")
+    return universal_newlines(text)
+
+
+def stage(ctx):
+    """CSV de style de chaque page gardé en mémoire ; files_style/page_N.csv si ctx.materialize."""
+    out_dir = ctx.dir("files_style") if ctx.materialize else None
+    styles = StyleTable()
+    with PdfPages(ctx.pdf_path) as pages:
+        for page_num in ctx.page_nums:
+            ctx.put(page_num, "style_csv", page_style_csv(pages.doc, page_num, styles, out_dir))
+            pages.page_done(page_num)
+
+
+def export_page_range(pdf_path: str, output_dir: str, page_nums: List[int]) -> List[Tuple[int, float]]:
+    """
+    Exporte page_N.csv pour chaque page (1-based) de `page_nums`.
+    Ouvre son propre fitz.Document : appelable depuis un processus du pool.
+    Retourne [(page_num, secondes), ...].
+    """
+    timings = []
+    styles = StyleTable()
+    with PdfPages(pdf_path) as pages:
+        for page_num in page_nums:
+            out_csv = Path(output_dir) / f"page_{page_num}.csv"
+            print(f"->  Export page {page_num} vers {out_csv}", flush=True)
+            t0 = time.perf_counter()
+            with telemetry.span("style.page", page=page_num) as span:
+                export_phrase_compact_from_doc(pages.doc, str(out_csv), pages=[page_num - 1], styles=styles)
+                span["bytes_written"] = out_csv.stat().st_size
+            timings.append((page_num, time.perf_counter() - t0))
+            pages.page_done(page_num)
+    return timings
+
+
+def store_page_range(pdf_path: str, page_nums: List[int]):
+    """[(page_num, page_lines), ...] : appelable depuis un processus du pool."""
+    lines = []
+    styles = StyleTable()
+    with PdfPages(pdf_path) as pages:
+        for page_num in page_nums:
+            with telemetry.span("style.page", page=page_num, output="parquet"):
+                lines.append((page_num, page_lines(pages.doc[page_num - 1], styles)))
+            pages.page_done(page_num)
+    return lines
+
+
+def write_page_csv(out_csv, lines) -> None:
+    """page_N.csv depuis la sortie de page_lines : même fichier qu'export_phrase_compact_from_doc."""
+    tmp_csv = f"{out_csv}.tmp"
+    with open(tmp_csv, "w", newline="", encoding="utf-8") as f:
+        f.write(csv_text([line_row(phrase, style, overrides) for phrase, style, _bbox, overrides in lines]))
+    os.replace(tmp_csv, out_csv)
     print(f"[OK] Export: {out_csv}")
 
 
+def export_store(pdf_path: str, store_dir, page_nums: List[int], workers: int = 1,
+                 csv_dir=None, csv_pages: Iterable[int] = ()) -> None:
+    """
+    Store Parquet (styleStore.py) des pages `page_nums`, écrit page par page
+    (par tranche terminée avec plusieurs workers). Les pages de `csv_pages`
+    reçoivent aussi leur csv_dir/page_N.csv, tiré de la même extraction.
+    """
+    from styleStore import StyleStoreWriter
+
+    csv_pages = set(csv_pages)
+
+    def write(writer, page_num, lines):
+        writer.write_page(page_num, lines)
+        if page_num in csv_pages:
+            write_page_csv(Path(csv_dir) / f"page_{page_num}.csv", lines)
+
+    with StyleStoreWriter(store_dir) as writer:
+        if workers <= 1:
+            styles = StyleTable()
+            with PdfPages(pdf_path) as pages:
+                for page_num in page_nums:
+                    with telemetry.span("style.page", page=page_num, output="parquet"):
+                        write(writer, page_num, page_lines(pages.doc[page_num - 1], styles))
+                    pages.page_done(page_num)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(store_page_range, pdf_path, chunk)
+                           for chunk in chunk_pages(page_nums, workers)]
+                for fut in as_completed(futures):
+                    for page_num, lines in fut.result():
+                        write(writer, page_num, lines)
+    print(f"[OK] Store : {store_dir} ({len(page_nums)} pages)")
+
+
+def chunk_pages(page_nums: List[int], workers: int) -> List[List[int]]:
+    """
+    Découpe en tranches contiguës ; plusieurs tranches par worker pour que
+    les pages denses ne s'accumulent pas toutes dans le même processus.
+    """
+    if not page_nums:
+        return []
+    n_chunks = min(len(page_nums), workers * CHUNKS_PER_WORKER)
+    size = math.ceil(len(page_nums) / n_chunks)
+    return [page_nums[i:i + size] for i in range(0, len(page_nums), size)]
+
+
+def export_pages_parallel(pdf_path: str, output_dir: str, page_nums: List[int], workers: int) -> List[Tuple[int, float]]:
+    timings = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(export_page_range, pdf_path, str(output_dir), chunk)
+                   for chunk in chunk_pages(page_nums, workers)]
+        for fut in as_completed(futures):
+            timings.extend(fut.result())
+    return sorted(timings)
+
+
 def main():
-    # Usage: python pdfToTxtStyle.py <pdf_path> <output_folder> <all(true|false)> [first_page] [last_page]
-    if len(sys.argv) < 4:
-        print("Usage: python pdfToTxtStyle.py <pdf_path> <output_folder> <all(true|false)> [first_page] [last_page]")
+    # Usage: python pdfToTxtStyle.py <pdf_path> <output_folder> <all(true|false)> [first_page] [last_page] [--workers N]
+    argv = list(sys.argv)
+    workers = int(pop_option(argv, "--workers", 1))
+    if len(argv) < 4:
+        print("Usage: python pdfToTxtStyle.py <pdf_path> <output_folder> <all(true|false)> [first_page] [last_page] [--workers N]")
         sys.exit(1)
 
-    pdf_path = sys.argv[1]
-    output_dir = Path(sys.argv[2])
-    all_flag = sys.argv[3].lower().strip()
-
-    with fitz.open(pdf_path) as doc:
-        total = len(doc)
+    pdf_path = argv[1]
+    output_dir = Path(argv[2])
+    all_flag = argv[3].lower().strip()
+
+    if STYLE_OUTPUT in ("parquet", "both"):
+        from styleStore import require_arrow
+        try:
+            require_arrow()
+        except RuntimeError as e:
+            # avant toute extraction : ne pas découvrir l'absence de pyarrow après les CSV
+            print(f"[ERR] STYLE_OUTPUT = \"{STYLE_OUTPUT}\" : {e}")
+            sys.exit(1)
+
+    with PdfPages(pdf_path) as pages:
+        total = len(pages)
         print(f"PDF : {pdf_path}")
         print(f"Nombre de pages detectees : {total}")
 
@@ -168,11 +469,11 @@ def main():
             first_page = 1
             last_page = total
         else:
-            if len(sys.argv) < 6:
+            if len(argv) < 6:
                 print("Error: need first_page and last_page when all_flag is false")
                 sys.exit(1)
-            first_page = int(sys.argv[4])
-            last_page = int(sys.argv[5])
+            first_page = int(argv[4])
+            last_page = int(argv[5])
 
             if first_page < 1:
                 first_page = 1
@@ -183,12 +484,72 @@ def main():
 
         output_dir.mkdir(parents=True, exist_ok=True)
 
-        # pages 1-based -> index 0-based
-        for page_num in range(first_page, last_page + 1):
-            page_idx = page_num - 1
-            out_csv = output_dir / f"page_{page_num}.csv"
-            print(f"->  Export page {page_num} vers {out_csv}")
-            export_phrase_compact_from_doc(doc, str(out_csv), pages=[page_idx])
+        # Reconstruction incrémentale : pages déjà exportées depuis ce même PDF ignorées
+        manifest = Manifest(output_dir, "style")
+        digests = {n: inputs_digest(Path(pdf_path), n) for n in range(first_page, last_page + 1)}
+        page_nums = []
+        if STYLE_OUTPUT in ("csv", "both"):
+            # CSV des pages sorties de la plage : supprimés, l'extraction les lirait encore
+            pruned = manifest.prune(digests)
+            if pruned:
+                print(f"[OK] style: {pruned} pages hors plage supprimées")
+            page_nums = [n for n, digest in digests.items() if not manifest.is_fresh(n, digest)]
+            manifest.report(len(digests), len(page_nums))
+        elif manifest.prune(()):
+            # plus de CSV : ceux d'un run précédent passeraient avant le store dans l'extraction
+            print("[OK] style: CSV supprimés (STYLE_OUTPUT sans csv)")
+        manifest.save()
+
+        store_stale = False
+        if STYLE_OUTPUT in ("parquet", "both"):
+            from styleStore import STORE_DIRNAME, store_files
+
+            # le store couvre toute la plage : reconstruit dès que le PDF ou la plage change
+            store_dir = output_dir / STORE_DIRNAME
+            store_manifest = Manifest(output_dir, "style-store")
+            store_digest = inputs_digest(Path(pdf_path), first_page, last_page)
+            store_stale = not store_manifest.is_fresh("store", store_digest)
+            if not store_stale:
+                print(f"[OK] Store a jour : {store_dir}")
+        else:
+            # plus de store : un store périmé ne doit pas servir de repli à l'extraction
+            old_store = Manifest(output_dir, "style-store")
+            if old_store.prune(()):
+                old_store.save()
+
+        t0 = time.perf_counter()
+        timings = []
+        if store_stale:
+            # une seule extraction par page : le store et les CSV à refaire viennent des mêmes lignes
+            export_store(pdf_path, store_dir, list(range(first_page, last_page + 1)), workers,
+                         csv_dir=output_dir, csv_pages=page_nums)
+            store_manifest.record("store", store_digest, store_files(store_dir))
+            store_manifest.save()
+            print(f"[TIME] store : {time.perf_counter() - t0:.3f}s ({last_page - first_page + 1} pages)")
+        elif workers <= 1:
+            styles = StyleTable()
+            # pages 1-based -> index 0-based
+            for page_num in page_nums:
+                page_idx = page_num - 1
+                out_csv = output_dir / f"page_{page_num}.csv"
+                print(f"->  Export page {page_num} vers {out_csv}")
+                t_page = time.perf_counter()
+                export_phrase_compact_from_doc(pages.doc, str(out_csv), pages=[page_idx], styles=styles)
+                timings.append((page_num, time.perf_counter() - t_page))
+                pages.page_done(page_num)
+
+    if not store_stale and workers > 1 and page_nums:
+        print(f"Workers : {workers}")
+        timings = export_pages_parallel(pdf_path, str(output_dir), page_nums, workers)
+
+    for page_num in page_nums:
+        manifest.record(page_num, digests[page_num], [output_dir / f"page_{page_num}.csv"])
+    manifest.save()
+
+    for page_num, seconds in timings:
+        print(f"[TIME] page {page_num} : {seconds:.3f}s")
+    if timings:
+        print(f"[TIME] total : {time.perf_counter() - t0:.3f}s ({len(timings)} pages)")
 
 
 if __name__ == "__main__":
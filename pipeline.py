@@ -0,0 +1,346 @@
+"""
+In-process stage runner: every stage of main.py in one interpreter.
+
+Each stage script exposes STAGE_INPUTS / STAGE_OUTPUTS (artifact names) and
+stage(ctx). The runner orders the stages from those declarations, shares
+loaded models and API clients through ctx.resources, and hands pages over in
+memory (ctx.put / ctx.get) instead of through the files/, output/ and files-out/
+directories. With materialize=False those intermediate directories are not
+written; crops and Gemini responses always are.
+
+An artifact is released as soon as the last stage reading it has run. Pages
+are never held as full-resolution arrays (about 58 MB per A4 page at 450 DPI):
+"page_image" is a pdfToImages.PageImage that each stage loads for the page it
+is working on, and "annotated" keeps only the encoded bytes.
+
+run_streaming() is the page-level variant: one thread per step
+(rasterize -> detect -> crop/draw + style CSV -> Gemini -> postprocess) linked
+by bounded queues, so a page reaches Gemini as soon as it is annotated and a
+slow step holds back the ones before it instead of piling pages up in memory.
+
+    config.PIPELINE_MODE = "inprocess" | "streaming"   # main.py
+"""
+import importlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import telemetry
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# main.py order; extraction-gemini-vision.py is not a valid module name, hence importlib
+STAGE_MODULES = ["pdfToImages", "pdfToTxtStyle", "detectImages", "cropImages", "drawBoxes",
+                 "extraction-gemini-vision", "postprocessing"]
+
+ROOT_ARTIFACTS = ("pdf",)
+
+
+class PipelineContext:
+
+    def __init__(self, pdf_path, page_nums, base_dir=BASE_DIR, materialize=True, dpi=450):
+        self.pdf_path = Path(pdf_path)
+        self.page_nums = list(page_nums)
+        self.base_dir = Path(base_dir)
+        self.materialize = materialize
+        self.dpi = dpi
+        self.pages = {page_num: {} for page_num in self.page_nums}
+        self.resources = {}   # shared across stages: loaded models, API clients
+
+    def dir(self, name) -> Path:
+        path = self.base_dir / name
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def put(self, page_num, artifact, value) -> None:
+        self.pages.setdefault(page_num, {})[artifact] = value
+
+    def get(self, page_num, artifact, default=None):
+        return self.pages.get(page_num, {}).get(artifact, default)
+
+    def pages_with(self, *artifacts):
+        """Pages (sorted) that have every artifact in `artifacts`."""
+        return [n for n in sorted(self.pages) if all(a in self.pages[n] for a in artifacts)]
+
+    def release(self, artifact) -> None:
+        for page in self.pages.values():
+            page.pop(artifact, None)
+
+
+def load_stage(module_name):
+    module = importlib.import_module(module_name)
+    for attr in ("STAGE_INPUTS", "STAGE_OUTPUTS", "stage"):
+        if not hasattr(module, attr):
+            raise AttributeError(f"{module_name} does not declare {attr}")
+    return module
+
+
+def order_stages(modules):
+    """Topological order of the stages from their declared inputs/outputs (declaration order on ties)."""
+    producers = {}
+    for module in modules:
+        for artifact in module.STAGE_OUTPUTS:
+            if artifact in producers:
+                raise ValueError(f"Artifact '{artifact}' produced by {producers[artifact].__name__} "
+                                 f"and {module.__name__}")
+            producers[artifact] = module
+
+    for module in modules:
+        for artifact in module.STAGE_INPUTS:
+            if artifact not in producers and artifact not in ROOT_ARTIFACTS:
+                raise ValueError(f"{module.__name__} needs '{artifact}', produced by no stage")
+
+    ordered, done, remaining = [], set(ROOT_ARTIFACTS), list(modules)
+    while remaining:
+        ready = [m for m in remaining if all(a in done for a in m.STAGE_INPUTS)]
+        if not ready:
+            raise ValueError("Stage graph has a cycle: " + ", ".join(m.__name__ for m in remaining))
+        module = ready[0]
+        ordered.append(module)
+        done.update(module.STAGE_OUTPUTS)
+        remaining.remove(module)
+    return ordered
+
+
+def last_readers(ordered):
+    """{artifact: index of the last stage reading it}."""
+    last = {}
+    for index, module in enumerate(ordered):
+        for artifact in module.STAGE_INPUTS:
+            last[artifact] = index
+    return last
+
+
+def run_pipeline(pdf_path, first_page=None, last_page=None, base_dir=BASE_DIR,
+                 materialize=True, stages=STAGE_MODULES):
+    """first_page/last_page 1-based inclusive; None = whole document."""
+    from pdfToImages import count_pdf_pages
+
+    total = count_pdf_pages(pdf_path)
+    first_page = max(1, first_page or 1)
+    last_page = min(total, last_page or total)
+    ctx = PipelineContext(pdf_path, range(first_page, last_page + 1), base_dir, materialize)
+    print(f"[RUN] In-process pipeline: pages {first_page} > {last_page} "
+          f"(materialize={'on' if materialize else 'off'})")
+
+    t0 = time.perf_counter()
+    ordered = order_stages([load_stage(name) for name in stages])
+    print(f"[TIME] imports : {time.perf_counter() - t0:.3f}s")
+    last = last_readers(ordered)
+
+    for index, module in enumerate(ordered):
+        print(f"\n[RUN] Stage {module.__name__}...")
+        t_stage = time.perf_counter()
+        with telemetry.span("stage", module=module.__name__, pages=len(ctx.page_nums)):
+            module.stage(ctx)
+        print(f"[OK] {module.__name__} finished ({time.perf_counter() - t_stage:.3f}s)")
+        for artifact, reader in last.items():
+            if reader == index:
+                ctx.release(artifact)
+
+    print(f"[TIME] total : {time.perf_counter() - t0:.3f}s")
+    return ctx
+
+
+# =========================
+# STREAMING (page by page)
+# =========================
+_END = object()
+
+
+class PipelineAborted(RuntimeError):
+    """Raised in a step blocked on a queue once another step has failed."""
+
+
+class Channel:
+    """Bounded queue between two steps; put/get give up when the run is aborted."""
+
+    def __init__(self, maxsize, abort: threading.Event):
+        self.queue = queue.Queue(maxsize)
+        self.abort = abort
+
+    def put(self, item) -> None:
+        while not self.abort.is_set():
+            try:
+                self.queue.put(item, timeout=0.2)
+                return
+            except queue.Full:
+                pass
+        raise PipelineAborted()
+
+    def get(self):
+        while not self.abort.is_set():
+            try:
+                return self.queue.get(timeout=0.2)
+            except queue.Empty:
+                pass
+        raise PipelineAborted()
+
+    def get_nowait(self):
+        return self.queue.get_nowait()
+
+    def close(self) -> None:
+        self.put(_END)
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is _END:
+                return
+            yield item
+
+
+def run_streaming(pdf_path, first_page=None, last_page=None, base_dir=BASE_DIR,
+                  materialize=True, postprocess=False, queue_size=4):
+    """
+    Same outputs as run_pipeline, page by page. `queue_size` pages at most wait
+    between two steps. The Gemini step keeps GEMINI_CONCURRENCY requests in flight.
+    """
+    from config import RASTER_BACKEND, RASTER_WORKERS
+    from imageProfiles import get_profile
+    from pdfToImages import count_pdf_pages, render_pages
+    from memoryBudget import PdfPages
+    import pdfToTxtStyle
+    import detectImages
+    import cropImages
+    import drawBoxes
+    import postprocessing
+    from detectService import ModelCache
+    gemini = importlib.import_module("extraction-gemini-vision")
+
+    total = count_pdf_pages(pdf_path)
+    first_page = max(1, first_page or 1)
+    last_page = min(total, last_page or total)
+    print(f"[RUN] Streaming pipeline: pages {first_page} > {last_page} "
+          f"(queues={queue_size}, materialize={'on' if materialize else 'off'})")
+
+    base_dir = Path(base_dir)
+    ctx = PipelineContext(pdf_path, range(first_page, last_page + 1), base_dir, materialize)
+    abort = threading.Event()
+    rendered, detected, annotated, extracted = (Channel(queue_size, abort) for _ in range(4))
+    errors = []
+    done = {"extracted": 0, "cleaned": 0}
+    done_lock = threading.Lock()
+
+    def rasterize():
+        render_pages(pdf_path, ctx.dir("files"), first_page, last_page,
+                     lambda page_num, img: rendered.put((page_num, img)),
+                     dpi=ctx.dpi, workers=RASTER_WORKERS, backend=RASTER_BACKEND, save_png=materialize)
+        rendered.close()
+
+    def detect():
+        models = ModelCache()
+        predict_root = ctx.dir(detectImages.output_dir) if materialize else None
+        batch_size = detectImages.BATCH_SIZE or 1
+        pending = iter(rendered)
+        for first in pending:
+            # whatever is already waiting joins the batch; never wait for a full one
+            batch = [first]
+            while len(batch) < batch_size:
+                try:
+                    item = rendered.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _END:
+                    rendered.queue.put(_END)
+                    break
+                batch.append(item)
+            found = detectImages.detect_arrays(models, batch, predict_root)
+            for page_num, img in batch:
+                if page_num in found:
+                    detected.put((page_num, img, found[page_num]))
+        detected.close()
+
+    def crop_and_draw():
+        crop_folder = ctx.dir(cropImages.crop_folder)
+        crop_profile = get_profile("crops")
+        annotated_profile = get_profile("annotated")
+        files_out = ctx.dir("files-out") if materialize else None
+        files_style = ctx.dir("files_style") if materialize else None
+        styles = pdfToTxtStyle.StyleTable()
+        with PdfPages(pdf_path) as pages:
+            for page_num, img, shapes in detected:
+                with telemetry.span("cropdraw.page", page=page_num):
+                    cropImages.crop_page(img, shapes, page_num, crop_folder, crop_profile)
+                    data, small = drawBoxes.render_annotated(img, shapes, page_num, annotated_profile, files_out)
+                del img
+                csv_content = pdfToTxtStyle.page_style_csv(pages.doc, page_num, styles, files_style)
+                pages.page_done(page_num)
+                annotated.put((page_num, data, small, csv_content))
+        annotated.close()
+
+    def extract():
+        client = gemini.genai.Client(api_key=gemini.load_api_key(gemini.api_key_path))
+        out_dir = ctx.dir(os.path.basename(gemini.output_dir))
+        slots = threading.Semaphore(gemini.GEMINI_CONCURRENCY)
+
+        def one_page(page_num, prepare, out_json):
+            try:
+                if prepare is not None:
+                    gemini.process_prepared(client, prepare())
+                if os.path.exists(out_json):
+                    with done_lock:
+                        done["extracted"] += 1
+                    if postprocess:
+                        extracted.put((page_num, out_json))
+            except PipelineAborted:
+                pass
+            except BaseException as e:
+                # stop feeding Gemini right away (daily cap, API failure)
+                errors.append(("extract", e))
+                abort.set()
+            finally:
+                slots.release()
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=gemini.GEMINI_CONCURRENCY) as pool:
+            for page_num, data, small, csv_content in annotated:
+                out_json = str(out_dir / f"page_{page_num}.json")
+                prepare = gemini.page_preparer(page_num, csv_content, data, small, out_json)
+                while not slots.acquire(timeout=0.2):
+                    if abort.is_set():
+                        raise PipelineAborted()
+                futures.append(pool.submit(one_page, page_num, prepare, out_json))
+            for fut in futures:
+                fut.result()
+        extracted.close()
+
+    def clean():
+        out_dir = str(ctx.dir(os.path.basename(postprocessing.OUTPUT_DIR)))
+        for _page_num, in_path in extracted:
+            if postprocessing.fix_and_save(os.path.basename(in_path), os.path.dirname(in_path), out_dir):
+                with done_lock:
+                    done["cleaned"] += 1
+
+    def run(step):
+        t_step = time.perf_counter()
+        try:
+            with telemetry.span("step", step=step.__name__):
+                step()
+            print(f"[OK] {step.__name__} finished ({time.perf_counter() - t_step:.3f}s)")
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            errors.append((step.__name__, e))
+            abort.set()
+
+    steps = [rasterize, detect, crop_and_draw, extract] + ([clean] if postprocess else [])
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(step,), name=step.__name__) for step in steps]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print(f"[TIME] total : {time.perf_counter() - t0:.3f}s "
+          f"({done['extracted']} extracted, {done['cleaned']} cleaned)")
+    gemini.print_run_summary()
+    for name, e in errors:
+        if isinstance(e, gemini.DailyLimitReached):
+            print(f" {e} Stopping.")
+            continue
+        raise RuntimeError(f"Streaming step {name} failed: {e}") from e
+    return done
@@ -1,7 +1,15 @@
 import os
 import json
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 # Assure-toi d'avoir fait : pip install json_repair
 from json_repair import repair_json
+from pathlib import Path
+
+from config import POSTPROCESS_WORKERS
+from manifest import Manifest, inputs_digest
+import telemetry
 
 # =========================
 # CONFIGURATION
@@ -15,12 +23,8 @@ OUTPUT_DIR = r"C:\Users\lasheb\PycharmProjects\extractionPipeline-TS\extractionO
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 
-def pre_clean_string(text: str) -> str:
-    """
-    Nettoyage chirurgical des erreurs de backslashs générées par le LLM
-    AVANT de tenter de réparer la structure JSON.
-    """
-    # 1. Retirer les balises Markdown ```json ... ```
+def strip_fences(text: str) -> str:
+    """Retire les balises Markdown ```json ... ``` autour de la réponse."""
     t = text.strip()
     if t.startswith("```json"):
         t = t[7:].strip()
@@ -28,6 +32,16 @@ def pre_clean_string(text: str) -> str:
         t = t[3:].strip()
     if t.endswith("```"):
         t = t[:-3].strip()
+    return t
+
+
+def pre_clean_string(text: str) -> str:
+    """
+    Nettoyage chirurgical des erreurs de backslashs générées par le LLM
+    AVANT de tenter de réparer la structure JSON.
+    """
+    # 1. Retirer les balises Markdown ```json ... ```
+    t = strip_fences(text)
 
     # -----------------------------------------------------------
     # RÉPARATIONS DES BACKSLASHS (Ordre important)
@@ -60,40 +74,123 @@ def pre_clean_string(text: str) -> str:
     return t
 
 
-def fix_and_save(filename):
-    in_path = os.path.join(INPUT_DIR, filename)
-    out_path = os.path.join(OUTPUT_DIR, filename)
-
-    try:
-        with open(in_path, "r", encoding="utf-8") as f:
-            raw_content = f.read()
-    except Exception as e:
-        print(f"[ERR] Erreur lecture {filename}: {e}")
-        return
+# =========================
+# RÉPARATION PAR PALIERS
+# =========================
+# Chaque palier donne exactement le résultat de l'ancien traitement
+# (pre_clean_string puis repair_json, qui commence lui-même par json.loads) :
+#   "strict" : aucun backslash -> pre_clean_string ne changerait rien, json.loads suffit
+#   "clean"  : json.loads après les corrections de backslashs
+#   "repair" : json_repair complet (lent), seulement si les deux premiers échouent
+TIERS = ("strict", "clean", "repair", "failed", "unreadable")
+
+
+def repair_text(raw_content: str):
+    """Retourne (données, palier, texte analysé) ; laisse passer l'erreur de json_repair en dernier recours."""
+    if "\\" not in raw_content:
+        stripped = strip_fences(raw_content)
+        try:
+            return json.loads(stripped), "strict", stripped
+        except ValueError:
+            pass
 
     # 1. Pré-nettoyage manuel (slashs)
     pre_cleaned = pre_clean_string(raw_content)
+    try:
+        return json.loads(pre_cleaned), "clean", pre_cleaned
+    except ValueError:
+        pass
 
     # 2. Utilisation de json_repair pour la structure
     # Cette librairie est très forte pour fermer les accolades manquantes
     # ou ignorer les virgules en trop, une fois que les strings sont propres (étape 1).
+    # repair_json renvoie un objet python (dict/list) directement
+    return repair_json(pre_cleaned, return_objects=True), "repair", pre_cleaned
+
+
+def repair_file(filename, input_dir=INPUT_DIR, output_dir=OUTPUT_DIR):
+    """Répare un fichier ; retourne (chemin écrit ou None, palier). Appelable depuis un processus du pool."""
+    in_path = os.path.join(input_dir, filename)
+    out_path = os.path.join(output_dir, filename)
+
+    try:
+        with open(in_path, "r", encoding="utf-8") as f:
+            raw_content = f.read()
+    except Exception as e:
+        print(f"[ERR] Erreur lecture {filename}: {e}", flush=True)
+        return None, "unreadable"
+
     try:
-        # repair_json renvoie un objet python (dict/list) directement
-        data = repair_json(pre_cleaned, return_objects=True)
+        data, tier, _ = repair_text(raw_content)
 
         # 3. Sauvegarde propre
         with open(out_path, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
 
-        print(f"[OK] Succes : {filename}")
+        print(f"[OK] Succes : {filename} ({tier})", flush=True)
+        return out_path, tier
 
     except Exception as e:
-        print(f"[ERR] Echec total sur : {filename}")
-        print(f"      Raison : {e}")
+        print(f"[ERR] Echec total sur : {filename}", flush=True)
+        print(f"      Raison : {e}", flush=True)
 
         # Sauvegarde du fichier cassé (mais pré-nettoyé) pour inspection
-        with open(out_path.replace(".json", "_BROKEN.txt"), "w", encoding="utf-8") as f:
-            f.write(pre_cleaned)
+        broken_path = out_path.replace(".json", "_BROKEN.txt")
+        with open(broken_path, "w", encoding="utf-8") as f:
+            f.write(pre_clean_string(raw_content))
+        return broken_path, "failed"
+
+
+def fix_and_save(filename, input_dir=INPUT_DIR, output_dir=OUTPUT_DIR):
+    """Chemin du JSON corrigé, ou None en cas d'échec."""
+    out_path, tier = repair_file(filename, input_dir, output_dir)
+    return out_path if tier not in ("failed", "unreadable") else None
+
+
+def _repair_one(filename, input_dir, output_dir):
+    with telemetry.span("postprocess.file", file=filename) as span:
+        path, tier = repair_file(filename, input_dir, output_dir)
+        span["tier"] = tier
+    return filename, path, tier
+
+
+def _repair_chunk(filenames, input_dir, output_dir):
+    return [_repair_one(f, input_dir, output_dir) for f in filenames]
+
+
+def repair_files(filenames, workers=POSTPROCESS_WORKERS, input_dir=INPUT_DIR, output_dir=OUTPUT_DIR):
+    """
+    Répare `filenames`, en parallèle (processus) si workers > 1.
+    Retourne [(fichier, chemin écrit ou None, palier), ...].
+    """
+    if workers <= 1 or len(filenames) < 2:
+        return _repair_chunk(filenames, input_dir, output_dir)
+
+    # quelques tranches par processus : peu d'aller-retours, charge équilibrée
+    size = max(1, len(filenames) // (workers * 4))
+    chunks = [filenames[i:i + size] for i in range(0, len(filenames), size)]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk_results in pool.map(_repair_chunk, chunks, [input_dir] * len(chunks), [output_dir] * len(chunks)):
+            results.extend(chunk_results)
+    return results
+
+
+# =========================
+# ÉTAPE DU PIPELINE EN PROCESSUS (pipeline.py)
+# =========================
+STAGE_INPUTS = ("extraction",)
+STAGE_OUTPUTS = ("cleaned",)
+
+
+def stage(ctx):
+    """Répare les réponses Gemini de la passe courante ; "cleaned" = chemin du JSON corrigé."""
+    out_dir = ctx.dir(os.path.basename(OUTPUT_DIR))
+    for page_num in ctx.pages_with("extraction"):
+        in_path = ctx.get(page_num, "extraction")
+        out_path = fix_and_save(os.path.basename(in_path), os.path.dirname(in_path), str(out_dir))
+        if out_path:
+            ctx.put(page_num, "cleaned", out_path)
 
 
 def main():
@@ -104,9 +201,26 @@ def main():
     files = [f for f in os.listdir(INPUT_DIR) if f.endswith(".json")]
     print(f"Traitement de {len(files)} fichiers dans {INPUT_DIR}...")
 
-    for f in files:
-        fix_and_save(f)
-
+    # Reconstruction incrémentale : seules les réponses Gemini modifiées sont réparées
+    manifest = Manifest(OUTPUT_DIR, "cleaned")
+    manifest.prune(os.path.splitext(f)[0] for f in files)
+
+    digests = {f: inputs_digest(Path(INPUT_DIR) / f) for f in files}
+    stale = [f for f in files if not manifest.is_fresh(os.path.splitext(f)[0], digests[f])]
+    for f in stale:
+        manifest.invalidate(os.path.splitext(f)[0])
+
+    t0 = time.perf_counter()
+    counts = Counter()
+    for f, out_path, tier in repair_files(stale):
+        counts[tier] += 1
+        if out_path is not None and os.path.exists(out_path):
+            manifest.record(os.path.splitext(f)[0], digests[f], [out_path])
+
+    manifest.save()
+    manifest.report(len(files), len(stale))
+    print(f"[TIME] {len(stale)} fichiers en {time.perf_counter() - t0:.2f}s | "
+          + " ".join(f"{tier}={counts[tier]}" for tier in TIERS))
     print("Post-traitement termine.")
 
 
@@ -0,0 +1,92 @@
+"""
+Cross-process ledger of Gemini requests (SQLite, WAL mode).
+
+Every local process that calls Gemini records its requests in the same file,
+so MAX_RPM / MAX_RPD hold for all parallel runs together and the daily budget
+survives restarts.
+
+    python rateLedger.py status     # remaining daily budget, requests in the last minute
+"""
+import sqlite3
+import sys
+import threading
+import time
+
+from config import GEMINI_LEDGER_PATH, GEMINI_MAX_RPM, GEMINI_MAX_RPD
+
+ONE_MIN = 60.0
+ONE_DAY = 86400.0
+
+_conn = None
+_lock = threading.Lock()
+
+
+def _connect():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(GEMINI_LEDGER_PATH, timeout=30, isolation_level=None,
+                                check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("CREATE TABLE IF NOT EXISTS requests (ts REAL NOT NULL)")
+        _conn.execute("CREATE INDEX IF NOT EXISTS requests_ts ON requests (ts)")
+    return _conn
+
+
+def try_acquire(max_rpm=GEMINI_MAX_RPM, max_rpd=GEMINI_MAX_RPD):
+    """
+    Atomically (BEGIN IMMEDIATE = one writer at a time across processes)
+    records one request if both caps allow it.
+    Returns (wait_seconds, used_today): wait 0 means the slot was taken;
+    None means the daily cap is reached.
+    """
+    with _lock:
+        conn = _connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM requests WHERE ts <= ?", (now - ONE_DAY,))
+            used_today = conn.execute("SELECT COUNT(*) FROM requests").fetchone()[0]
+            if used_today >= max_rpd:
+                conn.execute("COMMIT")
+                return None, used_today
+
+            minute = conn.execute(
+                "SELECT COUNT(*), MIN(ts) FROM requests WHERE ts > ?", (now - ONE_MIN,)
+            ).fetchone()
+            if minute[0] >= max_rpm:
+                conn.execute("COMMIT")
+                # Need to wait for the earliest minute slot to expire
+                return max(0.05, ONE_MIN - (now - minute[1]) + 0.05), used_today
+
+            conn.execute("INSERT INTO requests (ts) VALUES (?)", (now,))
+            conn.execute("COMMIT")
+            return 0.0, used_today + 1
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def usage():
+    """(requests in the last minute, requests in the last 24h)."""
+    with _lock:
+        conn = _connect()
+        now = time.time()
+        last_min = conn.execute("SELECT COUNT(*) FROM requests WHERE ts > ?", (now - ONE_MIN,)).fetchone()[0]
+        last_day = conn.execute("SELECT COUNT(*) FROM requests WHERE ts > ?", (now - ONE_DAY,)).fetchone()[0]
+    return last_min, last_day
+
+
+def remaining_today(max_rpd=GEMINI_MAX_RPD) -> int:
+    return max(0, max_rpd - usage()[1])
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if command == "status":
+        last_min, last_day = usage()
+        print(f"Ledger : {GEMINI_LEDGER_PATH}")
+        print(f"Last minute : {last_min}/{GEMINI_MAX_RPM}")
+        print(f"Last 24h    : {last_day}/{GEMINI_MAX_RPD} (remaining {max(0, GEMINI_MAX_RPD - last_day)})")
+    else:
+        print("Usage: python rateLedger.py [status]")
+        sys.exit(1)
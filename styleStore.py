@@ -0,0 +1,201 @@
+"""
+Store colonnaire du style d'un document (Parquet), alternative aux page_N.csv
+de pdfToTxtStyle (config.STYLE_OUTPUT = "parquet" ou "both"). Nécessite
+pyarrow (pip install pyarrow), importé seulement quand le store est utilisé.
+
+    <store>/lines.parquet      page, line, phrase, style_id, x0, y0, x1, y1
+    <store>/overrides.parquet  page, line, word_index, word, style_id, x0, y0, x1, y1
+    <store>/styles.parquet     style_id, font_family, style_tag, size, color_hex
+
+Les overrides sont "éclatés" (un mot par ligne) au lieu d'être empaquetés dans
+une chaîne mot|famille|taille|couleur|style||... Les pages sont écrites au fil
+de l'extraction, un row group par page : read_pages(store, 10, 20) ne lit que
+les row groups de la plage (statistiques de la colonne page). page_csv() redonne
+exactement le CSV de pdfToTxtStyle pour le prompt Gemini.
+
+    python styleStore.py <store_dir>            # pages, lignes, overrides, styles
+    python styleStore.py <store_dir> <page>     # CSV d'une page
+"""
+import os
+import sys
+from functools import lru_cache
+from pathlib import Path
+
+STORE_DIRNAME = "style_store"   # dans le dossier de sortie de pdfToTxtStyle (files_style/)
+TABLES = ("lines", "overrides", "styles")
+
+
+def _arrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("Le store de style Parquet nécessite pyarrow (pip install pyarrow)") from e
+    return pa, pq
+
+
+def require_arrow() -> None:
+    """RuntimeError avec un message clair si pyarrow manque (à appeler avant d'extraire)."""
+    _arrow()
+
+
+def _schemas(pa):
+    bbox = [("x0", pa.float32()), ("y0", pa.float32()), ("x1", pa.float32()), ("y1", pa.float32())]
+    return {
+        "lines": pa.schema([("page", pa.int32()), ("line", pa.int32()), ("phrase", pa.string()),
+                            ("style_id", pa.int32()), *bbox]),
+        "overrides": pa.schema([("page", pa.int32()), ("line", pa.int32()), ("word_index", pa.int32()),
+                                ("word", pa.string()), ("style_id", pa.int32()), *bbox]),
+        "styles": pa.schema([("style_id", pa.int32()), ("font_family", pa.string()), ("style_tag", pa.string()),
+                             ("size", pa.float64()), ("color_hex", pa.string())]),
+    }
+
+
+class StyleStoreWriter:
+    """
+    Écrit les pages au fil de l'eau (write_page) ; les fichiers n'apparaissent
+    qu'à close(), par renommage : un lecteur ne voit jamais de store à moitié écrit.
+    """
+
+    def __init__(self, store_dir):
+        self.pa, pq = _arrow()
+        self.dir = Path(store_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.schemas = _schemas(self.pa)
+        self._writers = {name: pq.ParquetWriter(self._tmp(name), self.schemas[name])
+                         for name in ("lines", "overrides")}
+        self._pq = pq
+        self._style_ids = {}   # (famille, tag, taille, couleur) -> style_id
+
+    def _tmp(self, name):
+        return self.dir / f"{name}.parquet.tmp"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, _exc, _tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def style_id(self, style) -> int:
+        if style not in self._style_ids:
+            self._style_ids[style] = len(self._style_ids)
+        return self._style_ids[style]
+
+    def write_page(self, page_num: int, lines) -> None:
+        """`lines` : sortie de pdfToTxtStyle.page_lines pour la page page_num (1-based)."""
+        cols = {name: {field: [] for field in self.schemas[name].names} for name in ("lines", "overrides")}
+        for line_no, (phrase, style, bbox, overrides) in enumerate(lines):
+            row = cols["lines"]
+            for field, value in zip(("page", "line", "phrase", "style_id", "x0", "y0", "x1", "y1"),
+                                    (page_num, line_no, phrase, self.style_id(style), *bbox)):
+                row[field].append(value)
+            for word_index, (word, wbbox, wstyle) in enumerate(overrides):
+                row = cols["overrides"]
+                for field, value in zip(("page", "line", "word_index", "word", "style_id", "x0", "y0", "x1", "y1"),
+                                        (page_num, line_no, word_index, word, self.style_id(wstyle), *wbbox)):
+                    row[field].append(value)
+        for name, writer in self._writers.items():
+            # un row group par page
+            writer.write_table(self.pa.table(cols[name], schema=self.schemas[name]))
+
+    def close(self) -> None:
+        for writer in self._writers.values():
+            writer.close()
+        styles = sorted(self._style_ids.items(), key=lambda kv: kv[1])
+        self._pq.write_table(self.pa.table({
+            "style_id": [sid for _style, sid in styles],
+            "font_family": [style[0] for style, _sid in styles],
+            "style_tag": [style[1] for style, _sid in styles],
+            "size": [float(style[2]) for style, _sid in styles],
+            "color_hex": [style[3] for style, _sid in styles],
+        }, schema=self.schemas["styles"]), self._tmp("styles"))
+        for name in TABLES:
+            os.replace(self._tmp(name), self.dir / f"{name}.parquet")
+
+    def abort(self) -> None:
+        for writer in self._writers.values():
+            writer.close()
+        for name in TABLES:
+            self._tmp(name).unlink(missing_ok=True)
+
+
+def store_files(store_dir):
+    return [Path(store_dir) / f"{name}.parquet" for name in TABLES]
+
+
+# =========================
+# LECTURE
+# =========================
+def read_pages(store_dir, first_page=None, last_page=None, table="lines", columns=None):
+    """pyarrow.Table des pages first..last (incluses) ; seuls les row groups de la plage sont lus."""
+    _pa, pq = _arrow()
+    filters = []
+    if first_page is not None:
+        filters.append(("page", ">=", first_page))
+    if last_page is not None:
+        filters.append(("page", "<=", last_page))
+    return pq.read_table(Path(store_dir) / f"{table}.parquet", columns=columns, filters=filters or None)
+
+
+@lru_cache(maxsize=8)
+def _styles(path: str, _mtime_ns: int):
+    _pa, pq = _arrow()
+    t = pq.read_table(path).to_pydict()
+    return {sid: (fam, tag, size, col) for sid, fam, tag, size, col
+            in zip(t["style_id"], t["font_family"], t["style_tag"], t["size"], t["color_hex"])}
+
+
+def read_styles(store_dir) -> dict:
+    """{style_id: (famille, tag, taille, couleur)}, mis en cache tant que le fichier ne change pas."""
+    path = Path(store_dir) / "styles.parquet"
+    return _styles(str(path), path.stat().st_mtime_ns)
+
+
+def page_lines(store_dir, page_num: int):
+    """Même structure que pdfToTxtStyle.page_lines, relue depuis le store."""
+    styles = read_styles(store_dir)
+    lines = read_pages(store_dir, page_num, page_num, "lines").sort_by("line").to_pydict()
+    words = read_pages(store_dir, page_num, page_num, "overrides").sort_by(
+        [("line", "ascending"), ("word_index", "ascending")]).to_pydict()
+
+    overrides = {}
+    for i, line_no in enumerate(words["line"]):
+        overrides.setdefault(line_no, []).append((
+            words["word"][i],
+            (words["x0"][i], words["y0"][i], words["x1"][i], words["y1"][i]),
+            styles[words["style_id"][i]],
+        ))
+    return [(phrase, styles[sid], (x0, y0, x1, y1), overrides.get(line_no, []))
+            for line_no, phrase, sid, x0, y0, x1, y1
+            in zip(lines["line"], lines["phrase"], lines["style_id"],
+                   lines["x0"], lines["y0"], lines["x1"], lines["y1"])]
+
+
+def page_csv(store_dir, page_num: int) -> str:
+    """CSV de la page tel que Gemini le lit d'un page_N.csv (fins de ligne universelles)."""
+    import pdfToTxtStyle
+
+    rows = [pdfToTxtStyle.line_row(phrase, style, overrides)
+            for phrase, style, _bbox, overrides in page_lines(store_dir, page_num)]
+    return pdfToTxtStyle.universal_newlines(pdfToTxtStyle.csv_text(rows))
+
+
+def has_store(store_dir) -> bool:
+    return all(p.exists() for p in store_files(store_dir))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python styleStore.py <store_dir> [page]")
+        sys.exit(1)
+    store = sys.argv[1]
+    if len(sys.argv) > 2:
+        print(page_csv(store, int(sys.argv[2])), end="")
+        sys.exit(0)
+    _pa, pq = _arrow()
+    for name in TABLES:
+        meta = pq.ParquetFile(Path(store) / f"{name}.parquet").metadata
+        print(f"{name:10s} {meta.num_rows:8d} rows  {meta.num_row_groups:5d} row groups")
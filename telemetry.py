@@ -0,0 +1,271 @@
+"""
+Run telemetry shared by every stage: spans (stage / page timings), counters
+(bytes, retries, backoff, time blocked by the rate limiter) and peak RSS.
+
+Off unless config.TRACE_ENABLED. Each process of a run (main.py and the stage
+scripts it starts) appends its events to <TRACE_DIR>/<run id>/events-<pid>.jsonl;
+the run id travels in the PIPELINE_RUN_ID environment variable. Writes are
+buffered and flushed when a thread's outermost span ends and at exit.
+finish_run() (main.py) merges them into events.jsonl and trace.json (Chrome
+trace: chrome://tracing or ui.perfetto.dev) and prints the time spent per span
+name. Only the TRACE_KEEP_RUNS most recent run directories are kept.
+
+Exporters receive every event dict as it is recorded: add_exporter(fn), or list
+"module:function" names in config.TRACE_EXPORTERS to feed another metrics stack.
+
+    with telemetry.span("style.page", page=12) as s:
+        ...
+        s["bytes_written"] = n
+    telemetry.count("gemini.retries", reason="rate")
+"""
+import atexit
+import importlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from config import TRACE_DIR, TRACE_ENABLED, TRACE_EXPORTERS, TRACE_FORMATS, TRACE_KEEP_RUNS
+
+RUN_ID_ENV = "PIPELINE_RUN_ID"
+
+_lock = threading.Lock()
+_file = None
+_file_pid = None   # a forked pool worker must not write through its parent's file
+_exporters = []
+_exporters_loaded = False
+_local = threading.local()   # span nesting depth of the thread
+# peak RSS is monotonic: sampled at most every RSS_SAMPLE_S seconds, not on every span
+RSS_SAMPLE_S = 0.5
+_rss_sample = (0.0, None)
+
+
+def peak_rss_mb():
+    """Pic de RSS (Mo) de ce processus et de ses enfants (gs) ; None sous Windows."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss est en octets sous macOS, en Ko ailleurs
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _sampled_peak_rss_mb():
+    global _rss_sample
+    now = time.monotonic()
+    if now - _rss_sample[0] >= RSS_SAMPLE_S:
+        _rss_sample = (now, peak_rss_mb())
+    return _rss_sample[1]
+
+
+def current_rss_mb():
+    """Current RSS (MB) of this process; the peak RSS where /proc is not available."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+
+def run_id() -> str:
+    """Current run id; a process started outside main.py gets its own."""
+    if RUN_ID_ENV not in os.environ:
+        os.environ[RUN_ID_ENV] = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+    return os.environ[RUN_ID_ENV]
+
+
+def run_dir() -> Path:
+    return Path(TRACE_DIR) / run_id()
+
+
+def add_exporter(fn) -> None:
+    """fn(event: dict) is called for every event of this process."""
+    _exporters.append(fn)
+
+
+def _load_configured_exporters() -> None:
+    global _exporters_loaded
+    _exporters_loaded = True
+    for name in TRACE_EXPORTERS:
+        module_name, _, attr = name.partition(":")
+        add_exporter(getattr(importlib.import_module(module_name), attr))
+
+
+def prune_runs(keep: int = TRACE_KEEP_RUNS) -> int:
+    """Deletes all but the `keep` most recent run directories (never the current one)."""
+    root = Path(TRACE_DIR)
+    if not root.exists():
+        return 0
+    runs = sorted((p for p in root.iterdir() if p.is_dir() and p.name != run_id()), key=lambda p: p.name)
+    old = runs[:max(0, len(runs) - max(0, keep - 1))]
+    for path in old:
+        shutil.rmtree(path, ignore_errors=True)
+    return len(old)
+
+
+def flush() -> None:
+    with _lock:
+        if _file is not None and _file_pid == os.getpid():
+            _file.flush()
+
+
+def _emit(event: dict) -> None:
+    global _file, _file_pid
+    if not TRACE_ENABLED:
+        return
+    line = json.dumps(event, ensure_ascii=False, default=str)
+    with _lock:
+        if not _exporters_loaded:
+            _load_configured_exporters()
+        if _file is None or _file_pid != os.getpid():
+            if not run_dir().exists():
+                # first process of a new run
+                run_dir().mkdir(parents=True, exist_ok=True)
+                prune_runs()
+            _file = open(run_dir() / f"events-{os.getpid()}.jsonl", "a", encoding="utf-8")
+            if _file_pid is None:
+                atexit.register(flush)
+            _file_pid = os.getpid()
+        _file.write(line + "\n")
+        if getattr(_local, "depth", 0) == 0:
+            # end of an outermost span, or an event outside any span: nothing later would flush it
+            _file.flush()
+    for exporter in _exporters:
+        try:
+            exporter(event)
+        except Exception as e:  # a broken exporter must not stop the pipeline
+            print(f"[WARN] Telemetry exporter {exporter!r} failed: {e}")
+
+
+def emit_span(name: str, start: float, duration: float, **attrs) -> None:
+    """A span measured by the caller (start = time.time())."""
+    _emit({"type": "span", "name": name, "ts": start, "dur": duration,
+           "pid": os.getpid(), "tid": threading.get_ident(), "rss_mb": _sampled_peak_rss_mb(),
+           "attrs": attrs})
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Times the block; the yielded dict can be filled with more attributes (bytes, counts...)."""
+    start, t0 = time.time(), time.perf_counter()
+    error = None
+    _local.depth = getattr(_local, "depth", 0) + 1
+    try:
+        yield attrs
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _local.depth -= 1
+        if TRACE_ENABLED:
+            if error:
+                attrs["error"] = error
+            # depth is back to 0 for the thread's outermost span: _emit flushes after it
+            emit_span(name, start, time.perf_counter() - t0, **attrs)
+
+
+def count(name: str, value=1, **attrs) -> None:
+    _emit({"type": "counter", "name": name, "ts": time.time(), "value": value,
+           "pid": os.getpid(), "tid": threading.get_ident(), "attrs": attrs})
+
+
+def gauge(name: str, value, **attrs) -> None:
+    """A sampled level (memory...): summarized by its maximum instead of a sum."""
+    _emit({"type": "gauge", "name": name, "ts": time.time(), "value": value,
+           "pid": os.getpid(), "tid": threading.get_ident(), "attrs": attrs})
+
+
+# =========================
+# END OF RUN (main.py)
+# =========================
+def load_events(directory=None):
+    events = []
+    for path in sorted(Path(directory or run_dir()).glob("events-*.jsonl")):
+        with open(path, "r", encoding="utf-8") as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    events.sort(key=lambda e: e["ts"])
+    return events
+
+
+def chrome_trace(events) -> dict:
+    """Trace Event Format: spans as complete events (ph X), counters as ph C, microseconds."""
+    t0 = events[0]["ts"] if events else 0
+    trace = []
+    for e in events:
+        ts = (e["ts"] - t0) * 1e6
+        if e["type"] == "span":
+            trace.append({"name": e["name"], "cat": e["name"].split(".")[0], "ph": "X", "ts": ts,
+                          "dur": e["dur"] * 1e6, "pid": e["pid"], "tid": e["tid"],
+                          "args": {**e["attrs"], "rss_mb": e.get("rss_mb")}})
+        else:
+            trace.append({"name": e["name"], "ph": "C", "ts": ts, "pid": e["pid"], "tid": e["tid"],
+                          "args": {"value": e["value"]}})
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+def summarize(events):
+    """{span name: (count, total seconds, max peak RSS)}, {counter name: total, gauge name: max}."""
+    spans = defaultdict(lambda: [0, 0.0, 0.0])
+    counters = defaultdict(float)
+    for e in events:
+        if e["type"] == "span":
+            s = spans[e["name"]]
+            s[0] += 1
+            s[1] += e["dur"]
+            s[2] = max(s[2], e.get("rss_mb") or 0.0)
+        elif e["type"] == "gauge":
+            counters[e["name"]] = max(counters[e["name"]], e["value"])
+        else:
+            counters[e["name"]] += e["value"]
+    return dict(spans), dict(counters)
+
+
+def finish_run() -> Path:
+    """Merges this run's per-process files; returns the run directory."""
+    global _file
+    with _lock:
+        if _file is not None:
+            _file.close()
+            _file = None
+    directory = run_dir()
+    if not TRACE_ENABLED or not directory.exists():
+        return directory
+
+    events = load_events(directory)
+    if "jsonl" in TRACE_FORMATS:
+        with open(directory / "events.jsonl", "w", encoding="utf-8") as f:
+            for e in events:
+                f.write(json.dumps(e, ensure_ascii=False, default=str) + "\n")
+    if "chrome" in TRACE_FORMATS:
+        with open(directory / "trace.json", "w", encoding="utf-8") as f:
+            json.dump(chrome_trace(events), f, default=str)
+    for path in directory.glob("events-*.jsonl"):
+        path.unlink()
+
+    print(f"\n[TIME] Run {run_id()} ({directory})")
+    print_summary(events)
+    return directory
+
+
+def print_summary(events) -> None:
+    spans, counters = summarize(events)
+    for name, (n, total, rss) in sorted(spans.items(), key=lambda kv: -kv[1][1]):
+        print(f"  {name:32s} {n:6d} x {total:9.3f}s   peak RSS {rss:7.1f} MB")
+    for name, total in sorted(counters.items()):
+        print(f"  {name:32s} {total:,.0f}" if total == int(total) else f"  {name:32s} {total:,.3f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python telemetry.py <trace_run_dir>")
+        sys.exit(1)
+    with open(Path(sys.argv[1]) / "events.jsonl", "r", encoding="utf-8") as f:
+        print_summary([json.loads(line) for line in f if line.strip()])